@@ -0,0 +1,94 @@
+"""
+Benchmark of /changes queries with and without jmodseq indexes.
+
+    python -m benchmarks.bench_changes [--sizes 1000,10000,100000]
+
+For every mailbox size a poll that finds the last few changes is timed
+as a jmodseq query of the object table, once with the indexes of the
+first migration and once with them dropped, and as the jchanges lookup
+Email/changes and Thread/changes use. With indexes the time stays flat
+as the mailbox grows, without it grows linearly.
+"""
+import argparse
+import logging
+import shutil
+import tempfile
+from random import Random
+from timeit import repeat
+
+from jmap.db.base import BaseDB
+
+
+def fill(db, messages, rounds, changes, rnd):
+    with db.bulk():
+        for n in range(messages):
+            db.add_message({
+                'msgid': f'm{n:08d}',
+                'thrid': f't{n // 4:08d}',
+                'isDraft': False,
+                'isUnread': True,
+                'keywords': {},
+                'messageId': f'<{n}@example.com>',
+                'inReplyTo': None,
+            }, ['inbox'])
+
+    def sync_round():
+        for _ in range(changes):
+            msgid = f'm{rnd.randrange(messages):08d}'
+            db.change_message(msgid, {'keywords': {'seen': True}}, ['inbox'])
+
+    for _ in range(rounds):
+        db.write(sync_round)
+
+
+def time_query(db, table, since, number):
+    def run():
+        db.dget(table, {'jmodseq': ('>', since)}, 'deleted,jcreated,jmodseq')
+    return min(repeat(run, repeat=5, number=number)) / number
+
+
+def time_changes(db, type, since, number):
+    def run():
+        db.get_changes(type, str(since))
+    return min(repeat(run, repeat=5, number=number)) / number
+
+
+def plan(db, table):
+    with db.reading() as cursor:
+        rows = cursor.execute(f'EXPLAIN QUERY PLAN SELECT * FROM {table} WHERE jmodseq > ?', [0])
+        return '; '.join(row[3] for row in rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='comma separated numbers of messages')
+    parser.add_argument('--number', type=int, default=200)
+    args = parser.parse_args()
+    # filling big mailboxes logs slow statements
+    logging.getLogger('jmap.sql').setLevel(logging.ERROR)
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    print(f"{'messages':>10} {'table':10} {'indexed':>12} {'scan':>12} {'jchanges':>12}")
+    for size in sizes:
+        path = tempfile.mkdtemp(prefix='bench-changes-')
+        try:
+            db = BaseDB('bench', path=path)
+            fill(db, size, rounds=5, changes=5, rnd=Random(42))
+            since = int(db.get_states()['Email']) - 1
+            for table, type in (('jmessages', 'Email'), ('jthreads', 'Thread')):
+                log = time_changes(db, type, since, args.number)
+                indexed = time_query(db, table, since, args.number)
+                if size == sizes[0]:
+                    print(f'{"":>10} {table:10} plan: {plan(db, table)}')
+                db.write(db.cursor.execute, f'DROP INDEX {table}_jmodseq')
+                scan = time_query(db, table, since, args.number)
+                print(f'{size:>10} {table:10} {indexed * 1e6:10.1f}us {scan * 1e6:10.1f}us '
+                      f'{log * 1e6:10.1f}us')
+            db.close()
+        finally:
+            shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Micro-benchmark of parse.htmltotext over a corpus of newsletters.
+
+    python -m benchmarks.bench_htmltotext [CORPUS_DIR] [--repeat N]
+
+CORPUS_DIR holds *.eml and/or *.html files, html parts are extracted
+from messages. Without a corpus a synthetic newsletter is generated.
+"""
+import argparse
+import os
+from timeit import repeat
+
+from jmap import mime
+from jmap.parse import htmltotext
+
+
+def load_corpus(path):
+    docs = []
+    for name in sorted(os.listdir(path)):
+        with open(os.path.join(path, name), 'rb') as f:
+            raw = f.read()
+        if name.endswith('.html') or name.endswith('.htm'):
+            docs.append(raw.decode('utf-8', 'replace'))
+        elif name.endswith('.eml'):
+            for part in mime.parse(raw).walk():
+                if part.type == 'text/html':
+                    docs.append(part.text()[0])
+    return docs
+
+
+def synthetic_newsletter(items=200):
+    story = (
+        '<tr><td class="story" style="padding:12px;font-family:Arial">'
+        '<a href="https://example.com/story?id={n}&amp;utm_source=news">'
+        '<img src="https://example.com/{n}.jpg" width="600" alt="Story {n}"></a>'
+        '<h2 style="margin:0">Headline number {n} &mdash; read&nbsp;more</h2>'
+        '<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit &amp; sed do '
+        'eiusmod tempor incididunt ut labore et dolore magna aliqua.</p>'
+        '</td></tr>\n'
+    )
+    return (
+        '<!DOCTYPE html><html><head><title>Weekly</title>'
+        '<style>' + 'td.story{color:#333}' * 200 + '</style></head><body>'
+        '<script>' + 'var tracking = 1;' * 200 + '</script>'
+        '<table width="100%">' + ''.join(story.format(n=n) for n in range(items)) +
+        '</table><!-- footer --><p>Unsubscribe</p></body></html>'
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('corpus', nargs='?', help='directory with .eml/.html files')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--number', type=int, default=20)
+    args = parser.parse_args()
+
+    docs = load_corpus(args.corpus) if args.corpus else [synthetic_newsletter()]
+    if not docs:
+        parser.error('no html documents found in corpus')
+    total = sum(len(d) for d in docs)
+    print(f'{len(docs)} documents, {total / 1024:.0f} KiB of html')
+
+    for label, limit in (('full text', None), ('preview 256', 256)):
+        best = min(repeat(lambda: [htmltotext(d, limit) for d in docs],
+                          repeat=args.repeat, number=args.number)) / args.number
+        print(f'{label:12} {best * 1000:8.2f} ms/corpus '
+              f'{total / best / 2**20:8.1f} MiB/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Benchmark of SQLite storage profiles on mirror workloads.
+
+    python -m benchmarks.bench_sqlite [--messages N] [--profile NAME ...]
+
+For every profile a fresh mirror is filled in bulk like an initial sync,
+then updated in many small transactions like incremental syncs, and
+finally asked for changes since a range of states like Email/changes.
+"""
+import argparse
+import logging
+from random import Random
+import shutil
+import tempfile
+from time import perf_counter
+
+from jmap.db import storage
+from jmap.db.base import BaseDB
+
+
+MAILBOXES = ('inbox', 'archive', 'sent', 'drafts', 'lists')
+
+
+def message(n, rnd):
+    return {
+        'msgid': f'm{n:08d}',
+        'thrid': f't{n // 4:08d}',
+        'isDraft': False,
+        'isUnread': rnd.random() < 0.2,
+        'keywords': {} if rnd.random() < 0.2 else {'$seen': True},
+        'messageId': f'<{n}@example.com>',
+        'inReplyTo': f'<{n - 1}@example.com>' if n % 4 else None,
+        'subject': f'Message number {n}',
+        'size': rnd.randrange(2000, 200000),
+    }
+
+
+def bench_backfill(db, args, rnd):
+    for jmailboxid in MAILBOXES:
+        db.dmake('jmailboxes', {'jmailboxid': jmailboxid, 'name': jmailboxid})
+    with db.bulk():
+        for n in range(args.messages):
+            db.add_message(message(n, rnd), [rnd.choice(MAILBOXES)])
+
+
+def bench_sync(db, args, rnd):
+    "Flag changes, one writer job per sync round."
+    def sync_round():
+        for _ in range(args.changes):
+            n = rnd.randrange(args.messages)
+            msgid = f'm{n:08d}'
+            seen = rnd.random() < 0.5
+            mailboxes = db.dgetcol('jmessagemap', {'msgid': msgid, 'deleted': 0}, 'jmailboxid')
+            db.change_message(msgid, {'keywords': {'seen': True} if seen else {}}, mailboxes)
+
+    for _ in range(args.rounds):
+        db.write(sync_round)
+
+
+def bench_changes(db, args, rnd):
+    "Email/changes from recent states back to old ones."
+    high = int(db.get_states()['Email'])
+    for since in range(high, max(high - args.rounds, 0), -1):
+        db.get_changes('Email', str(since))
+
+
+WORKLOADS = (
+    ('backfill', bench_backfill),
+    ('sync', bench_sync),
+    ('changes', bench_changes),
+)
+
+
+def run(profile, args):
+    path = tempfile.mkdtemp(prefix='bench-sqlite-')
+    try:
+        db = BaseDB('bench', path=path, profile=profile)
+        rnd = Random(42)
+        results = []
+        for name, workload in WORKLOADS:
+            t0 = perf_counter()
+            workload(db, args, rnd)
+            results.append((name, perf_counter() - t0))
+        db.close()
+        return results
+    finally:
+        shutil.rmtree(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--rounds', type=int, default=200, help='sync rounds and changes calls')
+    parser.add_argument('--changes', type=int, default=20, help='messages changed per sync round')
+    parser.add_argument('--profile', action='append', choices=sorted(storage.PROFILES),
+                        help='profile to run, default all')
+    parser.add_argument('--dir', help='put databases here instead of the temp dir, '
+                        'for benchmarking the disk the mirror lives on')
+    args = parser.parse_args()
+    if args.dir:
+        tempfile.tempdir = args.dir
+    logging.getLogger('jmap.sql').setLevel(logging.WARNING)
+
+    print(f'{args.messages} messages, {args.rounds} rounds of {args.changes} changes')
+    print(f"{'profile':10}" + ''.join(f'{name:>12}' for name, _ in WORKLOADS))
+    for profile in args.profile or storage.PROFILES:
+        results = run(profile, args)
+        print(f'{profile:10}' + ''.join(f'{elapsed * 1000:10.0f}ms' for _, elapsed in results))
+
+
+if __name__ == '__main__':
+    main()
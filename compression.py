@@ -0,0 +1,181 @@
+"""
+Response compression negotiated by Accept-Encoding.
+
+gzip is always available, zstd and br are offered when the zstandard
+and brotli packages are installed. Streaming responses are compressed
+chunk by chunk and flushed, event streams are not compressed at all so
+every event is sent as it comes. Responses that could be compressed get
+Vary: Accept-Encoding whether they are or not, HEAD ones never are.
+"""
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from starlette.datastructures import Headers, MutableHeaders
+
+
+# events are a few bytes each and must arrive as they are sent
+STREAM_TYPES = {'text/event-stream'}
+# content already compressed, recompressing wastes CPU for nothing
+SKIP_TYPES = ('image/', 'video/', 'audio/', 'font/woff')
+SKIP_SUBTYPES = {
+    'application/zip', 'application/gzip', 'application/x-gzip',
+    'application/pdf', 'application/zstd', 'application/x-7z-compressed',
+    'application/x-rar-compressed', 'application/x-bzip2', 'application/x-xz',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+}
+
+
+class GzipCompressor:
+    def __init__(self, level=6):
+        self.obj = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data, flush=False):
+        out = self.obj.compress(data)
+        return out + self.obj.flush(zlib.Z_SYNC_FLUSH) if flush else out
+
+    def finish(self):
+        return self.obj.flush()
+
+
+class ZstdCompressor:
+    def __init__(self, level=3):
+        self.obj = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data, flush=False):
+        out = self.obj.compress(data)
+        return out + self.obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK) if flush else out
+
+    def finish(self):
+        return self.obj.flush()
+
+
+class BrotliCompressor:
+    def __init__(self, level=4):
+        self.obj = brotli.Compressor(quality=level)
+
+    def compress(self, data, flush=False):
+        out = self.obj.process(data)
+        return out + self.obj.flush() if flush else out
+
+    def finish(self):
+        return self.obj.finish()
+
+
+# in order of preference
+COMPRESSORS = {}
+if zstandard is not None:
+    COMPRESSORS['zstd'] = ZstdCompressor
+if brotli is not None:
+    COMPRESSORS['br'] = BrotliCompressor
+COMPRESSORS['gzip'] = GzipCompressor
+
+
+def negotiate(accept_encoding: str):
+    "Return best supported coding from Accept-Encoding header, or None."
+    accepted = {}
+    for item in accept_encoding.lower().split(','):
+        coding, _, params = item.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding.strip()] = q
+    best = None
+    for coding in COMPRESSORS:
+        q = accepted.get(coding, accepted.get('*', 0.0))
+        if q > 0 and (best is None or q > best[1]):
+            best = (coding, q)
+    return best and best[0]
+
+
+def is_compressible(content_type: str):
+    content_type = content_type.split(';', 1)[0].strip().lower()
+    return not (content_type.startswith(SKIP_TYPES) or content_type in SKIP_SUBTYPES
+                or content_type in STREAM_TYPES)
+
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size=1024):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        coding = None
+        if scope['method'] != 'HEAD':
+            coding = negotiate(Headers(scope=scope).get('accept-encoding', ''))
+        responder = CompressionResponder(send, coding, self.minimum_size)
+        await self.app(scope, receive, responder.send)
+
+
+class CompressionResponder:
+    """
+    Wraps ASGI send, coding None only adds the Vary header. A response
+    sent in one piece is compressed when it has at least minimum_size
+    bytes. A streamed one is compressed from
+    its first chunk, and every chunk is flushed right away.
+    """
+    def __init__(self, send, coding, minimum_size):
+        self._send = send
+        self.coding = coding
+        self.minimum_size = minimum_size
+        self.start = None
+        self.compressor = None
+        self.passthrough = False
+
+    async def send(self, message):
+        if message['type'] == 'http.response.start':
+            # wait for body to decide
+            self.start = message
+            headers = MutableHeaders(raw=message['headers'])
+            if 'content-encoding' in headers \
+                    or not is_compressible(headers.get('content-type', '')):
+                self.passthrough = True
+                return
+            # caches must not mix compressed and uncompressed responses
+            headers.add_vary_header('Accept-Encoding')
+            if self.coding is None:
+                self.passthrough = True
+            return
+        if message['type'] != 'http.response.body':
+            return await self._send(message)
+        if self.passthrough:
+            if self.start:
+                await self._send(self.start)
+                self.start = None
+            return await self._send(message)
+
+        body = message.get('body', b'')
+        more_body = message.get('more_body', False)
+        if self.start:
+            start, self.start = self.start, None
+            if not more_body and len(body) < self.minimum_size:
+                self.passthrough = True
+                await self._send(start)
+                return await self._send({'type': 'http.response.body', 'body': body})
+            headers = MutableHeaders(raw=start['headers'])
+            headers['Content-Encoding'] = self.coding
+            del headers['Content-Length']
+            self.compressor = COMPRESSORS[self.coding]()
+            await self._send(start)
+
+        if more_body:
+            # flush each chunk, streamed content is wanted as it comes
+            data = self.compressor.compress(body, flush=True)
+        else:
+            data = self.compressor.compress(body) + self.compressor.finish()
+        await self._send({'type': 'http.response.body', 'body': data, 'more_body': more_body})
@@ -1,3 +1,4 @@
+from jmap import maintenance
 from jmap.db.imap import ImapDB
 
 class Account:
@@ -9,6 +10,7 @@ class ImapAccount(Account):
         self.id = accountId
         self.name = accountId
         self.db = ImapDB(accountId, password)
+        maintenance.register(self.db)
         self.capabilities = {
             "urn:ietf:params:jmap:vacationresponse": {},
             "urn:ietf:params:jmap:submission": {
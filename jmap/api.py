@@ -1,6 +1,7 @@
+from functools import lru_cache
 import logging as log
 from time import monotonic
-import re
+from types import MappingProxyType, SimpleNamespace
 
 from jmap.account import ImapAccount
 import jmap.core as core
@@ -9,81 +10,66 @@ import jmap.submission as submission
 import jmap.vacationresponse as vacationresponse
 import jmap.contacts as contacts
 import jmap.calendars as calendars
-from jmap import errors
+import jmap.websocket as websocket
+from jmap import errors, metrics, tracing
 
 
 CAPABILITIES = {
     'urn:ietf:params:jmap:core': core,
     'urn:ietf:params:jmap:mail': mail,
+    'urn:ietf:params:jmap:websocket': websocket,
     # 'urn:ietf:params:jmap:submission': jmap.submission,
     # 'urn:ietf:params:jmap:vacationresponse': jmap.vacationresponse,
     # 'urn:ietf:params:jmap:contacts': jmap.contacts,
     # 'urn:ietf:params:jmap:calendars': jmap.calendars,
 }
 
-def handle_request(user, data):
-    results = []
-    resultsByTag = {}
 
-    api = Api(user, data.get('createdIds', None))
-    for capability in data['using']:
-        CAPABILITIES[capability].register_methods(api)
+def _build_registry():
+    "Collect methods of every capability once, at import time."
+    registry = {}
+    for capability, module in CAPABILITIES.items():
+        collector = SimpleNamespace(methods={})
+        module.register_methods(collector)
+        registry[capability] = MappingProxyType(collector.methods)
+    return MappingProxyType(registry)
 
-    for cmd, kwargs, tag in data['methodCalls']:
-        t0 = monotonic()
-        logbit = ''
-        try:
-            func = api.methods[cmd]
-        except KeyError:
-            results.append(('error', {'error': 'unknownMethod'}, tag))
-            continue
-
-        # resolve kwargs
-        error = False
-        for key in [k for k in kwargs.keys() if k[0] == '#']:
-            # we are updating dict over which we iterate
-            # please check that your changes don't skip keys
-            val = kwargs.pop(key)
-            val = _parsepath(val['path'], resultsByTag[val['resultOf']])
-            if val is None:
-                results.append(('error',
-                    {'type': 'resultReference', 'message': repr(val)}, tag))
-                error = True
-                break
-            elif not isinstance(val, list):
-                val = [val]
-            kwargs[key[1:]] = val
-        if error: continue
+METHODS = _build_registry()
+
+
+@lru_cache(maxsize=64)
+def _merge_methods(using: frozenset):
+    methods = {}
+    for capability in using:
+        methods.update(METHODS[capability])
+    return MappingProxyType(methods)
 
-        try:
-            result = func(api, **kwargs)
-            results.append((cmd, result, tag))
-            resultsByTag[tag] = result
-        except Exception as e:
-            results.append(('error', {
-                'type': e.__class__.__name__,
-                'message': str(e),
-            }, tag))
-            raise e
-            api.rollback()
-
-        elapsed = monotonic() - t0
-
-        # log method call
-        if kwargs.get('ids', None):
-            logbit += " [" + (",".join(kwargs['ids'][:4]))
-            if len(kwargs['ids']) > 4:
-                logbit += ", ..." + str(len(kwargs['ids']))
-            logbit += "]"
-        if kwargs.get('properties', None):
-            logbit += " (" + (",".join(kwargs['properties'][:4]))
-            if len(kwargs['properties']) > 4:
-                logbit += ", ..." + str(len(kwargs['properties']))
-            logbit += ")"
-        log.info(f'JMAP CMD {cmd}{logbit} took {elapsed}')
 
+def methods_for(using):
+    """
+    Return read-only method table of capabilities in using,
+    raise unknownCapability if any of them is not supported.
+    """
+    unknown = [capability for capability in using if capability not in METHODS]
+    if unknown:
+        raise errors.unknownCapability(', '.join(unknown))
+    return _merge_methods(frozenset(using))
+
+
+def is_request(data) -> bool:
+    "Whether data matches the type signature of the Request object."
+    return isinstance(data, dict) \
+        and isinstance(data.get('using', None), list) \
+        and isinstance(data.get('methodCalls', None), list) \
+        and all(isinstance(call, list) and len(call) == 3
+                and isinstance(call[0], str) and isinstance(call[1], dict)
+                and isinstance(call[2], str)
+                for call in data['methodCalls'])
+
+
+def handle_request(user, data):
     out = {
-        'methodResponses': results,
+        'methodResponses': list(iter_responses(user, data)),
         'sessionState': user.sessionState,
     }
     if 'createdIds' in data:
@@ -91,11 +77,112 @@ def handle_request(user, data):
     return out
 
 
+def iter_responses(user, data, methods=None):
+    """
+    Process methodCalls of the request, yield (name, arguments, tag)
+    of each method response as soon as it is done.
+    Only results referenced by later calls are kept in memory.
+    methods is the table from methods_for(), looked up when not given.
+    """
+    if methods is None:
+        methods = methods_for(data['using'])
+    resultsByTag = {}
+    referenced = {
+        val['resultOf']
+        for _, kwargs, _ in data['methodCalls']
+        for key, val in kwargs.items()
+        if key[0] == '#' and isinstance(val, dict) and isinstance(val.get('resultOf'), str)
+    }
+
+    api = Api(user, data.get('createdIds', None), methods)
+
+    # parent of method spans, it can't be entered as we yield in between
+    request_span = tracing.span('jmap request', calls=len(data['methodCalls']))
+    try:
+        for cmd, kwargs, tag in data['methodCalls']:
+            t0 = monotonic()
+            logbit = ''
+            try:
+                func = api.methods[cmd]
+            except KeyError:
+                yield ('error', {'error': 'unknownMethod'}, tag)
+                continue
+
+            # resolve kwargs
+            error = False
+            for key in [k for k in kwargs.keys() if k[0] == '#']:
+                # we are updating dict over which we iterate
+                # please check that your changes don't skip keys
+                try:
+                    val = resolve_reference(kwargs.pop(key), resultsByTag)
+                except errors.invalidResultReference as e:
+                    yield ('error',
+                        {'type': 'invalidResultReference', 'message': str(e)}, tag)
+                    error = True
+                    break
+                if not isinstance(val, list):
+                    val = [val]
+                kwargs[key[1:]] = val
+            if error: continue
+
+            try:
+                with tracing.span('jmap ' + cmd, parent=request_span, method=cmd, tag=tag):
+                    result = func(api, **kwargs)
+                if tag in referenced:
+                    resultsByTag[tag] = (cmd, result)
+            except errors.JmapError as e:
+                yield ('error', {
+                    'type': e.__class__.__name__,
+                    'message': str(e),
+                }, tag)
+                continue
+            except Exception as e:
+                # the response is streamed, later calls still get theirs
+                log.exception('JMAP CMD %s failed', cmd)
+                yield ('error', {'type': 'serverFail', 'description': str(e)}, tag)
+                continue
+
+            elapsed = monotonic() - t0
+            metrics.observe('jmap_method_duration_seconds', elapsed, method=cmd)
+            objects = _object_count(result)
+            if objects is not None:
+                metrics.observe('jmap_method_objects', objects, metrics.COUNT_BUCKETS, method=cmd)
+
+            # log method call
+            if log.getLogger().isEnabledFor(log.INFO):
+                if kwargs.get('ids', None):
+                    logbit += " [" + (",".join(kwargs['ids'][:4]))
+                    if len(kwargs['ids']) > 4:
+                        logbit += ", ..." + str(len(kwargs['ids']))
+                    logbit += "]"
+                if kwargs.get('properties', None):
+                    logbit += " (" + (",".join(kwargs['properties'][:4]))
+                    if len(kwargs['properties']) > 4:
+                        logbit += ", ..." + str(len(kwargs['properties']))
+                    logbit += ")"
+                log.info('JMAP CMD %s%s took %s', cmd, logbit, elapsed)
+            yield (cmd, result, tag)
+    finally:
+        request_span.finish()
+
+
+def _object_count(result):
+    "Number of objects returned by /get, /query and /changes methods."
+    if not isinstance(result, dict):
+        return None
+    for key in ('list', 'ids'):
+        if isinstance(result.get(key, None), list):
+            return len(result[key])
+    if 'created' in result and isinstance(result['created'], list):
+        return len(result['created']) + len(result.get('updated', ())) + len(result.get('destroyed', ()))
+    return None
+
+
 class Api:
-    def __init__(self, user, idmap=None):
+    def __init__(self, user, idmap=None, methods=MappingProxyType({})):
         self.user = user
         self._idmap = idmap or {}
-        self.methods = {}
+        self.methods = methods
     
     def get_account(self, accountId) -> ImapAccount:
         try:
@@ -110,25 +197,69 @@ class Api:
         return self._idmap.get(key, key)
 
 
-def _parsepath(path, item):
-    match = re.match(r'^/([^/]+)', path)
-    if not match:
-        return item
-    selector = match.group(1)
-    if isinstance(item, list):
-        if selector == '*':
-            res = []
-            for one in item:
-                r = _parsepath(path[match.end():], one)
-                if isinstance(r, list):
-                    res.extend(r)
-                else:
-                    res.append(r)
-            return res
-        if selector.isnumeric():
-            return item[int(selector)]
+def resolve_reference(ref, resultsByTag):
+    "Return value ResultReference ref points to, in results of earlier calls."
+    if not isinstance(ref, dict) or not isinstance(ref.get('resultOf'), str):
+        raise errors.invalidResultReference(f'invalid reference {ref!r}')
+    try:
+        name, result = resultsByTag[ref['resultOf']]
+    except KeyError:
+        raise errors.invalidResultReference(f'no result for {ref!r}')
+    if ref.get('name', name) != name:
+        raise errors.invalidResultReference(f"{ref['resultOf']} is {name}, not {ref['name']}")
+    path = ref.get('path', '')
+    if not isinstance(path, str):
+        raise errors.invalidResultReference(f'invalid path {path!r}')
+    return evaluate_path(compile_path(path), result)
 
-    elif isinstance(item, dict):
-        return _parsepath(path[match.end():], item[selector])
 
-    return item
+@lru_cache(maxsize=1024)
+def compile_path(path: str) -> tuple:
+    "Parse JSON pointer into tuple of unescaped reference tokens."
+    if not path:
+        return ()
+    if path[0] != '/':
+        raise errors.invalidResultReference(f'invalid path {path!r}')
+    return tuple(token.replace('~1', '/').replace('~0', '~')
+                 for token in path[1:].split('/'))
+
+
+def evaluate_path(tokens: tuple, item):
+    """
+    Evaluate compiled JSON pointer with the "*" extension of RFC 8620,
+    section 3.7: "*" applies the rest of the path to every array item
+    and array results are flattened into a single list.
+    """
+    values = [item]
+    wildcard = False
+    for token in tokens:
+        out = []
+        for value in values:
+            if isinstance(value, dict):
+                try:
+                    out.append(value[token])
+                except KeyError:
+                    raise errors.invalidResultReference(f'{token!r} not found')
+            elif isinstance(value, list):
+                if token == '*':
+                    wildcard = True
+                    out.extend(value)
+                elif token.isdecimal() and token.isascii():
+                    try:
+                        out.append(value[int(token)])
+                    except (ValueError, IndexError):
+                        raise errors.invalidResultReference(f'index {token} out of range')
+                else:
+                    raise errors.invalidResultReference(f'{token!r} is not an array index')
+            else:
+                raise errors.invalidResultReference(f'{token!r} not found')
+        values = out
+    if not wildcard:
+        return values[0]
+    res = []
+    for value in values:
+        if isinstance(value, list):
+            res.extend(value)
+        else:
+            res.append(value)
+    return res
@@ -0,0 +1,159 @@
+"""
+Streaming message composer.
+
+make() describes the RFC 5322 message as a list of segments: header and
+boundary bytes, encoded text bodies and attachments read from blob
+storage. Total length is known before anything is read, so the message
+can be sent as IMAP APPEND literal in chunks with constant memory.
+"""
+from binascii import b2a_base64, b2a_qp
+from email.header import Header
+from email.utils import format_datetime, formataddr
+from urllib.parse import quote
+import uuid
+
+from jmap.parse import htmltotext
+
+
+# 57 octets encode to one 76 characters base64 line
+BASE64_LINE = 57
+CHUNK_LINES = 1024
+
+
+class Base64Blob:
+    "Base64 encoded body of a blob, read from file-like object in chunks."
+    def __init__(self, open, size):
+        self.open = open
+        self.size = size
+
+    def __len__(self):
+        lines, rest = divmod(self.size, BASE64_LINE)
+        length = lines * 78  # 76 characters + CRLF
+        if rest:
+            length += (rest + 2) // 3 * 4 + 2
+        return length
+
+    def __iter__(self):
+        chunksize = BASE64_LINE * CHUNK_LINES
+        with self.open() as f:
+            while True:
+                chunk = f.read(chunksize)
+                if not chunk:
+                    break
+                yield b''.join(
+                    b2a_base64(chunk[i:i + BASE64_LINE], newline=False) + b'\r\n'
+                    for i in range(0, len(chunk), BASE64_LINE))
+
+
+class ComposedMessage:
+    "RFC 5322 message as sequence of bytes and Base64Blob segments."
+    def __init__(self, segments=(), has_attachment=False):
+        self.segments = list(segments)
+        self.has_attachment = has_attachment
+
+    def __len__(self):
+        return sum(len(s) for s in self.segments)
+
+    def __iter__(self):
+        for segment in self.segments:
+            if isinstance(segment, bytes):
+                yield segment
+            else:
+                yield from segment
+
+    def __bytes__(self):
+        return b''.join(self)
+
+
+def _header(name, value):
+    if not value.isascii():
+        value = Header(value, 'utf-8', header_name=name).encode()
+    return f'{name}: {value}\r\n'.encode()
+
+
+def _param(key, value):
+    if value.isascii():
+        value = value.replace('\\', '\\\\').replace('"', '\\"')
+        return f'; {key}="{value}"'
+    # RFC 2231
+    return f"; {key}*=utf-8''{quote(value)}"
+
+
+def _mkone(a):
+    return formataddr((a['name'] or '', a['email']), charset='utf-8')
+
+def _mkemail(aa):
+    return ', '.join(_mkone(a) for a in aa)
+
+
+def _text_part(text, subtype):
+    text = text.replace('\r\n', '\n').replace('\n', '\r\n')
+    body = b2a_qp(text.encode('utf-8'))
+    if not body.endswith(b'\r\n'):
+        body += b'\r\n'
+    return [
+        f'Content-Type: text/{subtype}; charset="utf-8"\r\n'
+        'Content-Transfer-Encoding: quoted-printable\r\n\r\n'.encode(),
+        body,
+    ]
+
+
+def _attachment_part(att, open_blob):
+    typ, size, open = open_blob(att['blobId'])
+    name = att.get('name', None)
+    disposition = 'inline' if att.get('isInline', False) else 'attachment'
+    headers = [
+        _header('Content-Type', (att.get('type', None) or typ) + (_param('name', name) if name else '')),
+        _header('Content-Disposition', disposition + (_param('filename', name) if name else '')),
+    ]
+    if att.get('cid', None):
+        headers.append(_header('Content-ID', f"<{att['cid']}>"))
+    headers.append(b'Content-Transfer-Encoding: base64\r\n\r\n')
+    return headers + [Base64Blob(open, size)]
+
+
+def _multipart(subtype, parts):
+    boundary = uuid.uuid4().hex
+    segments = [f'Content-Type: multipart/{subtype}; boundary="{boundary}"\r\n\r\n'.encode()]
+    for part in parts:
+        segments.append(f'--{boundary}\r\n'.encode())
+        segments.extend(part)
+        segments.append(b'\r\n')
+    segments.append(f'--{boundary}--\r\n'.encode())
+    return segments
+
+
+def make(args, open_blob):
+    """
+    Compose message from Email/set create arguments.
+    open_blob(blobId) returns (type, size, open) of attachment content.
+    """
+    segments = [
+        _header('From', _mkemail(args['from'])),
+        _header('To', _mkemail(args['to'])),
+    ]
+    if args.get('cc', None):
+        segments.append(_header('Cc', _mkemail(args['cc'])))
+    if args.get('bcc', None):
+        segments.append(_header('Bcc', _mkemail(args['bcc'])))
+    if args.get('replyTo', None):
+        segments.append(_header('Reply-To', _mkemail(args['replyTo'])))
+    segments.append(_header('Subject', args['subject']))
+    segments.append(_header('Date', format_datetime(args['msgdate'])))
+    for header, val in args.get('headers', {}).items():
+        segments.append(_header(header, val))
+    segments.append(b'MIME-Version: 1.0\r\n')
+
+    if 'textBody' in args:
+        text = args['textBody']
+    else:
+        text = htmltotext(args['htmlBody'])
+    body = _text_part(text, 'plain')
+    if 'htmlBody' in args:
+        body = _multipart('alternative', [body, _text_part(args['htmlBody'], 'html')])
+
+    attachments = args.get('attachments', ())
+    if attachments:
+        body = _multipart('mixed', [body] + [_attachment_part(att, open_blob) for att in attachments])
+    segments.extend(body)
+    return ComposedMessage(segments, has_attachment=bool(attachments))
@@ -1,18 +1,41 @@
+from contextlib import contextmanager
+import io
+from itertools import groupby
+from operator import itemgetter
 import os
 import sqlite3
 import time
 from collections import defaultdict
 import re
-from datetime import datetime
+from datetime import datetime, timedelta
 import uuid
 try:
     import orjson as json
 except ImportError:
     import json
 
-from jmap import parse
+from jmap import compose, errors
+from . import query, storage
+from .cursor import InstrumentedCursor
+from .migrations import migrate, modseq_indexes
+from .pool import ReaderPool
+from .writer import Writer, writes
 
 
+# compiled statements kept per connection, helpers reuse the same SQL text
+SQL_CACHED_STATEMENTS = int(os.getenv('SQL_CACHED_STATEMENTS', 256))
+# messages per transaction in bulk mode
+BULK_CHUNK_SIZE = int(os.getenv('BULK_CHUNK_SIZE', 5000))
+# tombstones and changes older than this are purged by compact()
+COMPACT_RETENTION_DAYS = float(os.getenv('COMPACT_RETENTION_DAYS', 30))
+# rows deleted per writer job, so syncs run in between
+COMPACT_BATCH = int(os.getenv('COMPACT_BATCH', 1000))
+# pages freed by incremental vacuum per run, and per writer job
+COMPACT_VACUUM_PAGES = int(os.getenv('COMPACT_VACUUM_PAGES', 4096))
+COMPACT_VACUUM_STEP = int(os.getenv('COMPACT_VACUUM_STEP', 256))
+# tables with tombstones flagged in deleted and modseq in jmodseq
+TOMBSTONE_TABLES = ('jmessages', 'jmessagemap', 'jthreads')
+
 TABLE2GROUPS = {
   'jmessages': ['Email'],
   'jthreads': ['Thread'],
@@ -30,106 +53,393 @@ TABLE2GROUPS = {
   'jcalendarprefs': ['CalendarPreferences'],
 }
 
+# tables whose changes are logged to jchanges: (type, id column)
+CHANGELOG = {
+    'jmessages': ('Email', 'msgid'),
+    'jthreads': ('Thread', 'thrid'),
+    'jmailboxes': ('Mailbox', 'jmailboxid'),
+}
+MAILBOX_COUNTS = ('totalEmails', 'unreadEmails', 'totalThreads', 'unreadThreads')
+# account columns holding state of a type, jstate<type> for the others
+STATE_COLUMNS = {
+    'Email': 'highModSeqEmail',
+    'Thread': 'highModSeqThread',
+    'Mailbox': 'highModSeqMailbox',
+}
+
+
+def change_kind(table, values):
+    "Kind of change logged for an update of table with values."
+    if 'deleted' in values:
+        return 'destroyed' if values['deleted'] else 'created'
+    if table == 'jmailboxes' and values and all(key in MAILBOX_COUNTS for key in values):
+        return 'counts'
+    return 'updated'
+
+
+def count_deltas(old, new):
+    """
+    Deltas of mailbox counts when threads change from old to new, both
+    {(jmailboxid, thrid): (emails, unread)} of all mailboxes holding the
+    threads. Return {jmailboxid: [delta of each of MAILBOX_COUNTS]}.
+    """
+    # like mailbox_counts(), a thread is unread in every mailbox holding
+    # it when it has an unread message in any of them
+    unread_old = {thrid for (_, thrid), (_, unread) in old.items() if unread}
+    unread_new = {thrid for (_, thrid), (_, unread) in new.items() if unread}
+    deltas = defaultdict(lambda: [0, 0, 0, 0])
+    for key in old.keys() | new.keys():
+        jmailboxid, thrid = key
+        emails0, unread0 = old.get(key, (0, 0))
+        emails1, unread1 = new.get(key, (0, 0))
+        delta = (
+            emails1 - emails0,
+            unread1 - unread0,
+            (emails1 > 0) - (emails0 > 0),
+            (emails1 > 0 and thrid in unread_new) - (emails0 > 0 and thrid in unread_old),
+        )
+        if any(delta):
+            deltas[jmailboxid] = [a + b for a, b in zip(deltas[jmailboxid], delta)]
+    return dict(deltas)
+
+
+def thread_order(messages):
+    "Order msgids of thread, drafts follow the message they reply to."
+    drafts = defaultdict(list)
+    msgs = []
+    seenmsgs = set()
+    for msg in messages:
+        if msg['isDraft'] and msg['inReplyTo']:
+            # push the rest of the drafts to the end
+            drafts[msg['inReplyTo']].append(msg['msgid'])
+
+    for msg in messages:
+        if msg['isDraft']: continue
+        msgs.append(msg['msgid'])
+        seenmsgs.add(msg['msgid'])
+        if msg['messageId']:
+            for draft in drafts.get(msg['messageId'], ()):
+                msgs.append(draft)
+                seenmsgs.add(draft)
+    # make sure unlinked drafts aren't forgotten!
+    for msg in messages:
+        if msg['msgid'] in seenmsgs: continue
+        msgs.append(msg['msgid'])
+        seenmsgs.add(msg['msgid'])
+    return msgs
+
 
 class BaseDB:
-    def __init__(self, accountid, path='./data/'):
+    # {component: [(version, name, steps)]}, subclasses add their component
+    MIGRATIONS = {
+        'base': [
+            (1, 'jmodseq and jcreated indexes',
+             modseq_indexes('jmessages', 'jthreads', 'jmailboxes', 'jmessagemap')),
+            (2, 'jchanges log', (
+                """CREATE TABLE jchanges (
+                    jchangeid INTEGER PRIMARY KEY AUTOINCREMENT,
+                    modseq INTEGER NOT NULL,
+                    type TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    change TEXT NOT NULL
+                )""",
+                "CREATE INDEX jchanges_type ON jchanges (type, modseq)",
+                "CREATE INDEX jchanges_modseq ON jchanges (modseq)",
+            )),
+            (3, 'modseq commit times', (
+                """CREATE TABLE jmodseqs (
+                    modseq INTEGER PRIMARY KEY,
+                    mtime DATE
+                )""",
+                "CREATE INDEX jmodseqs_mtime ON jmodseqs (mtime)",
+            )),
+            (4, 'mailbox thread counts', (
+                """CREATE TABLE jmailboxthreads (
+                    jmailboxid TEXT NOT NULL,
+                    thrid TEXT NOT NULL,
+                    emails INTEGER NOT NULL,
+                    unread INTEGER NOT NULL,
+                    PRIMARY KEY (jmailboxid, thrid)
+                )""",
+                "CREATE INDEX jmailboxthreads_thrid ON jmailboxthreads (thrid)",
+                """INSERT INTO jmailboxthreads (jmailboxid, thrid, emails, unread)
+                    SELECT jmailboxid, thrid, COUNT(*), SUM(isUnread = 1)
+                    FROM jmessages JOIN jmessagemap USING (msgid)
+                    WHERE jmessages.deleted = 0 AND jmessagemap.deleted = 0
+                    GROUP BY jmailboxid, thrid""",
+            )),
+        ],
+    }
+
+    def __init__(self, accountid, path='./data/', profile=None):
         self.accountid = accountid
         self.dbpath = os.path.join(path, accountid + '.db')
         print('Opening dbpath', self.dbpath)
-        self.dbh = sqlite3.connect(self.dbpath, isolation_level='DEFERRED')
+        # the write connection belongs to the writer thread,
+        # which opens and commits its transactions
+        self.dbh = sqlite3.connect(self.dbpath, isolation_level=None,
+                                   check_same_thread=False,
+                                   cached_statements=SQL_CACHED_STATEMENTS)
+        # only takes effect on new databases, see compact()
+        self.dbh.execute("PRAGMA auto_vacuum=INCREMENTAL")
         self.dbh.execute("PRAGMA journal_mode=WAL")
+        self.pragmas = storage.apply(self.dbh, profile)
+        self.optimized = time.monotonic()
         self.dbh.row_factory = sqlite3.Row
         self._initdb()
-        self.cursor = self.dbh.cursor()
+        self.cursor = self.dbh.cursor(InstrumentedCursor)
         self.cursor.row_factory = sqlite3.Row
-        self.cursor.execute('BEGIN DEFERRED')
+        migrate(self.cursor, self.MIGRATIONS)
         self.modseq = 0
         self.tables = {}
         self.backfilling = False
-        self.updated_mailbox_counts = {}
+        self.updated_threads = set()
         self.change_cb = None
+        self.readers = ReaderPool(self.dbpath, profile=profile,
+                                  cached_statements=SQL_CACHED_STATEMENTS)
+        self.writer = Writer(self.cursor, self.flush_changes, name=f'sqlite-writer-{accountid}')
 
-    def delete(self):
+    def close(self):
+        self.writer.close()
+        self.readers.close()
         self.dbh.close()
-        os.unlink(self.dbpath)
-    
-    def begin(self):
-        if not self.dbh.in_transaction:
-            self.cursor.execute("BEGIN DEFERRED")
-            self.in_transaction = True
-        else:
-            print('Already in transaction')
-    
-    def commit(self):
-        if not self.dbh.in_transaction:
-            print('Not in transaction')
-            return
 
-        for jmailboxid, val in self.updated_mailbox_counts.items():
-            update = {}
-            self.cursor.execute("""SELECT
-                    COUNT(DISTINCT msgid)
-                FROM jmessages JOIN jmessagemap USING (msgid)
-                WHERE jmailboxid = ?
-                  AND jmessages.deleted = 0
-                  AND jmessagemap.deleted = 0
-                """, [jmailboxid])
-            update['totalEmails'] = self.cursor.fetchone()[0]
+    def delete(self):
+        self.close()
+        os.unlink(self.dbpath)
 
-            self.cursor.execute("""SELECT
-                    COUNT(DISTINCT msgid)
-                FROM jmessages JOIN jmessagemap USING (msgid)
-                WHERE jmailboxid = ?
-                  AND jmessages.isUnread = 1
-                  AND jmessages.deleted = 0
-                  AND jmessagemap.deleted = 0
-                """, [jmailboxid])
-            update['unreadEmails'] = self.cursor.fetchone()[0]
+    def write(self, func, *args, **kwargs):
+        "Run func in the writer, return its result once committed."
+        return self.writer.run(func, *args, **kwargs)
 
-            self.cursor.execute("""SELECT
-                COUNT(DISTINCT thrid)
-                FROM jmessages JOIN jmessagemap USING (msgid)
-                WHERE jmailboxid = ?
-                  AND jmessages.deleted = 0
-                  AND jmessagemap.deleted = 0
-                  AND thrid IN
-                        (SELECT thrid
-                        FROM jmessages JOIN jmessagemap USING (msgid)
-                        WHERE isUnread = 1
-                            AND jmessages.deleted = 0
-                            AND jmessagemap.deleted = 0)
-                """ , [jmailboxid])
-            update['totalThreads'] = self.cursor.fetchone()[0]
+    @contextmanager
+    def reading(self):
+        """
+        Cursor for reads. In the writer it's the write transaction,
+        elsewhere a snapshot of the last commit from the reader pool.
+        """
+        if self.writer.in_writer():
+            yield self.cursor
+        else:
+            with self.readers.cursor() as cursor:
+                yield cursor
 
-            self.dmaybedirty('jmailboxes', update, {'jmailboxid': jmailboxid})
-        self.updated_mailbox_counts = {}
+    def flush_changes(self):
+        "Update mailbox counts and states, the writer calls it before COMMIT."
+        if self.updated_threads:
+            self.flush_mailbox_counts(self.updated_threads)
+        self.updated_threads = set()
 
-        if self.modseq and self.change_cb:
+        if self.modseq:
             map = {}
             dbdata = {'highModSeq': self.modseq}
             state = self.modseq
             for table in self.tables.keys():
                 for group in TABLE2GROUPS[table]:
                     map[group] = state
-                    dbdata['jstate' + group] = state
+                    dbdata[STATE_COLUMNS.get(group, 'jstate' + group)] = state
             self.dupdate('account', dbdata)
-            if not self.backfilling:
+            self.cursor.execute("INSERT OR REPLACE INTO jmodseqs (modseq, mtime) VALUES (?, ?)",
+                                [state, datetime.now().isoformat()])
+            if self.change_cb and not self.backfilling:
                 self.change_cb(self, map, state)
-        self.cursor.execute('COMMIT')
+            # next transaction gets next modseq
+            self.modseq = 0
+            self.tables = {}
+        if storage.SQLITE_OPTIMIZE_INTERVAL and \
+                time.monotonic() - self.optimized >= storage.SQLITE_OPTIMIZE_INTERVAL:
+            self.optimize()
+
+    def compact(self, retention_days=COMPACT_RETENTION_DAYS, batch=COMPACT_BATCH,
+                vacuum_pages=COMPACT_VACUUM_PAGES):
+        """
+        Purge tombstones and change log older than retention_days.
+
+        lowModSeq is advanced first, so clients with older states get
+        cannotCalculateChanges instead of changes with holes. Rows are
+        deleted in batches, each one a writer job of its own. Then up to
+        vacuum_pages free pages are returned to the filesystem, when the
+        database has auto_vacuum=INCREMENTAL. That's the default of new
+        databases, older ones need an offline
+        PRAGMA auto_vacuum=INCREMENTAL; VACUUM; once.
+        Return dict of what was done.
+        """
+        res = {'lowModSeq': None, 'purged': {}, 'vacuumed': 0}
+        cutoff = (datetime.now() - timedelta(days=retention_days)).isoformat()
+        with self.reading() as cursor:
+            modseq = cursor.execute("SELECT MAX(modseq) FROM jmodseqs WHERE mtime < ?",
+                                    [cutoff]).fetchone()[0]
+        if modseq:
+            res['lowModSeq'] = self.write(self._advance_low_modseq, modseq)
+            for table in TOMBSTONE_TABLES:
+                res['purged'][table] = self._purge(
+                    table, 'deleted != 0 AND jmodseq <= ?', [modseq], batch)
+            res['purged']['jchanges'] = self._purge('jchanges', 'modseq <= ?', [modseq], batch)
+            res['purged']['jmodseqs'] = self._purge('jmodseqs', 'modseq < ?', [modseq], batch)
+        res['purged']['jfiles'] = self._purge(
+            'jfiles', 'deleted != 0 OR expires < ?', [datetime.now().isoformat()], batch)
+
+        with self.reading() as cursor:
+            incremental = cursor.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        while incremental and res['vacuumed'] < vacuum_pages:
+            step = min(COMPACT_VACUUM_STEP, vacuum_pages - res['vacuumed'])
+            pages = self.write(self._vacuum_step, step)
+            if not pages:
+                break
+            res['vacuumed'] += pages
+        return res
+
+    def _advance_low_modseq(self, modseq):
+        self.cursor.execute("UPDATE account SET lowModSeq=? WHERE lowModSeq < ?", [modseq, modseq])
+        return self.cursor.execute("SELECT lowModSeq FROM account").fetchone()[0]
+
+    def _purge(self, table, where, params, batch) -> int:
+        "Delete rows of table matching where, batch rows per writer job."
+        sql = f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} WHERE {where} LIMIT {int(batch)})"
+        total = 0
+        while True:
+            deleted = self.write(lambda: self.cursor.execute(sql, params).rowcount)
+            total += deleted
+            if deleted < batch:
+                return total
+
+    def _vacuum_step(self, pages) -> int:
+        "Free up to pages pages, return how many were freed."
+        # the pragma frees one page per step and sqlite3 steps it only
+        # once, executescript() would complete it but commits first
+        before = free = self.cursor.execute("PRAGMA freelist_count").fetchone()[0]
+        for _ in range(min(free, pages)):
+            self.cursor.execute("PRAGMA incremental_vacuum(1)")
+        if free:
+            free = self.cursor.execute("PRAGMA freelist_count").fetchone()[0]
+        return before - free
+
+    def optimize(self):
+        "Let SQLite refresh statistics of tables whose queries need them."
+        self.cursor.execute('PRAGMA optimize')
+        self.optimized = time.monotonic()
     
     def rollback(self):
-        if not self.dbh.in_transaction:
-            print('Not in transaction')
-            return
-        self.cursor.execute('ROLLBACK')
-    
+        "Undo changes of the current writer job, jobs are atomic otherwise."
+        if self.writer.in_writer():
+            self.cursor.execute('ROLLBACK TO job')
+
     # handy for error cases
-    def reset(self):
-        if not self.dbh.in_transaction:
-            print('Not in transaction')
+    reset = rollback
+
+    def get_states(self):
+        "Current state of each data type, as returned by its /get method."
+        with self.reading() as cursor:
+            row = cursor.execute("SELECT highModSeqMailbox, highModSeqThread, highModSeqEmail"
+                                 " FROM account LIMIT 1").fetchone()
+        if not row:
+            return {'Mailbox': '1', 'Thread': '1', 'Email': '1'}
+        return {'Mailbox': str(row[0]), 'Thread': str(row[1]), 'Email': str(row[2])}
+
+    @property
+    def highModSeqMailbox(self):
+        return self.get_states()['Mailbox']
+
+    @property
+    def highModSeqThread(self):
+        return self.get_states()['Thread']
+
+    @property
+    def highModSeqEmail(self):
+        return self.get_states()['Email']
+
+    @property
+    def lowModSeq(self):
+        with self.reading() as cursor:
+            row = cursor.execute("SELECT lowModSeq FROM account LIMIT 1").fetchone()
+        return row[0] if row else 0
+
+    def get_changes(self, type, sinceState, maxChanges=None):
+        """
+        Changes of type since state from the jchanges log, as the
+        created, updated and destroyed ids of a /changes response.
+        With maxChanges, newState may be an intermediate state
+        'modseq:jchangeid' and hasMoreChanges is true.
+        """
+        if maxChanges is not None and (not isinstance(maxChanges, int) or maxChanges < 1):
+            raise errors.invalidArguments('maxChanges must be a positive integer')
+        try:
+            modseq, _, position = str(sinceState).partition(':')
+            since = int(modseq)
+            position = int(position or 0)
+        except ValueError:
+            raise errors.cannotCalculateChanges(f'Unknown state {sinceState}') from None
+
+        with self.reading() as cursor:
+            row = cursor.execute("SELECT lowModSeq, " + STATE_COLUMNS[type] +
+                                 " FROM account LIMIT 1").fetchone()
+            lowModSeq, newState = (row[0], str(row[1])) if row else (0, '1')
+            if since < lowModSeq:
+                raise errors.cannotCalculateChanges(f'State {sinceState} is too old')
+            # the single writer appends in modseq order, so an intermediate
+            # state continues after its row within the same modseq
+            rows = cursor.execute(
+                "SELECT jchangeid, modseq, id, change FROM jchanges"
+                " WHERE type=? AND modseq>=? AND jchangeid>?"
+                " ORDER BY modseq, jchangeid",
+                [type, since if position else since + 1, position])
+            # id -> [existed before, exists now, only counts changed]
+            changes = {}
+            hasMoreChanges = False
+            for jchangeid, modseq, id, change in rows:
+                if id not in changes:
+                    if maxChanges is not None and len(changes) == maxChanges:
+                        newState = f'{consumed[0]}:{consumed[1]}'
+                        hasMoreChanges = True
+                        break
+                    changes[id] = [change != 'created', change != 'destroyed', change == 'counts']
+                else:
+                    if change in ('created', 'destroyed'):
+                        changes[id][1] = change == 'created'
+                    changes[id][2] = changes[id][2] and change == 'counts'
+                consumed = (modseq, jchangeid)
+
+        created, updated, destroyed = [], [], []
+        only_counts = True
+        for id, (existed, exists, counts) in changes.items():
+            if not existed:
+                if exists:
+                    created.append(id)
+                # else never seen
+            elif not exists:
+                destroyed.append(id)
+            else:
+                updated.append(id)
+                only_counts = only_counts and counts
+        res = {
+            'oldState': sinceState,
+            'newState': newState,
+            'hasMoreChanges': hasMoreChanges,
+            'created': created,
+            'updated': updated,
+            'destroyed': destroyed,
+        }
+        if type == 'Mailbox':
+            res['updatedProperties'] = list(MAILBOX_COUNTS) if updated and only_counts else None
+        return res
+
+    @writes
+    def log_change(self, table, change, filter):
+        "Append change of the rows of table matching filter to jchanges."
+        try:
+            type, idcolumn = CHANGELOG[table]
+        except KeyError:
             return
-        self.cursor.execute('ROLLBACK')
+        id = filter.get(idcolumn, None)
+        if id is not None and not isinstance(id, (tuple, list)):
+            self.cursor.execute(query.insert('jchanges', ('modseq', 'type', 'change', 'id'), verb='INSERT'),
+                                [self.modseq, type, change, id])
+        else:
+            columns, operators, params = query.split_filter(filter)
+            self.cursor.execute(query.log_changes(table, idcolumn, columns, operators),
+                                [self.modseq, type, change] + params)
 
+    @writes
     def dirty(self, table):
         if not self.modseq:
             user = self.get_user()
@@ -137,6 +447,7 @@ class BaseDB:
         self.tables[table] = self.modseq
         return self.modseq
 
+    @writes
     def get_user(self):
         self.cursor.execute("SELECT * FROM account LIMIT 1")
         row = self.cursor.fetchone()
@@ -148,6 +459,7 @@ class BaseDB:
                 [self.accountid, self.accountid, 1])
             return self.get_user()
 
+    @writes
     def touch_thread_by_msgid(self, msgid):
         self.cursor.execute("SELECT thrid FROM jmessages WHERE msgid=?", [msgid])
         try:
@@ -159,28 +471,7 @@ class BaseDB:
         if not messages:
             self.dmaybedirty('jthreads', {'deleted': 1, 'data': '[]'}, {'thrid': thrid})
             return
-        
-        drafts = defaultdict(list)
-        msgs = []
-        seenmsgs = set()
-        for msg in messages:
-            if msg['isDraft'] and msg['inReplyTo']:
-                # push the rest of the drafts to the end
-                drafts[msg['inReplyTo']].append(msg['msgid'])
-
-        for msg in messages:
-            if msg['isDraft']: continue
-            msgs.append(msg['msgid'])
-            seenmsgs.add(msg['msgid'])
-            if msg['messageId']:
-                for draft in drafts.get(msg['messageId'], ()):
-                    msgs.append(draft)
-                    seenmsgs.add(draft)
-        # make sure unlinked drafts aren't forgotten!
-        for msg in messages:
-            if msg['msgid'] in seenmsgs: continue
-            msgs.append(msg['msgid'])
-            seenmsgs.add(msg['msgid'])
+        msgs = thread_order(messages)
         # have to handle doesn't exist case dammit, dmaybdirty isn't good for that
         self.cursor.execute("SELECT jcreated FROM jthreads WHERE thrid=?", [thrid])
         if self.cursor.fetchone():
@@ -189,45 +480,277 @@ class BaseDB:
                              {'thrid': thrid})
         else:
             self.dmake('jthreads', {'thrid': thrid, 'data': json.dumps(msgs)})
-    
+
+    @writes
+    def recompute_threads(self, thrids):
+        "touch_thread_by_msgid for many threads at once, with a few set based statements."
+        if not thrids:
+            return
+        self._temp_ids(thrids)
+        self.cursor.execute("""SELECT thrid,msgid,isDraft,inReplyTo,messageId
+            FROM jmessages
+            WHERE deleted=0 AND thrid IN (SELECT id FROM temp.bulk_ids)
+            ORDER BY thrid, rowid""")
+        threads = {thrid: thread_order(list(messages))
+                   for thrid, messages in groupby(self.cursor.fetchall(), itemgetter('thrid'))}
+        self.cursor.execute("SELECT thrid, deleted FROM jthreads WHERE thrid IN (SELECT id FROM temp.bulk_ids)")
+        existing = dict(self.cursor.fetchall())
+
+        modseq = self.dirty('jthreads')
+        now = datetime.now().isoformat()
+        self.cursor.executemany(
+            "UPDATE jthreads SET data=?, deleted=?, jmodseq=?, mtime=? WHERE thrid=?",
+            [(json.dumps(threads[thrid]) if thrid in threads else '[]',
+              0 if thrid in threads else 1, modseq, now, thrid)
+             for thrid in existing])
+        self.cursor.executemany(
+            query.insert('jthreads', ('thrid', 'data', 'jcreated', 'jmodseq', 'deleted', 'mtime')),
+            [(thrid, json.dumps(msgs), modseq, modseq, 0, now)
+             for thrid, msgs in threads.items() if thrid not in existing])
+        self.cursor.executemany(
+            query.insert('jchanges', ('modseq', 'type', 'change', 'id'), verb='INSERT'),
+            [(modseq, 'Thread',
+              'destroyed' if thrid not in threads else
+              'created' if existing.get(thrid, 1) else 'updated', thrid)
+             for thrid in thrids])
+
+    def _temp_ids(self, ids):
+        "Fill temp.bulk_ids, for statements using IN (SELECT id FROM temp.bulk_ids)."
+        self.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS bulk_ids (id TEXT PRIMARY KEY)")
+        self.cursor.execute("DELETE FROM temp.bulk_ids")
+        self.cursor.executemany("INSERT OR IGNORE INTO temp.bulk_ids VALUES (?)", [(id,) for id in ids])
+
+    def mailbox_counts(self, jmailboxids):
+        "Return {jmailboxid: counts} of given mailboxes, computed in one pass."
+        jmailboxids = list(jmailboxids)
+        counts = {id: {'totalEmails': 0, 'unreadEmails': 0, 'totalThreads': 0, 'unreadThreads': 0}
+                  for id in jmailboxids}
+        with self.reading() as cursor:
+            rows = cursor.execute("""SELECT jmailboxid,
+                    COUNT(DISTINCT msgid),
+                    COUNT(DISTINCT CASE WHEN jmessages.isUnread = 1 THEN msgid END),
+                    COUNT(DISTINCT thrid),
+                    COUNT(DISTINCT CASE WHEN thrid IN
+                        (SELECT thrid
+                        FROM jmessages JOIN jmessagemap USING (msgid)
+                        WHERE isUnread = 1
+                            AND jmessages.deleted = 0
+                            AND jmessagemap.deleted = 0) THEN thrid END)
+                FROM jmessages JOIN jmessagemap USING (msgid)
+                WHERE jmessages.deleted = 0
+                  AND jmessagemap.deleted = 0
+                  AND jmailboxid IN (""" + ('?,' * len(jmailboxids))[:-1] + """)
+                GROUP BY jmailboxid""", jmailboxids).fetchall()
+        for id, total, unread, threads, unreadThreads in rows:
+            counts[id] = {
+                'totalEmails': total,
+                'unreadEmails': unread,
+                'totalThreads': threads,
+                'unreadThreads': unreadThreads,
+            }
+        return counts
+
+    def _thread_counts(self, thrids):
+        """
+        Return {(jmailboxid, thrid): (emails, unread)} of given threads
+        in all mailboxes, counted from messages.
+        """
+        self._temp_ids(thrids)
+        self.cursor.execute("""SELECT jmailboxid, thrid, COUNT(*), SUM(isUnread = 1)
+            FROM jmessages JOIN jmessagemap USING (msgid)
+            WHERE jmessages.deleted = 0
+              AND jmessagemap.deleted = 0
+              AND thrid IN (SELECT id FROM temp.bulk_ids)
+            GROUP BY jmailboxid, thrid""")
+        return {(jmailboxid, thrid): (emails, unread)
+                for jmailboxid, thrid, emails, unread in self.cursor.fetchall()}
+
+    @writes
+    def flush_mailbox_counts(self, thrids):
+        """
+        Apply changes of given threads to mailbox counts. Only messages
+        of these threads are counted, and compared with their counts
+        kept in jmailboxthreads, so a change costs the size of its
+        threads instead of the size of its mailboxes.
+        """
+        new = self._thread_counts(thrids)
+        self.cursor.execute("""SELECT jmailboxid, thrid, emails, unread FROM jmailboxthreads
+            WHERE thrid IN (SELECT id FROM temp.bulk_ids)""")
+        old = {(jmailboxid, thrid): (emails, unread)
+               for jmailboxid, thrid, emails, unread in self.cursor.fetchall()}
+        if old == new:
+            return
+        self.cursor.execute("DELETE FROM jmailboxthreads WHERE thrid IN (SELECT id FROM temp.bulk_ids)")
+        self.cursor.executemany(
+            query.insert('jmailboxthreads', ('jmailboxid', 'thrid', 'emails', 'unread'), verb='INSERT'),
+            [key + value for key, value in new.items()])
+        deltas = count_deltas(old, new)
+        if not deltas:
+            return
+        self.cursor.execute(f"SELECT jmailboxid,{','.join(MAILBOX_COUNTS)} FROM jmailboxes"
+                            " WHERE jmailboxid IN (" + ('?,' * len(deltas))[:-1] + ")", list(deltas))
+        for row in self.cursor.fetchall():
+            delta = deltas[row['jmailboxid']]
+            self.dmaybedirty('jmailboxes', {
+                name: (row[name] or 0) + delta[i] for i, name in enumerate(MAILBOX_COUNTS)
+            }, {'jmailboxid': row['jmailboxid']})
+
+    def verify_mailbox_counts(self) -> dict:
+        """
+        Count every mailbox from its messages, repair counts and
+        jmailboxthreads where they drifted. Each mailbox is one writer
+        job. Return {jmailboxid: (stored counts, counted ones)} of
+        repaired mailboxes.
+        """
+        repaired = {}
+        for jmailboxid in self.dgetcol('jmailboxes', {'deleted': 0}, 'jmailboxid'):
+            res = self.write(self._verify_mailbox, jmailboxid)
+            if res:
+                repaired[jmailboxid] = res
+        return repaired
+
+    def _verify_mailbox(self, jmailboxid):
+        self.cursor.execute("""SELECT thrid, COUNT(*), SUM(isUnread = 1)
+            FROM jmessages JOIN jmessagemap USING (msgid)
+            WHERE jmessages.deleted = 0
+              AND jmessagemap.deleted = 0
+              AND jmailboxid = ?
+            GROUP BY thrid""", [jmailboxid])
+        threads = {thrid: (emails, unread) for thrid, emails, unread in self.cursor.fetchall()}
+        self.cursor.execute("SELECT thrid, emails, unread FROM jmailboxthreads WHERE jmailboxid = ?",
+                            [jmailboxid])
+        if threads != {thrid: (emails, unread) for thrid, emails, unread in self.cursor.fetchall()}:
+            self.cursor.execute("DELETE FROM jmailboxthreads WHERE jmailboxid = ?", [jmailboxid])
+            self.cursor.executemany(
+                query.insert('jmailboxthreads', ('jmailboxid', 'thrid', 'emails', 'unread'), verb='INSERT'),
+                [(jmailboxid, thrid, *value) for thrid, value in threads.items()])
+
+        counts = self.mailbox_counts([jmailboxid])[jmailboxid]
+        row = self.dgetone('jmailboxes', {'jmailboxid': jmailboxid}, ','.join(MAILBOX_COUNTS))
+        stored = {name: row[name] for name in MAILBOX_COUNTS}
+        if stored != counts:
+            self.dmaybedirty('jmailboxes', counts, {'jmailboxid': jmailboxid})
+            return stored, counts
+
+    @contextmanager
+    def bulk(self, chunk_size=BULK_CHUNK_SIZE):
+        """
+        Bulk ingestion for backfill. Inside the block add_message() only
+        buffers rows, they are inserted with executemany in one writer
+        job every chunk_size messages. Threads and mailbox counts of all
+        added messages are recomputed once, when the block ends. If it
+        fails, buffered rows are dropped, running the backfill again
+        repairs threads and counts of the committed chunks.
+
+        A backend that mirrors a mail store wraps its first sync in this
+        block. ImapDB has none yet: it serves messages from IMAP as they
+        are asked for and doesn't fill jmessages.
+        """
+        self.backfilling = True
+        self.bulk_chunk_size = chunk_size
+        self.bulk_rows = defaultdict(list)
+        self.bulk_count = 0
+        self.bulk_threads = set()
+        try:
+            yield self
+            self.write(self._finish_bulk)
+        finally:
+            self.backfilling = False
+            self.bulk_rows = None
+
+    def _finish_bulk(self):
+        self.flush_bulk()
+        self.recompute_threads(self.bulk_threads)
+        self.updated_threads.update(self.bulk_threads)
+
+    @writes
+    def flush_bulk(self):
+        """
+        Insert buffered rows, one executemany per table and column set.
+        Rows get the modseq of the transaction they are committed in.
+        """
+        for (table, columns), rows in self.bulk_rows.items():
+            modseq = self.dirty(table)
+            self.cursor.executemany(query.insert(table, columns + ('jcreated', 'jmodseq')),
+                                    [row + [modseq, modseq] for row in rows])
+            if table in CHANGELOG:
+                type, idcolumn = CHANGELOG[table]
+                i = columns.index(idcolumn)
+                self.cursor.executemany(
+                    query.insert('jchanges', ('modseq', 'type', 'change', 'id'), verb='INSERT'),
+                    [(modseq, type, 'created', row[i]) for row in rows])
+        self.bulk_rows.clear()
+
+    def _bulk_add_message(self, data, mailboxes):
+        now = datetime.now().isoformat()
+        row = {
+            **data,
+            'keywords': json.dumps(data['keywords']),
+            'deleted': 0,
+            'mtime': now,
+        }
+        self.bulk_rows['jmessages', tuple(row)].append(list(row.values()))
+        maprows = self.bulk_rows['jmessagemap', ('msgid', 'jmailboxid', 'deleted', 'mtime')]
+        for jmailboxid in mailboxes:
+            maprows.append([data['msgid'], jmailboxid, 0, now])
+        self.bulk_threads.add(data['thrid'])
+        self.bulk_count += 1
+        if self.bulk_count % self.bulk_chunk_size == 0:
+            self.flush_bulk()
+
     def add_message(self, data, mailboxes):
-        if mailboxes:
-            self.dmake('jmessages', {
-                **data,
-                'keywords': json.dumps(data['keywords']),
-                })
-            for mailbox in mailboxes:
-                self.add_message_to_mailbox(data['msgid'], mailbox)
-            self.touch_thread_by_msgid(data['msgid'])
-
-    def update_mailbox_counts(self, jmailboxid, jmodseq):
-        self.updated_mailbox_counts[jmailboxid] = jmodseq
+        if mailboxes and self.backfilling:
+            self._bulk_add_message(data, mailboxes)
+        elif mailboxes:
+            self.write(self._add_message, data, mailboxes)
+
+    def _add_message(self, data, mailboxes):
+        self.dmake('jmessages', {
+            **data,
+            'keywords': json.dumps(data['keywords']),
+            })
+        for mailbox in mailboxes:
+            self.add_message_to_mailbox(data['msgid'], mailbox)
+        self.touch_thread_by_msgid(data['msgid'])
+
+    @writes
+    def update_mailbox_counts(self, msgid):
+        "Count the thread of msgid again in its mailboxes before commit."
+        self.cursor.execute("SELECT thrid FROM jmessages WHERE msgid=?", [msgid])
+        row = self.cursor.fetchone()
+        if row:
+            self.updated_threads.add(row[0])
     
+    @writes
     def add_message_to_mailbox(self, msgid, jmailboxid):
         data = {
             'msgid': msgid,
             'jmailboxid': jmailboxid,
         }
         self.dmake('jmessagemap', data)
-        self.update_mailbox_counts(jmailboxid, data['jmodseq'])
+        self.update_mailbox_counts(msgid)
         self.ddirty('jmessages', {}, {'msgid': msgid})
     
+    @writes
     def delete_message_from_mailbox(self, msgid, jmailboxid):
         data = {'deleted': datetime.now().timestamp()}
         self.dmaybedirty('jmessagemap', data, {
             'msgid': msgid,
             'jmailboxid': jmailboxid,
         })
-        self.update_mailbox_counts(jmailboxid, data['jmodseq'])
+        self.update_mailbox_counts(msgid)
         self.ddirty('jmessages', {}, {'msgid': msgid})
     
+    @writes
     def change_message(self, msgid, data, newids):
         keywords = data.get('keywords', {})
-        bump = self.dmaybedirty('jmessages', {
+        self.dmaybedirty('jmessages', {
             'keywords': json.dumps(keywords),
             'isDraft': bool(keywords.get('draft', False)),
             'isUnread': not bool(keywords.get('seen', False)),
         }, {'msgid': msgid})
+        # unread may have changed in the mailboxes it stays in
+        self.update_mailbox_counts(msgid)
 
         oldids = self.dgetcol('jmessagemap', {
             'msgid': msgid,
@@ -238,9 +761,6 @@ class BaseDB:
         for jmailboxid in newids:
             if jmailboxid in old:
                 old.remove(jmailboxid)
-                # just bump the modseq
-                if bump:
-                    self.update_mailbox_counts(jmailboxid, data['jmodseq'])
             else:
                 self.add_message_to_mailbox(msgid, jmailboxid)
         for jmailboxid in old:
@@ -258,14 +778,30 @@ class BaseDB:
             part = match.group(3)
             return self.get_raw_message(id, part)
 
+    def open_blob(self, blobId):
+        """
+        Return (type, size, open) of blob, where open() returns file-like
+        object, so that large blobs can be read in chunks.
+        """
+        match = re.match(r'^f-(\d+)$', blobId)
+        if match:
+            row = self.dgetone('jfiles', {'jfileid': match.group(1)}, 'type,size')
+            if not row:
+                raise errors.notFound(f'Blob {blobId} not found')
+            return row['type'], row['size'], \
+                lambda: self.readers.blobopen('jfiles', 'content', int(match.group(1)))
+        res = self.get_blob(blobId)
+        if not res:
+            raise errors.notFound(f'Blob {blobId} not found')
+        typ, content = res
+        return typ, len(content), lambda: io.BytesIO(content)
+
     # NOTE: this can ONLY be used to create draft messages
     def create_messages(self, args, idmap):
         if not args:
             return {}, {}
-        self.begin()
         # XXX - get draft mailbox ID
         draftid = self.dgetfield('jmailboxes', {'role': 'drafts'}, 'jmailboxid')
-        self.commit()
 
         todo = {}
         for cid, item in args.items():
@@ -273,7 +809,7 @@ class BaseDB:
             keywords = item.pop('keywords', ())
             item['date'] = datetime.now().isoformat()
             item['headers']['Message-ID'] += '<' + str(uuid.uuid4()) + '.' + item['date'] + os.getenv('jmaphost')
-            message = parse.make(item, self.get_blob())
+            message = compose.make(item, self.open_blob)
             todo[cid] = (message, mailboxIds, keywords)
         
         created = {}
@@ -296,6 +832,7 @@ class BaseDB:
     def destroy_messages(self):
         return NotImplementedError()
     
+    @writes
     def delete_message(self, msgid):
         self.dmaybedirty('jmessages', {'deleted': datetime.now().timestamp()}, {'msgid': msgid})
         oldids = self.dgetcol('jmessagemap', {'msgid': msgid, 'deleted': 0}, 'jmailboxid')
@@ -307,11 +844,12 @@ class BaseDB:
         # TODO: actually report the messages (or at least check that they exist)
         return msgids, ()
 
+    @writes
     def put_file(self, accountid, type, content, expires):
         size = len(content)
         c = self.cursor.execute('INSERT OR REPLACE INTO jfiles (type, size, content, expires) VALUES (?, ?, ?, ?)',
             (type, size, content, expires))
-        id = c.last_insert_id()
+        id = c.lastrowid
         jmaphost = os.getenv('jmaphost')
 
         return {
@@ -327,19 +865,35 @@ class BaseDB:
         if data:
             return data['type'], data['content']
 
+    def get_previews(self, blobIds):
+        "Return stored previews as dict blobId -> preview."
+        blobIds = list(blobIds)
+        if not blobIds:
+            return {}
+        sql = 'SELECT blobId, preview FROM jpreviews WHERE blobId IN (' \
+            + ('?,' * len(blobIds))[:-1] + ')'
+        with self.reading() as cursor:
+            return {blobId: preview for blobId, preview in cursor.execute(sql, blobIds)}
+
+    @writes
+    def put_previews(self, previews):
+        "Store previews, dict blobId -> preview. Blobs are immutable, so is preview."
+        if not previews:
+            return
+        self.cursor.executemany('INSERT OR IGNORE INTO jpreviews (blobId, preview) VALUES (?, ?)',
+            previews.items())
+
     def _dbl(self, *args):
         return '(' + ', '.join(args) + ')'
     
+    @writes
     def dinsert(self, table, values):
         values['mtime'] = datetime.now().isoformat()
-        sql = f"INSERT OR REPLACE INTO {table} (`" \
-            + '`,`'.join(values.keys()) \
-            + "`) VALUES (" \
-            + ('?,' * len(values))[:-1] + ")"
-        print(sql, values.values())
+        sql = query.insert(table, tuple(values))
         cursor = self.cursor.execute(sql, list(values.values()))
         return cursor.lastrowid
     
+    @writes
     def dmake(self, table, values, modseqfields=()):
         modseq = self.dirty(table)
         values['jcreated'] = modseq
@@ -347,116 +901,91 @@ class BaseDB:
         for field in modseqfields:
             values[field] = modseq
         values['deleted'] = 0
-        return self.dinsert(table, values)
+        rowid = self.dinsert(table, values)
+        if table in CHANGELOG:
+            idcolumn = CHANGELOG[table][1]
+            self.log_change(table, 'created',
+                            {idcolumn: values[idcolumn]} if idcolumn in values else {'rowid': rowid})
+        return rowid
 
+    @writes
     def dupdate(self, table, values, filter={}):
         values['mtime'] = datetime.now().isoformat()
-        sql = f'UPDATE {table} SET ' \
-            + ', '.join([k + '=?' for k in values.keys()])
-        if filter:
-            sql += ' WHERE ' + ' AND '.join([k + '=?' for k in filter.keys()])
-        self.cursor.execute(sql, list(values.values()) + list(filter.values()))
+        columns, operators, params = query.split_filter(filter)
+        sql = query.update(table, tuple(values), columns, operators)
+        self.cursor.execute(sql, list(values.values()) + params)
     
     def filter_values(self, table, values, filter={}):
-        sql = 'SELECT ' + ','.join(values.keys()) + ' FROM ' + table
-        if filter:
-            sql += ' WHERE ' + ' AND '.join([k + '=?' for k in filter.keys()])
-        for row in self.cursor.execute(sql, list(filter.values())):
-            data = row
-        else:
-            data = {}
-        for key in values.keys():
-            if filter.get(key, None) or (data.get(key, None) == values[key]):
-                del values[key]
-        return values
+        "Return those values which differ from the stored row."
+        columns, operators, params = query.split_filter(filter)
+        sql = query.select(table, ','.join(values), columns, operators, limit=1)
+        with self.reading() as cursor:
+            row = cursor.execute(sql, params).fetchone()
+        data = dict(row) if row else {}
+        return {
+            key: val for key, val in values.items()
+            if not filter.get(key, None) and data.get(key, None) != val
+        }
 
+    @writes
     def dmaybeupdate(self, table, values, filter={}):
         filtered = self.filter_values(table, values, filter)
         if filtered:
             return self.dupdate(table, filtered, filter)
     
+    @writes
     def ddirty(self, table, values, filter={}):
+        change = change_kind(table, values)
         values['jmodseq'] = self.dirty(table)
-        return self.dupdate(table, values, filter)
+        self.dupdate(table, values, filter)
+        self.log_change(table, change, filter)
 
+    @writes
     def dmaybedirty(self, table, values=None, filter={}, modseqfields=()):
         filtered = self.filter_values(table, values, filter)
         if not filtered:
             return
+        change = change_kind(table, filtered)
         modseq = self.dirty(table)
         for field in ('jmodseq', *modseqfields):
             filtered[field] = values[field] = modseq
-        return self.dupdate(table, filtered, filter)
+        self.dupdate(table, filtered, filter)
+        self.log_change(table, change, filter)
 
+    @writes
     def dnuke(self, table, filter={}):
         modseq = self.dirty(table)
-        sql = f'UPDATE {table} SET deleted=1, jmodseq=? WHERE deleted=0'
-        if filter:
-            sql += ' AND ' + ' AND '.join([k + '=?' for k in filter.keys()])
-        return self.cursor.execute(sql, [modseq] + filter.values())
+        self.log_change(table, 'destroyed', {**filter, 'deleted': 0})
+        columns, operators, params = query.split_filter(filter)
+        return self.cursor.execute(query.nuke(table, columns, operators), [modseq] + params)
     
+    @writes
     def ddelete(self, table, filter={}):
-        sql = f'DELETE FROM {table}'
-        if filter:
-            sql += ' WHERE ' + ' AND '.join([k + '=?' for k in filter.keys()])
-        return self.cursor.execute(sql, list(filter.values()))
+        columns, operators, params = query.split_filter(filter)
+        return self.cursor.execute(query.delete(table, columns, operators), params)
 
     def dget(self, table, filter={}, fields='*'):
-        sql = f'SELECT {fields} FROM {table}'
-        conditions = []
-        values = []
-        for key, val in filter.items():
-            if type(val) in (tuple, list):
-                conditions.append(f'{key} {val[0]} ?')
-                values.append(val[1])
-            else:
-                conditions.append(key + '=?')
-                values.append(val)
-        if conditions:
-            sql += ' WHERE ' + ' AND '.join(conditions)
-        self.cursor.execute(sql, values)
-        return self.cursor.fetchall()
+        columns, operators, params = query.split_filter(filter)
+        with self.reading() as cursor:
+            return cursor.execute(query.select(table, fields, columns, operators), params).fetchall()
 
     def dcount(self, table, filter={}):
-        sql = f'SELECT COUNT(*) FROM {table}'
-        conditions = []
-        values = []
-        for key, val in filter:
-            if type(val) in (tuple, list):
-                conditions.append(f'{key} {val[0]} ?')
-                values.append(val[1])
-            else:
-                conditions.append(key + '=?')
-                values.append(val)
-        if conditions:
-            sql += ' WHERE ' + ' AND '.join(conditions)
-        self.cursor.execute(sql, values)
-        return self.cursor.fetchone()[0]
+        columns, operators, params = query.split_filter(filter)
+        with self.reading() as cursor:
+            return cursor.execute(query.select(table, 'COUNT(*)', columns, operators), params).fetchone()[0]
 
     def dgetby(self, table, hashkey, filter={}, fields='*'):
         data = self.dget(table, filter, fields)
         return {d[hashkey]: d for d in data}
 
     def dgetone(self, table, filter={}, fields='*'):
-        sql = f'SELECT {fields} FROM {table}'
-        conditions = []
-        values = []
-        for key, val in filter.items():
-            if type(val) in (tuple, list):
-                conditions.append(f'{key} {val[0]} ?')
-                values.append(val[1])
-            else:
-                conditions.append(key + '=?')
-                values.append(val)
-        if conditions:
-            sql += ' WHERE ' + ' AND '.join(conditions)
-        sql += ' LIMIT 1'
-        self.cursor.execute(sql, values)
-        return self.cursor.fetchone()
+        columns, operators, params = query.split_filter(filter)
+        with self.reading() as cursor:
+            return cursor.execute(query.select(table, fields, columns, operators, limit=1), params).fetchone()
 
     def dgetfield(self, table, filter, field):
         res = self.dgetone(table, filter, field)
-        return res.get(field, None) if res else res
+        return res[0] if res else None
     
     def dgetcol(self, table, filter={}, field=0):
         return [row[field] for row in self.dget(table, filter, field)]
@@ -570,6 +1099,12 @@ class BaseDB:
             mtime DATE
         );""")
 
+        self.dbh.execute("""
+        CREATE TABLE IF NOT EXISTS jpreviews (
+            blobId TEXT PRIMARY KEY,
+            preview TEXT
+        );""")
+
         self.dbh.execute("""
         CREATE TABLE IF NOT EXISTS jfiles (
             jfileid INTEGER PRIMARY KEY,
@@ -0,0 +1,85 @@
+"""
+Instrumented SQLite cursor.
+
+Every statement is timed and counted per table and operation in
+jmap.metrics, logged to the 'jmap.sql' logger at SQL_LOG_LEVEL, and
+recorded as a span when tracing is on. Statements slower than
+SQL_SLOW_MS are logged as warnings together with their query plan.
+"""
+from functools import lru_cache
+import logging
+import os
+import re
+import sqlite3
+from time import monotonic
+
+from jmap import metrics, tracing
+
+
+def log_level(name, default=logging.DEBUG) -> int:
+    "Level of name like 'INFO' or '10', default when it's neither."
+    if name.isdigit():
+        return int(name)
+    level = logging.getLevelName(name.upper())
+    return level if isinstance(level, int) else default
+
+
+SQL_LOG_LEVEL = log_level(os.getenv('SQL_LOG_LEVEL', 'DEBUG'))
+SQL_SLOW_MS = float(os.getenv('SQL_SLOW_MS', 100))
+
+logger = logging.getLogger('jmap.sql')
+
+TABLE_RE = {
+    'select': re.compile(r'\bFROM\s+`?(\w+)', re.I),
+    'insert': re.compile(r'\bINTO\s+`?(\w+)', re.I),
+    'replace': re.compile(r'\bINTO\s+`?(\w+)', re.I),
+    'update': re.compile(r'^\s*UPDATE\s+(?:OR\s+\w+\s+)?`?(\w+)', re.I),
+    'delete': re.compile(r'\bFROM\s+`?(\w+)', re.I),
+}
+
+
+@lru_cache(maxsize=1024)
+def classify(sql: str):
+    "Return (operation, table, statement on one line) of SQL statement."
+    statement = ' '.join(sql.split())
+    op = statement.split(' ', 1)[0].lower()
+    match = TABLE_RE[op].search(statement) if op in TABLE_RE else None
+    return op, match.group(1) if match else '', statement
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        return self._run(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._run(super().executemany, sql, seq_of_parameters, many=True)
+
+    def _run(self, execute, sql, parameters, many=False):
+        op, table, statement = classify(sql)
+        t0 = monotonic()
+        if tracing.exporter is None:
+            execute(sql, parameters)
+        else:
+            with tracing.span('sql', statement=statement[:500], table=table) as span:
+                execute(sql, parameters)
+                span.set_attribute('rows', self.rowcount)
+        elapsed = monotonic() - t0
+
+        metrics.inc('sql_statements_total', table=table, op=op)
+        metrics.observe('sql_statement_duration_seconds', elapsed, table=table, op=op)
+        if logger.isEnabledFor(SQL_LOG_LEVEL):
+            logger.log(SQL_LOG_LEVEL, '%.2fms %s', elapsed * 1000, statement)
+        if elapsed * 1000 >= SQL_SLOW_MS:
+            metrics.inc('sql_slow_statements_total', table=table, op=op)
+            logger.warning('Slow statement %.2fms: %s\n%s', elapsed * 1000, statement,
+                           self._plan(sql, None if many else parameters))
+        return self
+
+    def _plan(self, sql, parameters):
+        if parameters is None:
+            return '(executemany, no plan)'
+        try:
+            rows = self.connection.execute('EXPLAIN QUERY PLAN ' + sql, parameters).fetchall()
+        except sqlite3.Error as e:
+            return f'(no plan: {e})'
+        return '\n'.join(f'  {row[3]}' for row in rows) or '  (no plan)'
@@ -1,10 +1,13 @@
 from binascii import a2b_base64, b2a_base64
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-import email
-from email.policy import default
 import hashlib
+import multiprocessing
+import os
 import re
+from time import monotonic
 import uuid
 
 try:
@@ -13,12 +16,16 @@ except ImportError:
     import json
 from imapclient import IMAPClient
 from imapclient.exceptions import IMAPClientError
+from imapclient.imapclient import datetime_to_INTERNALDATE, seq_to_parenstr
 from imapclient.response_types import Envelope
+from imapclient.util import to_bytes, to_unicode
 
-from jmap import errors, parse
-from jmap.parse import asAddresses, asDate, asMessageIds, asText, bodystructure, htmltotext, parseStructure
+from jmap import errors, metrics, mime, parse, tracing
+from jmap.compose import ComposedMessage
+from jmap.parse import PREVIEW_LENGTH, asAddresses, asDate, asMessageIds, asText, bodystructure, bodyvalues, decode_header_form, make_preview, parseStructure, select_bodyvalues
 
 from .base import BaseDB
+from .writer import writes
 
 
 KNOWN_SPECIALS = set(b'\\HasChildren \\HasNoChildren \\NoSelect \\NoInferiors \\UnMarked'.lower().split())
@@ -65,6 +72,13 @@ KEYWORD2FLAG = {
 }
 FLAG2KEYWORD = {f.lower().encode(): kw for kw, f in KEYWORD2FLAG.items()}
 
+# octets of first text part fetched to generate preview locally,
+# html needs more as markup is not part of preview
+PREVIEW_FETCH_BYTES = {
+    'plain': 4 * PREVIEW_LENGTH,
+    'html': 64 * PREVIEW_LENGTH,
+}
+
 
 FIELDS_MAP = {
     'blobId': 'X-GUID',  # Dovecot
@@ -72,7 +86,7 @@ FIELDS_MAP = {
     'hasAttachment': 'FLAGS',
     'headers': 'RFC822.HEADER',
     'keywords': 'FLAGS',
-    'preview': 'PREVIEW',
+    'preview': 'X-GUID',  # previews are stored per blobId
     'receivedAt': 'INTERNALDATE',
     'size': 'RFC822.SIZE',
     'attachments': 'RFC822',
@@ -91,6 +105,30 @@ FIELDS_MAP = {
     'references': 'RFC822.HEADER',
 }
 
+# body properties computed by parse stage
+PARSE_PROPERTIES = {'bodyStructure', 'bodyValues', 'textBody', 'htmlBody', 'attachments'}
+# messages this large are parsed in a worker process
+PARSE_OFFLOAD_BYTES = int(os.getenv('PARSE_OFFLOAD_BYTES', 256 * 1024))
+PARSE_WORKERS = int(os.getenv('PARSE_WORKERS', 0)) or None
+
+_parse_pool = None
+
+def parse_pool():
+    global _parse_pool
+    if _parse_pool is None:
+        # spawn, workers don't need our IMAP sockets and sqlite handles
+        _parse_pool = ProcessPoolExecutor(PARSE_WORKERS,
+            mp_context=multiprocessing.get_context('spawn'))
+    return _parse_pool
+
+def shutdown_parse_pool():
+    "Stop worker processes, called when the server stops."
+    global _parse_pool
+    if _parse_pool is not None:
+        _parse_pool.shutdown(cancel_futures=True)
+        _parse_pool = None
+
+
 class ImapMessage(dict):
     header_re = re.compile(r'^([\w-]+)\s*:\s*(.+?)\r\n(?=[\w\r])', re.I | re.M | re.DOTALL)
 
@@ -102,8 +140,8 @@ class ImapMessage(dict):
         "Return raw value from last header instance, name needs to be lowercase."
         return self['LASTHEADERS'].get(name, None)
 
-    def EML(self):
-        return email.message_from_bytes(self['RFC822'], policy=default)
+    def MIME(self):
+        return mime.parse(self['RFC822'])
 
     def LASTHEADERS(self):
         # make headers dict with only last instance of each header
@@ -132,31 +170,34 @@ class ImapMessage(dict):
             for name, value in self.header_re.findall(self['DECODEDHEADERS'])]
 
     def inReplyTo(self):
-        return asMessageIds(self.get_header('in-reply-to'))
+        return decode_header_form(asMessageIds, self.get_header('in-reply-to'))
 
     def keywords(self):
         return {FLAG2KEYWORD.get(f.lower(), f.decode()): True for f in self.pop('FLAGS')}
 
     def messageId(self):
-        return asMessageIds(self.get_header('message-id'))
+        return decode_header_form(asMessageIds, self.get_header('message-id'))
 
     def mailboxIds(self):
         return [ parse_message_id(self['id'])[0] ]
 
     def preview(self):
-        return self.pop('PREVIEW')[1].decode()
+        preview = server_preview(self.pop('PREVIEW'))
+        if preview is None:
+            raise KeyError('preview')
+        return preview
 
     def receivedAt(self):
         return self.pop('INTERNALDATE')
 
     def references(self):
-        return asMessageIds(self.get_header('references'))
+        return decode_header_form(asMessageIds, self.get_header('references'))
 
     def replyTo(self):
-        return asAddresses(self.get_header('reply-to'))
+        return decode_header_form(asAddresses, self.get_header('reply-to'))
 
     def sentAt(self):
-        return asDate(self.get_header('date'))
+        return decode_header_form(asDate, self.get_header('date'))
 
     def size(self):
         try:
@@ -165,20 +206,24 @@ class ImapMessage(dict):
             return len(self['RFC822'])
 
     def subject(self):
-        return asText(self.get_header('subject')) or ''
+        return decode_header_form(asText, self.get_header('subject')) or ''
 
     def threadId(self):
         # TODO: threading
         return f"t{self['id']}"
 
     def bodyStructure(self):
-        self['bodyValues'], bodyStructure \
-            = bodystructure(self['id'], self['EML'])
-        return bodyStructure
+        return bodystructure(self['id'], self['MIME'])
 
     def bodyValues(self):
-        bodyValues, self['bodystructure'] \
-            = bodystructure(self['id'], self['EML'])
+        return bodyvalues(self['MIME'])
+
+    def get_body_values(self, fetchText=False, fetchHTML=False, fetchAll=False, limit=None):
+        "Decode only text parts requested by Email/get, up to limit octets each."
+        # parse stage may have done it already
+        bodyValues = self.get(('bodyValues', (fetchText, fetchHTML, fetchAll, limit)), None)
+        if bodyValues is None:
+            bodyValues = select_bodyvalues(self['MIME'], fetchText, fetchHTML, fetchAll, limit)
         return bodyValues
 
     def textBody(self):
@@ -197,12 +242,22 @@ class ImapMessage(dict):
         return attachments
 
 
+def server_preview(value):
+    "Decode RFC 8970 PREVIEW fetch item, None when server has none."
+    if isinstance(value, (tuple, list)):
+        # draft version returned (algorithm preview)
+        value = value[-1] if value else None
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    return value
+
+
 # Define address getters
 # "from" is reserved in python, it needs to be defined this way
 # others are similar
 def address_getter(field):
     def get(self):
-        return asAddresses(self.get_header(field)) or []
+        return decode_header_form(asAddresses, self.get_header(field)) or []
     return get
 for prop in ('from', 'to', 'cc', 'bcc', 'sender'):
     setattr(ImapMessage, prop, address_getter(prop))
@@ -228,26 +283,76 @@ def parse_message_id(messageid):
            int.from_bytes(b[16:20], 'big'), \
            int.from_bytes(b[20:24], 'big')
 
+class InstrumentedIMAPClient(IMAPClient):
+    "IMAPClient recording latency, received bytes and a span of every command."
+    def __init__(self, *args, **kwargs):
+        self._received = 0
+        # span attributes of the next command, set by wrappers below
+        self._attributes = {}
+        super().__init__(*args, **kwargs)
+        read, readline = self._imap.read, self._imap.readline
+        def counted_read(size):
+            data = read(size)
+            self._received += len(data)
+            return data
+        def counted_readline():
+            line = readline()
+            self._received += len(line)
+            return line
+        self._imap.read = counted_read
+        self._imap.readline = counted_readline
+
+    @contextmanager
+    def command(self, name: str):
+        attributes, self._attributes = self._attributes, {}
+        self._received = 0
+        t0 = monotonic()
+        with tracing.span('imap ' + name, command=name, **attributes) as span:
+            try:
+                yield
+            finally:
+                metrics.observe('imap_command_duration_seconds', monotonic() - t0, command=name)
+                metrics.inc('imap_received_bytes_total', self._received, command=name)
+                span.set_attribute('bytes', self._received)
+
+    def _raw_command(self, command, args, uid=True):
+        with self.command(to_unicode(command).upper()):
+            return super()._raw_command(command, args, uid)
+
+    def _command_and_check(self, command, *args, unpack=False, uid=False):
+        with self.command(to_unicode(command).upper()):
+            return super()._command_and_check(command, *args, unpack=unpack, uid=uid)
+
+    def select_folder(self, folder, readonly=False):
+        self._attributes = {'folder': folder}
+        return super().select_folder(folder, readonly)
+
+    def fetch(self, messages, data, modifiers=None):
+        self._attributes = {'uids': _uid_count(messages)}
+        return super().fetch(messages, data, modifiers)
+
+    def _store(self, cmd, messages, flags, fetch_key, silent):
+        self._attributes = {'uids': _uid_count(messages)}
+        return super()._store(cmd, messages, flags, fetch_key, silent)
+
+
+def _uid_count(messages):
+    if isinstance(messages, (list, tuple, set)):
+        return len(messages)
+    if isinstance(messages, int):
+        return 1
+    return str(messages)
+
+
 class ImapDB(BaseDB):
+    # messages are fetched from IMAP when asked for, not mirrored into
+    # jmessages, so there is no backfill to run in BaseDB.bulk() (yet)
     def __init__(self, username, password='h', host='localhost', port=143, *args, **kwargs):
         super().__init__(username, *args, **kwargs)
-        self.imap = IMAPClient(host, port, use_uid=True, ssl=False)
+        self.imap = InstrumentedIMAPClient(host, port, use_uid=True, ssl=False)
         res = self.imap.login(username, password)
-        self.cursor.execute("SELECT lowModSeq,highModSeq,highModSeqMailbox,highModSeqThread,highModSeqEmail FROM account LIMIT 1")
-        row = self.cursor.fetchone()
+        self.has_preview = self.imap.has_capability('PREVIEW')
         self.lastfoldersync = 0
-        if row:
-            self.lowModSeq,
-            self.highModSeq,
-            self.highModSeqMailbox,
-            self.highModSeqThread,
-            self.highModSeqEmail = row
-        else:
-            self.lowModSeq = 0
-            self.highModSeq = 1
-            self.highModSeqMailbox = 1
-            self.highModSeqThread = 1
-            self.highModSeqEmail = 1
 
         # (imapname, readonly)
         self.selected_folder = (None, False)
@@ -267,6 +372,8 @@ class ImapDB(BaseDB):
             if msg:
                 found = True
                 for prop in properties:
+                    if FIELDS_MAP.get(prop, None) == 'RFC822' and 'RFC822' in msg:
+                        continue  # parsed lazily from fetched message
                     try:
                         msg[prop]
                     except (KeyError, AttributeError):
@@ -281,7 +388,7 @@ class ImapDB(BaseDB):
         return messages, fetch_ids, fetch_props
 
 
-    def get_messages(self, properties=(), sort={}, inMailbox=None, inMailboxOtherThan=(), id__in=None, threadId__in=None, **criteria):
+    def get_messages(self, properties=(), sort={}, inMailbox=None, inMailboxOtherThan=(), id__in=None, threadId__in=None, bodyvalues_args=None, **criteria):
         # XXX: id == threadId for now
         if id__in is None and threadId__in is not None:
             id__in = [id[1:] for id in threadId__in]
@@ -292,6 +399,8 @@ class ImapDB(BaseDB):
             messages, id__in, properties = self.get_messages_cached(properties, id__in=id__in)
 
         fetch_fields = {f for prop, f in FIELDS_MAP.items() if prop in properties}
+        if 'preview' in properties and self.has_preview:
+            fetch_fields.add('PREVIEW')
         if 'RFC822' in fetch_fields:
             # remove redundand fields
             fetch_fields.discard('RFC822.HEADER')
@@ -332,47 +441,131 @@ class ImapDB(BaseDB):
 
         for mailbox in mailboxes:
             imapname = mailbox['imapname']
-            if self.selected_folder[0] != imapname:
-                self.imap.select_folder(imapname, readonly=True)
-                self.selected_folder = (imapname, True)
-
-            uids = mailbox_uids.get(mailbox['id'], None)
-            # uids are now None or not empty
-            # fetch all
-            if sort_criteria:
-                if uids:
-                    search = f'{",".join(map(str, uids))} {search_criteria}'
-                else:
-                    search = search_criteria or 'ALL'
-                uids = self.imap.sort(sort_criteria, search)
-            elif search_criteria:
-                if uids:
-                    search = f'{",".join(map(str, uids))} {search_criteria}'
-                uids = self.imap.search(search)
-            if uids is None:
-                uids = '1:*'
-            fetch_fields.add('UID')
-            fetches = self.imap.fetch(uids, fetch_fields)
-
-            for uid, data in fetches.items():
-                id = format_message_id(mailbox['id'], mailbox['uidvalidity'], uid)
-                msg = self.messages.get(id, None)
-                if not msg:
-                    msg = ImapMessage(id=id, mailboxIds=[mailbox['id']])
-                    self.messages[id] = msg
-                for k, v in data.items():
-                    msg[k.decode()] = v
-                messages.append(msg)
+            with tracing.span('get_messages folder', folder=imapname) as span:
+                if self.selected_folder[0] != imapname:
+                    self.imap.select_folder(imapname, readonly=True)
+                    self.selected_folder = (imapname, True)
+
+                uids = mailbox_uids.get(mailbox['id'], None)
+                # uids are now None or not empty
+                # fetch all
+                if sort_criteria:
+                    if uids:
+                        search = f'{",".join(map(str, uids))} {search_criteria}'
+                    else:
+                        search = search_criteria or 'ALL'
+                    uids = self.imap.sort(sort_criteria, search)
+                elif search_criteria:
+                    if uids:
+                        search = f'{",".join(map(str, uids))} {search_criteria}'
+                    uids = self.imap.search(search)
+                if uids is None:
+                    uids = '1:*'
+                fetch_fields.add('UID')
+                fetches = self.imap.fetch(uids, fetch_fields)
+                span.set_attribute('uids', len(fetches))
+
+                fetched = []
+                for uid, data in fetches.items():
+                    id = format_message_id(mailbox['id'], mailbox['uidvalidity'], uid)
+                    msg = self.messages.get(id, None)
+                    if not msg:
+                        msg = ImapMessage(id=id, mailboxIds=[mailbox['id']])
+                        self.messages[id] = msg
+                    for k, v in data.items():
+                        msg[k.decode()] = v
+                    fetched.append(msg)
+                if 'preview' in properties:
+                    self.fill_previews(fetched)
+                messages.extend(fetched)
+
+        if PARSE_PROPERTIES.intersection(properties):
+            self.parse_messages(messages, bodyvalues_args)
         return messages
+
+
+    def parse_messages(self, messages, bodyvalues_args=None):
+        """
+        Parse body properties of large messages in worker processes.
+        Results are stored in the cached messages, smaller messages
+        are left for lazy parsing on this thread.
+        """
+        pending = []
+        for msg in messages:
+            if 'bodyStructure' in msg or 'RFC822' not in msg:
+                continue
+            if len(msg['RFC822']) >= PARSE_OFFLOAD_BYTES:
+                # worker processes don't see our spans, time the job from here
+                span = tracing.span('parse_body offload', bytes=len(msg['RFC822']))
+                pending.append((msg, span, parse_pool().submit(
+                    parse.parse_body, msg['id'], msg['RFC822'], bodyvalues_args)))
+        for msg, span, future in pending:
+            try:
+                msg.update(future.result())
+            finally:
+                span.finish()
+
+
+    def fill_previews(self, messages):
+        """
+        Set preview of messages from selected folder.
+        Server PREVIEW is used when given, then previews stored per blobId,
+        otherwise preview is made from partial fetch of the first text part.
+        """
+        new = {}
+        todo = {}
+        for msg in messages:
+            if 'preview' in msg:
+                continue
+            preview = server_preview(msg.pop('PREVIEW', None))
+            if preview is not None:
+                msg['preview'] = new[msg['blobId']] = preview
+            elif 'RFC822' in msg:
+                bodyValues = bodyvalues(msg['MIME'], types=('text/plain', 'text/html'),
+                                        limit=PREVIEW_FETCH_BYTES['html'])
+                msg['preview'] = new[msg['blobId']] = parse.preview(bodyValues) or ''
+            else:
+                todo[msg['blobId']] = msg
+
+        for blobId, preview in self.get_previews(todo.keys()).items():
+            todo.pop(blobId)['preview'] = preview
+
+        if todo:
+            bymsg = {msg['UID']: msg for msg in todo.values()}
+            # messages with the same first text part need one FETCH
+            sections = defaultdict(list)
+            for uid, data in self.imap.fetch(list(bymsg), ['BODYSTRUCTURE']).items():
+                section = first_text_section(data[b'BODYSTRUCTURE'])
+                if section:
+                    sections[section].append(uid)
+                else:
+                    msg = bymsg[uid]
+                    msg['preview'] = new[msg['blobId']] = ''
+            for (number, subtype, charset, encoding), uids in sections.items():
+                size = PREVIEW_FETCH_BYTES[subtype]
+                fetches = self.imap.fetch(uids, [f'BODY.PEEK[{number}]<0.{size}>'])
+                for uid, data in fetches.items():
+                    body = next((v for k, v in data.items() if k.startswith(b'BODY[')), b'') or b''
+                    if len(body) >= size:
+                        # partial fetch, don't decode incomplete last line
+                        body = body[:body.rfind(b'\n') + 1] or body
+                    part = mime.parse(
+                        f'Content-Type: text/{subtype}; charset="{charset}"\r\n'
+                        f'Content-Transfer-Encoding: {encoding}\r\n\r\n'.encode() + body)
+                    msg = bymsg[uid]
+                    msg['preview'] = new[msg['blobId']] = make_preview(part.text()[0], part.type)
+
+        self.put_previews(new)
     
 
+    @writes
     def changed_record(self, ifolderid, uid, flags=(), labels=()):
         res = self.dmaybeupdate('imessages', {
             'flags': json.dumps(sorted(flags)),
             'labels': json.dumps(sorted(labels)),
         }, {'ifolderid': ifolderid, 'uid': uid})
         if res:
-            msgid = self.dgefield('imessages', {'ifolderid': ifolderid, 'uid': uid}, 'msgid')
+            msgid = self.dgetfield('imessages', {'ifolderid': ifolderid, 'uid': uid}, 'msgid')
             self.mark_sync(msgid)
     
     def import_message(self, rfc822, mailboxIds, keywords):
@@ -387,31 +580,64 @@ class ImapDB(BaseDB):
             if kw in KEYWORD2FLAG:
                 flags.remove(kw)
                 flags.add(KEYWORD2FLAG[kw])
-        appendres = self.imap.append('imapname', '(' + ' '.join(flags) + ')', datetime.now(), rfc822)
+        appendres = self.append_message(imapname, flags, datetime.now(), rfc822)
         # TODO: compare appendres[2] with uidvalidity
         uid = appendres[3]
-        fdata = jmailmap[mailboxIds[0]]
+        msgdata = self.write(self._sync_appended, jmailmap[mailboxIds[0]], uid)
+        # save us having to download it again - outside the sync job so we don't wait on the parse
+        if isinstance(rfc822, ComposedMessage):
+            hasAttachment = rfc822.has_attachment
+        else:
+            hasAttachment = bool(parse.parse(rfc822, msgdata['msgid'])['hasAttachment'])
+        self.dinsert('jrawmessage', {
+            'msgid': msgdata['msgid'],
+            'parsed': json.dumps('message'),
+            'hasAttachment': hasAttachment,
+        })
+        return msgdata
+
+    def _sync_appended(self, fdata, uid):
+        "Sync folder of appended message in one writer job, return its msgid,thrid,size."
         self.do_folder(fdata['ifolderid'], fdata['label'])
-        ifolderid = fdata['ifolderid']
         msgdata = self.dgetone('imessages', {
-            'ifolderid': ifolderid,
+            'ifolderid': fdata['ifolderid'],
             'uid': uid,
         }, 'msgid,thrid,size')
-        
         # XXX - did we fail to sync this back?  Annoying
         if not msgdata:
             raise Exception('Failed to get back stored message from imap server')
-        # save us having to download it again - drop out of transaction so we don't wait on the parse
-        message = parse.parse(rfc822, msgdata['msgid'])
-        self.begin()
-        self.dinsert('jrawmessage', {
-            'msgid': msgdata['msgid'],
-            'parsed': json.dumps('message'),
-            'hasAttachment': message['hasattachment'],
-        })
-        self.commit()
         return msgdata
     
+    def append_message(self, imapname, flags, msg_time, message):
+        """
+        APPEND message to the folder. ComposedMessage is sent as literal
+        chunk by chunk, so attachments are never all in memory.
+        """
+        if not isinstance(message, ComposedMessage):
+            return self.imap.append(imapname, message, flags, msg_time)
+        imap = self.imap._imap
+        tag = imap._new_tag()
+        command = b' '.join([
+            tag, b'APPEND',
+            to_bytes(self.imap._normalise_folder(imapname)),
+            to_bytes(seq_to_parenstr(flags)),
+            to_bytes('"%s"' % datetime_to_INTERNALDATE(msg_time)),
+            b'{%d}' % len(message),
+        ])
+        with self.imap.command('APPEND'):
+            imap.send(command + b'\r\n')
+            while imap._get_response():
+                if imap.tagged_commands[tag]:
+                    break  # NO/BAD instead of continuation
+            else:
+                for chunk in message:
+                    imap.send(chunk)
+                imap.send(b'\r\n')
+            typ, data = imap._command_complete('APPEND', tag)
+        if typ != 'OK':
+            raise IMAPClientError(f'APPEND failed: {data}')
+        return data[0]
+
     def update_messages(self, changes, idmap):
         if not changes:
             return {}, {}
@@ -421,8 +647,9 @@ class ImapDB(BaseDB):
         map = {}
         msgids = set(changes.keys())
         sql = 'SELECT msgid,ifolderid,uid FROM imessages WHERE msgid IN (' + (('?,' * len(msgids))[:-1]) + ')'
-        self.cursor.execute(sql, list(msgids))
-        for msgid, ifolderid, uid in self.cursor:
+        with self.reading() as cursor:
+            rows = cursor.execute(sql, list(msgids)).fetchall()
+        for msgid, ifolderid, uid in rows:
             if not msgid in map:
                 map[msgid] = {ifolderid: {uid}}
             elif not ifolderid in map[msgid]:
@@ -530,6 +757,7 @@ class ImapDB(BaseDB):
 
         return destroyed, notdestroyed
     
+    @writes
     def deleted_record(self, ifolderid, uid):
         msgid = self.dgetfield('imessages', {'ifolderid': ifolderid, 'uid': uid}, 'msgid')
         if msgid:
@@ -537,8 +765,8 @@ class ImapDB(BaseDB):
             self.mark_sync(msgid)
 
     def get_raw_message(self, msgid, part=None):
-        self.cursor.execute('SELECT imapname,uidvalidity,uid FROM ifolders JOIN imessages USING (ifolderid) WHERE msgid=?', [msgid])
-        imapname, uidvalidity, uid = self.cursor.fetchone()
+        with self.reading() as cursor:
+            imapname, uidvalidity, uid = cursor.execute('SELECT imapname,uidvalidity,uid FROM ifolders JOIN imessages USING (ifolderid) WHERE msgid=?', [msgid]).fetchone()
         if not imapname:
             return None
         typ = 'message/rfc822'
@@ -683,7 +911,16 @@ class ImapDB(BaseDB):
     def create_submission(self, new, idmap):
         if not new:
             return {}, {}
-        
+        createmap, notcreated, todo = self.write(self._make_submissions, new, idmap)
+
+        for cid, sub in todo.items():
+            type, rfc822 = self.get_raw_message(todo[cid])
+            self.imap.send_mail(rfc822, sub['envelope'])
+
+        return createmap, notcreated
+
+    def _make_submissions(self, new, idmap):
+        "Store submissions in one writer job, before any mail is sent."
         todo = {}
         createmap = {}
         notcreated = {}
@@ -704,13 +941,7 @@ class ImapDB(BaseDB):
             })
             createmap[cid] = {'id': id}
             todo[cid] = msgid
-        self.commit()
-
-        for cid, sub in todo.items():
-            type, rfc822 = self.get_raw_message(todo[cid])
-            self.imap.send_mail(rfc822, sub['envelope'])
-
-        return createmap, notcreated
+        return createmap, notcreated, todo
 
 
     def update_submission(self, changed, idmap):
@@ -720,17 +951,19 @@ class ImapDB(BaseDB):
     def destroy_submission(self, destroy):
         if not destroy:
             return [], {}
+        return self.write(self._destroy_submissions, destroy)
+
+    def _destroy_submissions(self, destroy):
         destroyed = []
         notdestroyed = {}
         namemap = {}
         for subid in destroy:
             deleted = self.dgetfield('jsubmission', {'jsubid': subid}, 'deleted')
             if deleted:
-                destroy.append(subid)
+                destroyed.append(subid)
                 self.ddelete('jsubmission', {'jsubid': subid})
             else:
                 notdestroyed[subid] = {'type': 'notFound', 'description': 'submission not found'}
-        self.commit()
         return destroyed, notdestroyed
     
     def _initdb(self):
@@ -858,6 +1091,31 @@ def as_imap_search(criteria):
     return ' '.join(out)
 
 
+def first_text_section(bodystructure, prefix=''):
+    """
+    Return (section, subtype, charset, encoding) of first text/plain part
+    in BODYSTRUCTURE, first text/html when there is no plain text.
+    """
+    html = None
+    if bodystructure.is_multipart:
+        for n, part in enumerate(bodystructure[0], 1):
+            found = first_text_section(part, f'{prefix}{n}.')
+            if found and found[1] == 'plain':
+                return found
+            html = html or found
+        return html
+    maintype = bodystructure[0].decode().lower()
+    subtype = bodystructure[1].decode().lower()
+    if maintype != 'text' or subtype not in ('plain', 'html'):
+        return None
+    params = bodystructure[2] or ()
+    params = {params[i].decode().lower(): params[i + 1].decode() for i in range(0, len(params) - 1, 2)}
+    if 'name' in params:
+        return None  # attachment
+    encoding = (bodystructure[5] or b'7bit').decode().lower()
+    return (prefix[:-1] or '1'), subtype, params.get('charset', 'us-ascii'), encoding
+
+
 def find_type(message, part):
     if message.get('id', '') == part:
         return message['type']
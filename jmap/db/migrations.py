@@ -0,0 +1,55 @@
+"""
+Versioned schema migrations.
+
+_initdb() creates tables as they were first released; later schema
+changes are migrations. Each component (BaseDB, ImapDB, ...) has a list
+of (version, name, steps), numbered from 1, and the jmigrations table
+records what was applied to the database. A step is an SQL statement or
+a callable taking the cursor. Every migration runs in its own
+transaction, so a failing one is applied again on next open.
+"""
+import logging as log
+
+
+def migrate(cursor, components) -> list:
+    "Apply missing migrations of {component: migrations}, return names of applied ones."
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS jmigrations (
+        component TEXT NOT NULL,
+        version INTEGER NOT NULL,
+        name TEXT,
+        applied DATE DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (component, version)
+    );""")
+    cursor.execute("SELECT component, MAX(version) FROM jmigrations GROUP BY component")
+    current = dict(cursor.fetchall())
+    applied = []
+    for component, migrations in components.items():
+        for version, name, steps in sorted(migrations, key=lambda m: m[0]):
+            if version <= current.get(component, 0):
+                continue
+            log.info('Applying migration %s %d: %s', component, version, name)
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                for step in steps:
+                    if callable(step):
+                        step(cursor)
+                    else:
+                        cursor.execute(step)
+                cursor.execute("INSERT INTO jmigrations (component, version, name) VALUES (?,?,?)",
+                               [component, version, name])
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+            applied.append(f'{component} {version}: {name}')
+    return applied
+
+
+def modseq_indexes(*tables):
+    "Steps creating jmodseq and jcreated indexes, for /changes since a state."
+    return tuple(
+        f"CREATE INDEX IF NOT EXISTS {table}_{column} ON {table} ({column})"
+        for table in tables
+        for column in ('jmodseq', 'jcreated')
+    )
@@ -0,0 +1,103 @@
+"""
+Pool of read-only connections to a SQLite database in WAL mode.
+
+Every use of a connection is one read transaction, so it sees a
+consistent snapshot of the last commit and never waits for the writer.
+Connections are opened on demand and up to SQLITE_READERS idle ones are
+kept, a reader never waits for a free connection.
+"""
+from contextlib import contextmanager
+import os
+import queue
+import sqlite3
+from urllib.parse import quote
+
+from . import storage
+from .cursor import InstrumentedCursor
+
+
+SQLITE_READERS = int(os.getenv('SQLITE_READERS', 4))
+
+
+class ReaderPool:
+    def __init__(self, dbpath, size=SQLITE_READERS, profile=None, cached_statements=128):
+        self.uri = 'file:' + quote(os.path.abspath(dbpath)) + '?mode=ro'
+        self.size = size
+        self.profile = profile
+        self.cached_statements = cached_statements
+        self.idle = queue.LifoQueue()
+
+    def connect(self):
+        dbh = sqlite3.connect(self.uri, uri=True, isolation_level=None,
+                              check_same_thread=False,
+                              cached_statements=self.cached_statements)
+        dbh.row_factory = sqlite3.Row
+        storage.apply(dbh, self.profile)
+        cursor = dbh.cursor(InstrumentedCursor)
+        cursor.row_factory = sqlite3.Row
+        return cursor
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return self.connect()
+
+    def release(self, cursor):
+        if self.idle.qsize() < self.size:
+            self.idle.put(cursor)
+        else:
+            cursor.connection.close()
+
+    @contextmanager
+    def cursor(self):
+        "Cursor in a read transaction, returned to the pool afterwards."
+        cursor = self.acquire()
+        cursor.execute('BEGIN')
+        try:
+            yield cursor
+        finally:
+            cursor.execute('COMMIT')
+            self.release(cursor)
+
+    def blobopen(self, table, column, row):
+        "Open blob read-only, its connection returns to the pool when the blob is closed."
+        cursor = self.acquire()
+        try:
+            blob = cursor.connection.blobopen(table, column, row, readonly=True)
+        except BaseException:
+            self.release(cursor)
+            raise
+        return PooledBlob(blob, lambda: self.release(cursor))
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().connection.close()
+            except queue.Empty:
+                return
+
+
+class PooledBlob:
+    "sqlite3.Blob calling release once it's closed."
+    def __init__(self, blob, release):
+        self.blob = blob
+        self._release = release
+
+    def __getattr__(self, name):
+        return getattr(self.blob, name)
+
+    def __len__(self):
+        return len(self.blob)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._release is not None:
+            self.blob.close()
+            self._release, release = None, self._release
+            release()
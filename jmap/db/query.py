@@ -0,0 +1,83 @@
+"""
+Cached SQL text for the BaseDB query helpers.
+
+Statements are built from table, column and operator names only, values
+are always bound as parameters. The same text is returned for the same
+shape of call, so it's built once and sqlite3 finds it in its statement
+cache instead of compiling it again.
+"""
+from functools import lru_cache
+
+
+def split_filter(filter: dict):
+    """
+    Return (columns, operators, values) of a helper filter,
+    where a value is either plain (equality) or (operator, value).
+    """
+    columns = tuple(filter)
+    operators = []
+    values = []
+    for val in filter.values():
+        if type(val) in (tuple, list):
+            operators.append(val[0])
+            values.append(val[1])
+        else:
+            operators.append('=')
+            values.append(val)
+    return columns, tuple(operators), values
+
+
+def _conditions(columns, operators):
+    return ' AND '.join(
+        f'{column}=?' if op == '=' else f'{column} {op} ?'
+        for column, op in zip(columns, operators))
+
+
+@lru_cache(maxsize=1024)
+def select(table, fields, columns=(), operators=(), limit=None):
+    sql = f'SELECT {fields} FROM {table}'
+    if columns:
+        sql += ' WHERE ' + _conditions(columns, operators)
+    if limit is not None:
+        sql += f' LIMIT {limit}'
+    return sql
+
+
+@lru_cache(maxsize=1024)
+def insert(table, columns, verb='INSERT OR REPLACE'):
+    return f"{verb} INTO {table} (`" + '`,`'.join(columns) \
+        + "`) VALUES (" + ('?,' * len(columns))[:-1] + ")"
+
+
+@lru_cache(maxsize=1024)
+def update(table, set_columns, columns=(), operators=()):
+    sql = f'UPDATE {table} SET ' + ', '.join(k + '=?' for k in set_columns)
+    if columns:
+        sql += ' WHERE ' + _conditions(columns, operators)
+    return sql
+
+
+@lru_cache(maxsize=256)
+def nuke(table, columns=(), operators=()):
+    sql = f'UPDATE {table} SET deleted=1, jmodseq=? WHERE deleted=0'
+    if columns:
+        sql += ' AND ' + _conditions(columns, operators)
+    return sql
+
+
+@lru_cache(maxsize=256)
+def delete(table, columns=(), operators=()):
+    sql = f'DELETE FROM {table}'
+    if columns:
+        sql += ' WHERE ' + _conditions(columns, operators)
+    return sql
+
+
+@lru_cache(maxsize=256)
+def log_changes(table, idcolumn, columns=(), operators=()):
+    """
+    Append a jchanges row for every row of table matching the filter,
+    values are modseq, type, change and then those of the filter.
+    """
+    return 'INSERT INTO jchanges (modseq, type, change, id) ' \
+        + select(table, f'?,?,?,{idcolumn}', columns, operators)
@@ -0,0 +1,78 @@
+"""
+SQLite storage profiles for the per-account mirror.
+
+A profile is a set of per-connection pragmas applied when BaseDB opens
+its database. Pick one with SQLITE_PROFILE and override single pragmas
+with SQLITE_PRAGMAS="cache_size=-65536,mmap_size=0".
+
+    safe      SQLite defaults, fsync on every commit
+    balanced  synchronous=NORMAL, memory for cache and temp tables
+    fast      bigger cache and mmap, fewer WAL checkpoints
+
+With WAL, synchronous=NORMAL never corrupts the database, a power loss
+may only roll back the last commits, which the next IMAP sync redoes.
+Compare profiles on your data with benchmarks/bench_sqlite.py.
+"""
+import os
+import re
+
+
+PROFILES = {
+    'safe': {
+        'synchronous': 'FULL',
+        'cache_size': -2000,
+        'mmap_size': 0,
+        'temp_store': 'DEFAULT',
+        'wal_autocheckpoint': 1000,
+    },
+    'balanced': {
+        'synchronous': 'NORMAL',
+        'cache_size': -16384,           # KiB
+        'mmap_size': 64 * 2**20,
+        'temp_store': 'MEMORY',
+        'wal_autocheckpoint': 1000,     # pages
+    },
+    'fast': {
+        'synchronous': 'NORMAL',
+        'cache_size': -65536,
+        'mmap_size': 256 * 2**20,
+        'temp_store': 'MEMORY',
+        'wal_autocheckpoint': 4000,
+    },
+}
+
+SQLITE_PROFILE = os.getenv('SQLITE_PROFILE', 'balanced')
+SQLITE_PRAGMAS = {
+    name.strip(): value.strip()
+    for name, _, value in (
+        item.partition('=')
+        for item in os.getenv('SQLITE_PRAGMAS', '').split(',') if item.strip()
+    )
+}
+# seconds between PRAGMA optimize runs, 0 disables
+SQLITE_OPTIMIZE_INTERVAL = float(os.getenv('SQLITE_OPTIMIZE_INTERVAL', 3600))
+
+# pragma values can't be bound as parameters
+VALUE_RE = re.compile(r'^-?\w+$')
+
+
+def pragmas(profile=None, overrides=None) -> dict:
+    "Return pragmas of named profile with overrides applied."
+    profile = profile or SQLITE_PROFILE
+    try:
+        res = dict(PROFILES[profile])
+    except KeyError:
+        raise ValueError(f'unknown SQLITE_PROFILE {profile!r}') from None
+    res.update(SQLITE_PRAGMAS if overrides is None else overrides)
+    for name, value in res.items():
+        if name not in PROFILES['safe'] or not VALUE_RE.match(str(value)):
+            raise ValueError(f'bad SQLite pragma {name}={value!r}')
+    return res
+
+
+def apply(dbh, profile=None, overrides=None) -> dict:
+    "Set pragmas of profile on connection, return them."
+    res = pragmas(profile, overrides)
+    for name, value in res.items():
+        dbh.execute(f'PRAGMA {name}={value}')
+    return res
@@ -0,0 +1,124 @@
+"""
+Single writer of a SQLite database.
+
+One thread owns the write connection and runs write jobs from a queue.
+Jobs queued while a transaction runs are committed together in the next
+one (group commit), each inside its own savepoint, so a failing job only
+rolls back its own changes. Callers get the result of their job once it
+is committed.
+
+GROUP_COMMIT_MAX limits jobs per transaction, GROUP_COMMIT_WAIT (ms)
+lets the writer wait for more jobs before it begins one.
+
+Context variables don't follow jobs into the writer thread, so the
+tracing span current when a job is queued is kept with it and each job
+runs in a child span of it.
+"""
+from concurrent.futures import Future
+from functools import wraps
+import os
+import queue
+import threading
+
+from jmap import metrics, tracing
+
+
+GROUP_COMMIT_MAX = int(os.getenv('GROUP_COMMIT_MAX', 64))
+GROUP_COMMIT_WAIT = float(os.getenv('GROUP_COMMIT_WAIT', 0))
+
+
+def writes(method):
+    "Run BaseDB method as a writer job, directly when already in one."
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return self.writer.run(method, self, *args, **kwargs)
+    return wrapper
+
+
+class Writer:
+    def __init__(self, cursor, before_commit=None, name='sqlite-writer'):
+        self.cursor = cursor
+        self.before_commit = before_commit
+        self.jobs = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.loop, name=name, daemon=True)
+        self.thread.start()
+
+    def in_writer(self) -> bool:
+        return threading.get_ident() == self.thread.ident
+
+    def submit(self, func, *args, **kwargs) -> Future:
+        "Queue job, return Future of its result."
+        future = Future()
+        self.jobs.put((future, func, args, kwargs, tracing.current_span.get()))
+        return future
+
+    def run(self, func, *args, **kwargs):
+        "Run job and wait until it's committed, return its result."
+        if self.in_writer():
+            return func(*args, **kwargs)
+        return self.submit(func, *args, **kwargs).result()
+
+    def close(self):
+        "Commit queued jobs and stop."
+        if self.thread.is_alive():
+            self.jobs.put(None)
+            self.thread.join()
+
+    def loop(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            batch = [job]
+            stop = self.collect(batch)
+            self.commit(batch)
+            if stop:
+                return
+
+    def collect(self, batch) -> bool:
+        "Add queued jobs to batch, return True when asked to stop."
+        timeout = GROUP_COMMIT_WAIT / 1000
+        while len(batch) < GROUP_COMMIT_MAX:
+            try:
+                job = self.jobs.get(timeout=timeout) if timeout else self.jobs.get_nowait()
+            except queue.Empty:
+                return False
+            if job is None:
+                return True
+            batch.append(job)
+        return False
+
+    def commit(self, batch):
+        done = []
+        try:
+            self.cursor.execute('BEGIN IMMEDIATE')
+            for future, func, args, kwargs, parent in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                self.cursor.execute('SAVEPOINT job')
+                try:
+                    with tracing.span('sqlite write', parent, job=getattr(func, '__name__', '?'),
+                                      batch=len(batch)):
+                        result = func(*args, **kwargs)
+                except BaseException as e:
+                    self.cursor.execute('ROLLBACK TO job')
+                    self.cursor.execute('RELEASE job')
+                    future.set_exception(e)
+                else:
+                    self.cursor.execute('RELEASE job')
+                    done.append((future, result))
+            if self.before_commit is not None:
+                self.before_commit()
+            self.cursor.execute('COMMIT')
+        except BaseException as e:
+            if self.cursor.connection.in_transaction:
+                self.cursor.execute('ROLLBACK')
+            for future, _ in done:
+                future.set_exception(e)
+            for future, *_ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        metrics.observe('sql_group_commit_jobs', len(batch), buckets=metrics.COUNT_BUCKETS)
+        for future, result in done:
+            future.set_result(result)
@@ -5,7 +5,7 @@ except ImportError:
     import json
 
 from jmap import errors
-from jmap.parse import asAddresses, asDate, asGroupedAddresses, asMessageIds, asRaw, asText, asURLs, htmltotext
+from jmap.parse import asAddresses, asDate, asGroupedAddresses, asMessageIds, asRaw, asText, asURLs, decode_headers
 from jmap.core import resolve_patch
 import re
 
@@ -136,51 +136,52 @@ def api_Email_get(request,
 
     if header_props and 'headers' not in properties:
         simple_props.remove('headers')
+    bodyvalues_args = (fetchTextBodyValues, fetchHTMLBodyValues,
+                       fetchAllBodyValues, maxBodyValueBytes or None)
+    if 'bodyValues' not in properties:
+        bodyvalues_args = None
     if ids is None:
         # get all
-        messages = account.db.get_messages(simple_props)
+        messages = account.db.get_messages(simple_props, bodyvalues_args=bodyvalues_args)
     else:
         notFound = set(request.idmap(i) for i in ids)
-        messages = account.db.get_messages(simple_props, id__in=notFound)
+        messages = account.db.get_messages(simple_props, id__in=notFound, bodyvalues_args=bodyvalues_args)
 
     for msg in messages:
         if ids is not None:
             notFound.remove(msg['id'])
         # Fill most of msg properties except header:*
-        data = {prop: msg[prop] for prop in simple_props}
+        data = {prop: msg[prop] for prop in simple_props if prop != 'bodyValues'}
         data['id'] = msg['id']
-        if 'textBody' in msg and 'htmlBody' not in msg and not msg['textBody']:
-            data['textBody'] = htmltotext(msg['htmlBody'])
+        if 'textBody' in data and not data['textBody']:
+            # no text/plain alternative, textBody falls back to html parts
+            data['textBody'] = msg['htmlBody']
         if 'bodyValues' in properties:
-            if fetchHTMLBodyValues:
-                data['bodyValues'] = {k: v for k, v in msg['bodyValues'].items() if v['type'] == 'text/html'}
-            elif fetchTextBodyValues:
-                data['bodyValues'] = {k: v for k, v in msg['bodyValues'].items() if v['type'] == 'text/plain'}
-            elif fetchAllBodyValues:
-                data['bodyValues'] = msg['bodyValues']
-            if maxBodyValueBytes:
-                for k, bodyValue in data['bodyValues'].items():
-                    if len(bodyValue['value']) > maxBodyValueBytes:
-                        bodyValue = {k: v for k, v in bodyValue.items()}
-                        bodyValue['value'] = bodyValue['value'][:maxBodyValueBytes]
-                        bodyValue['isTruncated'] = True,
-                        data['bodyValues'][k] = bodyValue
-
-        for prop, name, form, getall in header_props:
-            try:
-                func = HEADER_FORMS[form]
-            except KeyError:
-                raise errors.invalidProperties(f'Unknown header-form {form} in {prop}')
-
-            name = name.lower()
-            if getall:
-                data[prop] = [func(h['value'])
-                    for h in msg['headers'] if h['name'].lower() == name]
-            else:
-                data[prop] = func(msg.get_header(name))
+            # decode only requested parts, and no more than maxBodyValueBytes
+            data['bodyValues'] = msg.get_body_values(*bodyvalues_args)
 
         lst.append(data)
 
+    # header:* properties are decoded in batch for the whole list,
+    # mailing lists repeat the same raw values over and over
+    for prop, name, form, getall in header_props:
+        try:
+            func = HEADER_FORMS[form]
+        except KeyError:
+            raise errors.invalidProperties(f'Unknown header-form {form} in {prop}')
+
+        name = name.lower()
+        if getall:
+            raws = [[h['value'] for h in msg['headers'] if h['name'].lower() == name]
+                for msg in messages]
+            values = iter(decode_headers(func, [raw for r in raws for raw in r]))
+            for data, r in zip(lst, raws):
+                data[prop] = [next(values) for _ in r]
+        else:
+            values = decode_headers(func, [msg.get_header(name) for msg in messages])
+            for data, value in zip(lst, values):
+                data[prop] = value
+
     return {
         'accountId': accountId,
         'list': lst,
@@ -191,36 +192,9 @@ def api_Email_get(request,
 
 def api_Email_changes(request, accountId, sinceState, maxChanges=None):
     account = request.get_account(accountId)
-    newState = account.db.highModSeqEmail
-
-    if sinceState <= str(account.db.lowModSeq):
-        raise errors.cannotCalculateChanges({'new_state': newState})
-    
-    rows = account.db.dget('jmessages', {'jmodseq': ('>', sinceState)},
-                        'msgid,deleted,jcreated,jmodseq')
-    if maxChanges and len(rows) > maxChanges:
-        raise errors.cannotCalculateChanges({'new_state': newState})
-
-    created = []
-    updated = []
-    removed = []
-    for msgid, deleted, jcreated in rows:
-        if not deleted:
-            if jcreated <= sinceState:
-                updated.append(msgid)
-            else:
-                created.append(msgid)
-        elif jcreated <= sinceState:
-            removed.append(msgid)
-        # else never seen
-    
     return {
         'accountId': accountId,
-        'oldState': sinceState,
-        'newState': newState,
-        'created': created,
-        'updated': updated,
-        'removed': removed,
+        **account.db.get_changes('Email', sinceState, maxChanges),
     }
 
 
@@ -147,43 +147,13 @@ def api_Mailbox_query(request, accountId=None, sort=None, filter=None, position=
 
 def api_Mailbox_changes(request, accountId, sinceState, maxChanges=None, **kwargs):
     """
-    https://jmap.io/spec-mail.html#mailboxquerychanges
-    https://jmap.io/spec-core.html#querychanges
+    https://jmap.io/spec-mail.html#mailboxchanges
+    https://jmap.io/spec-core.html#changes
     """
     account = request.get_account(accountId)
-    new_state = account.db.highModSeqMailbox
-    if sinceState <= str(account.db.lowModSeq):
-        raise errors.cannotCalculateChanges({'new_state': new_state})
-    rows = account.db.get_mailboxes(modseq__gt=sinceState)
-
-    if maxChanges and len(rows) > maxChanges:
-        raise errors.cannotCalculateChanges({'new_state': new_state})
-
-    created = []
-    updated = []
-    removed = []
-    only_counts = 0
-    for mbox in rows:
-        if not mbox['deleted']:
-            if mbox['created'] <= sinceState:
-                updated.append(mbox['id'])
-                if mbox['jnoncountsmodseq'] > sinceState:
-                    only_counts = 0
-            else:
-                created.append(mbox['id'])
-        else:
-            if mbox['created'] <= sinceState:
-                removed.append(mbox['id'])
-            # otherwise never seen
-
     return {
         'accountId': accountId,
-        'oldState': sinceState,
-        'newState': new_state,
-        'created': created,
-        'updated': updated,
-        'removed': removed,
-        'changedProperties': ["totalEmails", "unreadEmails", "totalThreads", "unreadThreads"] if only_counts else None,
+        **account.db.get_changes('Mailbox', sinceState, maxChanges),
     }
 
 
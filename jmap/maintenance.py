@@ -0,0 +1,105 @@
+"""
+Periodic maintenance of account databases.
+
+Databases of open accounts are registered here and run() calls every
+job for each of them when its interval passes. Jobs run in worker
+threads, on up to MAINTENANCE_CONCURRENCY databases at once, so one slow
+database doesn't hold back the others. Requests keep being served, and
+each database's writer interleaves the jobs' transactions with sync ones.
+
+A run of compact does all purging that is due, in writer jobs of
+COMPACT_BATCH rows, and vacuums at most COMPACT_VACUUM_PAGES pages;
+what's left of a large backlog of free pages waits for the next run.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+import logging as log
+import os
+from time import monotonic
+import weakref
+
+from jmap import metrics
+
+
+COMPACT_INTERVAL = float(os.getenv('COMPACT_INTERVAL', 3600))
+VERIFY_COUNTS_INTERVAL = float(os.getenv('VERIFY_COUNTS_INTERVAL', 86400))
+MAINTENANCE_TICK = float(os.getenv('MAINTENANCE_TICK', 60))
+MAINTENANCE_CONCURRENCY = int(os.getenv('MAINTENANCE_CONCURRENCY', 4))
+
+DATABASES = weakref.WeakSet()
+# (name, interval in seconds, function called with database), 0 disables
+JOBS = []
+
+
+def register(db):
+    DATABASES.add(db)
+
+
+def job(name, interval):
+    "Decorator adding function to JOBS."
+    def decorator(func):
+        JOBS.append((name, interval, func))
+        return func
+    return decorator
+
+
+@job('compact', COMPACT_INTERVAL)
+def compact(db):
+    return db.compact()
+
+
+@job('verify_counts', VERIFY_COUNTS_INTERVAL)
+def verify_counts(db):
+    "Repair mailbox counts that drifted from their messages."
+    repaired = db.verify_mailbox_counts()
+    if repaired:
+        metrics.inc('mailbox_counts_repaired_total', len(repaired))
+        log.warning('Repaired mailbox counts of %s: %s', db.accountid, repaired)
+    return repaired
+
+
+async def run_job(name, func, db):
+    t0 = monotonic()
+    try:
+        res = await asyncio.to_thread(func, db)
+    except Exception:
+        metrics.inc('maintenance_errors_total', job=name)
+        log.exception('Maintenance job %s of %s failed', name, db.accountid)
+        return
+    metrics.inc('maintenance_runs_total', job=name)
+    metrics.observe('maintenance_duration_seconds', monotonic() - t0, job=name)
+    log.info('Maintenance job %s of %s: %s', name, db.accountid, res)
+
+
+async def run_all(name, func, databases, concurrency=MAINTENANCE_CONCURRENCY):
+    "Run job on databases, at most concurrency of them at once."
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+    async def bounded(db):
+        async with semaphore:
+            await run_job(name, func, db)
+
+    await asyncio.gather(*(bounded(db) for db in databases))
+
+
+async def run(tick=MAINTENANCE_TICK):
+    "Run jobs forever, first runs are one interval after start."
+    started = monotonic()
+    last = {}
+    while True:
+        await asyncio.sleep(tick)
+        for name, interval, func in JOBS:
+            if not interval or monotonic() - last.get(name, started) < interval:
+                continue
+            last[name] = monotonic()
+            await run_all(name, func, list(DATABASES))
+
+
+@asynccontextmanager
+async def lifespan(app):
+    "Starlette lifespan running maintenance in the background."
+    task = asyncio.create_task(run())
+    try:
+        yield
+    finally:
+        task.cancel()
@@ -0,0 +1,111 @@
+"""
+In-process metrics.
+
+Counters are incremented by name, gauges are callables evaluated when
+metrics are collected, histograms count observations into fixed buckets.
+Counters and histograms take labels as keyword arguments. Everything is
+exported in Prometheus text format by render().
+Updates come from the event loop, worker threads and writer threads,
+so counters and histograms are changed and read under LOCK.
+"""
+from bisect import bisect_left
+from collections import Counter
+import threading
+
+
+# seconds, from cache hits to slow IMAP round trips
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+# objects per response
+COUNT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+COUNTERS = Counter()
+GAUGES = {}
+HISTOGRAMS = {}
+LOCK = threading.Lock()
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def inc(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with LOCK:
+        COUNTERS[key] += value
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with LOCK:
+        try:
+            histogram = HISTOGRAMS[key]
+        except KeyError:
+            histogram = HISTOGRAMS[key] = Histogram(buckets)
+        histogram.observe(value)
+
+
+def register_gauge(name, func):
+    GAUGES[name] = func
+
+
+def snapshot():
+    "Return dict of current values of all counters and gauges."
+    with LOCK:
+        counters = list(COUNTERS.items())
+    res = {_series(name, labels): value for (name, labels), value in counters}
+    res.update({name: func() for name, func in GAUGES.items()})
+    return res
+
+
+def _series(name, labels):
+    if not labels:
+        return name
+    pairs = ','.join(
+        '%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels)
+    return f'{name}{{{pairs}}}'
+
+
+def render() -> str:
+    "Return all metrics in Prometheus text exposition format."
+    lines = []
+    typed = set()
+    def typ(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f'# TYPE {name} {kind}')
+
+    # copy under the lock, gauges are called and text is built outside it
+    with LOCK:
+        counters = sorted(COUNTERS.items())
+        histograms = [(key, h.buckets, list(h.counts), h.sum, h.count)
+                      for key, h in sorted(HISTOGRAMS.items())]
+
+    for (name, labels), value in counters:
+        typ(name, 'counter')
+        lines.append(f'{_series(name, labels)} {value}')
+    for name, func in sorted(GAUGES.items()):
+        typ(name, 'gauge')
+        lines.append(f'{name} {func()}')
+    for (name, labels), buckets, counts, total, n in histograms:
+        typ(name, 'histogram')
+        cumulative = 0
+        for le, count in zip(buckets + ('+Inf',), counts):
+            cumulative += count
+            lines.append(f"{_series(name + '_bucket', labels + (('le', le),))} {cumulative}")
+        lines.append(f"{_series(name + '_sum', labels)} {total}")
+        lines.append(f"{_series(name + '_count', labels)} {n}")
+    lines.append('')
+    return '\n'.join(lines)
@@ -0,0 +1,267 @@
+"""
+Offset based MIME parser.
+
+Parsing a message builds a tree of MimePart objects which only record
+byte offsets into the original message, so the part tree, sizes,
+dispositions and charsets are known without decoding any body.
+Text parts are decoded lazily, and only up to the requested limit.
+"""
+from binascii import a2b_base64, a2b_qp, Error as BinasciiError
+import codecs
+import re
+from urllib.parse import unquote_to_bytes
+
+
+HEADER_END_RE = re.compile(rb'\r?\n\r?\n')
+HEADER_LINE_RE = re.compile(rb'\r?\n(?![ \t])')
+PARAM_RE = re.compile(r';\s*([^\s=;]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;\s]*)')
+BASE64_WS = b' \t\r\n'
+
+
+class MimePart:
+    """
+    One node of the MIME tree.
+
+    `start`, `body_start` and `end` are offsets into `raw`, which is the
+    whole message shared by every part of the tree.
+    """
+    __slots__ = ('raw', 'start', 'body_start', 'end', 'partId', 'headers',
+                 'type', 'params', 'disposition', 'disposition_params',
+                 'encoding', 'subParts')
+
+    def __init__(self, raw, start, end, partId=None, default_type='text/plain'):
+        self.raw = raw
+        self.start = start
+        self.end = end
+        self.partId = partId
+        self.subParts = []
+
+        match = HEADER_END_RE.search(raw, start, end)
+        if raw.startswith(b'\n', start) or raw.startswith(b'\r\n', start):
+            # no headers at all, body follows the empty line
+            self.body_start = raw.index(b'\n', start) + 1
+            block = b''
+        elif match:
+            self.body_start = match.end()
+            block = raw[start:match.start()]
+        else:
+            self.body_start = end
+            block = raw[start:end]
+        self.headers = parse_headers(block)
+
+        ctype, self.params = split_params(self.get_header('content-type') or default_type)
+        if '/' not in ctype:
+            ctype = default_type
+        self.type = ctype.lower()
+        disposition, self.disposition_params = split_params(self.get_header('content-disposition') or '')
+        self.disposition = disposition.lower() or None
+        self.encoding = (self.get_header('content-transfer-encoding') or '7bit').strip().lower()
+
+    def get_header(self, name: str):
+        "Return raw value of the first header instance, name needs to be lowercase."
+        for hname, value in self.headers:
+            if hname.lower() == name:
+                return value
+        return None
+
+    @property
+    def is_multipart(self):
+        return self.type.startswith('multipart/')
+
+    @property
+    def charset(self):
+        charset = self.params.get('charset', None)
+        if charset:
+            return charset.lower()
+        if self.type.startswith('text/'):
+            return 'us-ascii'
+        return None
+
+    @property
+    def name(self):
+        return self.disposition_params.get('filename', None) \
+            or self.params.get('name', None)
+
+    @property
+    def size(self):
+        "Size in octets after transfer decoding, computed without decoding."
+        start, end = self.body_start, self.end
+        if self.encoding == 'base64':
+            ws = sum(self.raw.count(c, start, end) for c in (b' ', b'\t', b'\r', b'\n'))
+            padding = self.raw.count(b'=', max(start, end - 4), end)
+            return max(0, (end - start - ws) * 3 // 4 - padding)
+        if self.encoding == 'quoted-printable':
+            escapes = self.raw.count(b'=', start, end)
+            softbreaks = self.raw.count(b'=\r\n', start, end)
+            return max(0, end - start - 2 * escapes - softbreaks)
+        return end - start
+
+    def content(self, limit=None):
+        """
+        Return transfer decoded body bytes.
+        When limit is given, decode only enough input to produce limit bytes.
+        """
+        start, end = self.body_start, self.end
+        if limit is not None:
+            if self.encoding == 'base64':
+                # account for line breaks, 76 chars per line is common
+                want = (limit // 3 + 1) * 4
+                end = min(end, start + want + (want // 76 + 1) * 2)
+            elif self.encoding == 'quoted-printable':
+                end = min(end, start + limit * 3 + 2)
+                if end < self.end:
+                    # never cut an escape sequence in half
+                    cut = self.raw.rfind(b'\n', start, end)
+                    end = cut + 1 if cut > start else end - 2
+            else:
+                end = min(end, start + limit)
+        data = self.raw[start:end]
+        if self.encoding == 'base64':
+            data = data.translate(None, BASE64_WS)
+            if end < self.end:
+                data = data[:len(data) & ~3]
+            try:
+                data = a2b_base64(data)
+            except BinasciiError:
+                data = a2b_base64(data[:len(data) & ~3] + b'==')
+        elif self.encoding == 'quoted-printable':
+            data = a2b_qp(data)
+        return data if limit is None else data[:limit]
+
+    def text(self, limit=None):
+        """
+        Return (value, isEncodingProblem, isTruncated) of a text part.
+        Limit is in UTF-8 octets as maxBodyValueBytes of Email/get.
+        """
+        if limit is None:
+            data = self.content()
+            truncated = False
+        else:
+            # 4 octets is the longest char in common charsets
+            data = self.content(limit * 4 + 4)
+            truncated = self.size > len(data)
+        try:
+            decoder = codecs.getincrementaldecoder(_codec(self.charset))('strict')
+            value = decoder.decode(data, final=not truncated)
+            problem = False
+        except (LookupError, UnicodeDecodeError):
+            decoder = codecs.getincrementaldecoder('utf-8')('replace')
+            value = decoder.decode(data, final=not truncated)
+            problem = True
+        if limit is not None:
+            encoded = value.encode('utf-8', 'surrogatepass')
+            if len(encoded) > limit:
+                value = encoded[:limit].decode('utf-8', 'ignore')
+                truncated = True
+        return value, problem, truncated
+
+    def walk(self):
+        yield self
+        for part in self.subParts:
+            yield from part.walk()
+
+
+def _codec(charset):
+    if charset in (None, 'us-ascii', 'ascii'):
+        # us-ascii mail routinely carries 8bit, utf-8 is a superset
+        return 'utf-8'
+    return charset
+
+
+def parse_headers(block: bytes):
+    "Split raw header block into list of (name, value) tuples."
+    headers = []
+    if not block:
+        return headers
+    for line in HEADER_LINE_RE.split(block):
+        name, sep, value = line.partition(b':')
+        if not sep:
+            continue
+        headers.append((
+            name.strip().decode('ascii', 'replace'),
+            value.strip().decode('utf-8', 'replace'),
+        ))
+    return headers
+
+
+def split_params(value: str):
+    "Split structured header into main value and dict of parameters."
+    main, _, rest = value.partition(';')
+    params = {}
+    continuations = {}
+    for key, val in PARAM_RE.findall(';' + rest):
+        key = key.lower()
+        if val.startswith('"'):
+            val = re.sub(r'\\(.)', r'\1', val[1:-1])
+        if '*' in key:
+            # RFC 2231 encoded and/or continued parameter
+            key, _, section = key.partition('*')
+            continuations.setdefault(key, []).append((section, val))
+        else:
+            params[key] = val
+    for key, sections in continuations.items():
+        params[key] = _join_rfc2231(sorted(sections, key=_section_order))
+    return main.strip(), params
+
+
+def _section_order(item):
+    section = item[0].rstrip('*')
+    return int(section) if section.isdigit() else 0
+
+
+def _join_rfc2231(sections):
+    charset = None
+    value = b''
+    for section, val in sections:
+        if not section.endswith('*') and section != '':
+            value += val.encode('utf-8', 'replace')
+            continue
+        if section in ('', '0*'):
+            parts = val.split("'", 2)
+            if len(parts) == 3:
+                charset, _, val = parts
+        value += unquote_to_bytes(val)
+    try:
+        return value.decode(charset or 'utf-8', 'replace')
+    except LookupError:
+        return value.decode('utf-8', 'replace')
+
+
+def parse(raw: bytes, start=0, end=None, partId=None, default_type='text/plain'):
+    "Parse message (or embedded part) into tree of MimePart."
+    if end is None:
+        end = len(raw)
+    part = MimePart(raw, start, end, partId, default_type)
+    if part.is_multipart:
+        boundary = part.params.get('boundary', None)
+        if boundary:
+            subtype = 'message/rfc822' if part.type == 'multipart/digest' else 'text/plain'
+            for n, (s, e) in enumerate(_split_multipart(raw, part.body_start, end, boundary.encode()), 1):
+                subId = f'{partId}.{n}' if partId else str(n)
+                part.subParts.append(parse(raw, s, e, subId, subtype))
+        else:
+            part.type = 'text/plain'
+    if part.partId is None and not part.is_multipart:
+        # single part message is IMAP section 1
+        part.partId = '1'
+    return part
+
+
+def _split_multipart(raw, start, end, boundary):
+    "Yield (start, end) offsets of body parts between boundary lines."
+    delimiter = re.compile(rb'^--' + re.escape(boundary) + rb'(--)?[ \t]*\r?$', re.M)
+    partstart = None
+    for match in delimiter.finditer(raw, start, end):
+        if partstart is not None:
+            partend = match.start()
+            if raw[partend - 2:partend] == b'\r\n':
+                partend -= 2
+            elif raw[partend - 1:partend] == b'\n':
+                partend -= 1
+            yield partstart, max(partstart, partend)
+        if match.group(1):
+            return
+        partstart = min(match.end() + 1, end)
+    if partstart is not None and partstart < end:
+        # missing close delimiter
+        yield partstart, end
@@ -1,12 +1,15 @@
+from collections import OrderedDict
 from datetime import datetime
-import email
 from email.header import decode_header, make_header
-from email.message import EmailMessage
-from email.policy import default
-from email.utils import format_datetime, getaddresses, parseaddr, parsedate_to_datetime
+from email.utils import getaddresses, parseaddr, parsedate_to_datetime
 from email._parseaddr import AddressList
 import hashlib
+from html import unescape
+import os
 import re
+import threading
+
+from jmap import metrics, mime
 
 
 MEDIA_MAIN_TYPES = ('image', 'audio', 'video')
@@ -41,33 +44,101 @@ def asText(raw):
     return raw and str(make_header(decode_header(raw))).strip()
 
 
+def _copy(value):
+    "Copy of decoded header value, lists and dicts are copied deeply."
+    if isinstance(value, list):
+        return [_copy(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _copy(item) for key, item in value.items()}
+    return value
+
+
+class HeaderCache:
+    """
+    Bounded LRU memo of header form decoding, keyed on (form, raw value).
+    Shared by request threads, so it's locked. Every caller gets its own
+    copy of the value, responses may be modified without touching it.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def decode(self, form, raw):
+        if not raw:
+            return form(raw)
+        key = (form, raw)
+        with self.lock:
+            if key in self.data:
+                self.hits += 1
+                self.data.move_to_end(key)
+                return _copy(self.data[key])
+        # decode outside of the lock, a value decoded twice is no harm
+        value = form(raw)
+        with self.lock:
+            self.misses += 1
+            self.data[key] = _copy(value)
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+        return value
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+header_cache = HeaderCache(int(os.getenv('HEADER_CACHE_SIZE', 10000)))
+metrics.register_gauge('header_cache_hits', lambda: header_cache.hits)
+metrics.register_gauge('header_cache_misses', lambda: header_cache.misses)
+metrics.register_gauge('header_cache_hit_rate', header_cache.hit_rate)
+metrics.register_gauge('header_cache_size', lambda: len(header_cache.data))
+
+
+def decode_header_form(form, raw):
+    "Return raw header value decoded by form function, e.g. asAddresses."
+    return header_cache.decode(form, raw)
+
+
+def decode_headers(form, raws):
+    "Decode list of raw header values, each distinct value once."
+    decoded = {}
+    res = []
+    for raw in raws:
+        try:
+            res.append(decoded[raw])
+        except KeyError:
+            value = decoded[raw] = header_cache.decode(form, raw)
+            res.append(value)
+    return res
+
+
 
 def parse(rfc822, id=None):
     if id is None:
         id = hashlib.sha1(rfc822).hexdigest()
-    eml = email.message_from_bytes(rfc822, policy=default)
-    res = parse_email(id, eml)
+    res = parse_email(id, mime.parse(rfc822))
     res['id'] = id
     res['size'] = len(rfc822)
     return res
 
 
-def parse_email(id, eml, part=None):
-    bodyValues = {}
-    bodyStructure = bodystructure(bodyValues, id, eml)
+def parse_email(id, part):
+    bodyStructure = bodystructure(id, part)
+    bodyValues = bodyvalues(part)
     textBody, htmlBody, attachments = parseStructure([bodyStructure], 'mixed', False)
-    subject = str(make_header(decode_header(eml['Subject'])))
     return {
-        'from': hdrAsAddresses(eml['From']),
-        'to': hdrAsAddresses(eml['To']),
-        'cc': hdrAsAddresses(eml['Cc']),
-        'bcc': hdrAsAddresses(eml['Bcc']),
-        'replyTo': hdrAsAddresses(eml['Reply-To']),
-        'subject': subject,
-        'date': asDate(eml['Date']),
+        'from': asAddresses(part.get_header('from')),
+        'to': asAddresses(part.get_header('to')),
+        'cc': asAddresses(part.get_header('cc')),
+        'bcc': asAddresses(part.get_header('bcc')),
+        'replyTo': asAddresses(part.get_header('reply-to')),
+        'subject': asText(part.get_header('subject')),
+        'date': asDate(part.get_header('date')),
         'preview': preview(bodyValues),
         'hasAttachment': len(attachments),
-        'headers': headers(eml),
+        'headers': [{'name': k, 'value': v} for k, v in part.headers],
         'bodyStructure': bodyStructure,
         'bodyValues': bodyValues,
         'textBody': textBody,
@@ -76,48 +147,61 @@ def parse_email(id, eml, part=None):
     }
 
 
-def bodystructure(id, eml, partno=None):
-    hdrs = headers(eml)
-    typ = eml.get_content_type().lower()
-    bodyValues = {}
-
-    if eml.is_multipart():
-        subParts = []
-        for n, part in enumerate(eml.iter_parts()):
-            subBodyValues, part = bodystructure(id, part, f"{partno}.{n}" if partno else str(n))
-            subParts.append(part)
-            if subBodyValues:
-                bodyValues.update(subBodyValues)
-        return bodyValues, {
+def bodystructure(id, part):
+    "Return JMAP bodyStructure of mime.MimePart tree, no bodies are decoded."
+    hdrs = [{'name': k, 'value': v} for k, v in part.headers]
+    if part.is_multipart:
+        return {
             'partId': None,
             'blobId': None,
-            'type': typ,
+            'type': part.type,
+            'charset': None,
             'size': 0,
             'headers': hdrs,
             'name': None,
             'cid': None,
             'disposition': 'none',
-            'subParts': subParts,
+            'subParts': [bodystructure(id, sub) for sub in part.subParts],
         }
 
-    partno = partno or '1'
-    body = eml.get_content()
-    if typ.startswith('text/'):
-        bodyValues[partno] = {'value': body, 'type': typ}
-    return bodyValues, {
-        'partId': partno,
-        'blobId': f"{id}-{partno}",
-        'type': typ,
-        'size': len(body),
+    return {
+        'partId': part.partId,
+        'blobId': f"{id}-{part.partId}",
+        'type': part.type,
+        'charset': part.charset,
+        'size': part.size,
         'headers': hdrs,
-        'name': eml.get_filename(),
-        'cid': asOneURL(eml['Content-ID']),
-        'language': asCommaList(eml['Content-Language']),
-        'location': hdrAsText(eml['Content-Location']),
-        'disposition': eml.get_content_disposition() or 'none',
+        'name': asText(part.name),
+        'cid': asOneURL(part.get_header('content-id')),
+        'language': asCommaList(part.get_header('content-language')),
+        'location': asText(part.get_header('content-location')),
+        'disposition': part.disposition or 'none',
     }
 
 
+def bodyvalues(part, types=None, partIds=None, limit=None):
+    """
+    Decode text parts of mime.MimePart tree into JMAP bodyValues.
+    Only parts of given types or partIds are decoded, up to limit octets.
+    """
+    bodyValues = {}
+    for leaf in part.walk():
+        if leaf.is_multipart or not leaf.type.startswith('text/'):
+            continue
+        if types is not None and leaf.type not in types:
+            continue
+        if partIds is not None and leaf.partId not in partIds:
+            continue
+        value, isEncodingProblem, isTruncated = leaf.text(limit)
+        bodyValues[leaf.partId] = {
+            'value': value,
+            'type': leaf.type,
+            'isEncodingProblem': isEncodingProblem,
+            'isTruncated': isTruncated,
+        }
+    return bodyValues
+
+
 def parseStructure(parts, multipartType, inAlternative):
     textBody = []
     htmlBody = []
@@ -166,99 +250,134 @@ def parseStructure(parts, multipartType, inAlternative):
     return textBody, htmlBody,attachments
 
 
-def hdrAsAddresses(hdr):
-    return hdr and [{
-        'name': str(a.display_name),
-        'email': f"{a.username}@{a.domain}",
-    } for a in hdr.addresses]
+def select_bodyvalues(part, fetchText=False, fetchHTML=False, fetchAll=False, limit=None):
+    "Return bodyValues as requested by fetch*BodyValues arguments of Email/get."
+    if fetchAll:
+        return bodyvalues(part, limit=limit)
+    types = []
+    if fetchText:
+        types.append('text/plain')
+    if fetchHTML:
+        types.append('text/html')
+    values = bodyvalues(part, types, limit=limit) if types else {}
+    if fetchText and not fetchHTML and not values:
+        # html only message, its textBody is the html part, sent as it is
+        values = bodyvalues(part, ['text/html'], limit=limit)
+    return values
+
+
+def parse_body(id, rfc822, bodyvalues_args=None):
+    """
+    Parse body related properties of the message.
+    Returns only plain data, so it can run in a worker process.
+    """
+    part = mime.parse(rfc822)
+    res = {'bodyStructure': bodystructure(id, part)}
+    res['textBody'], res['htmlBody'], res['attachments'] = \
+        parseStructure([res['bodyStructure']], 'mixed', False)
+    if bodyvalues_args is not None:
+        res['bodyValues', bodyvalues_args] = select_bodyvalues(part, *bodyvalues_args)
+    return res
+
 
-def hdrAsText(hdr):
-    return hdr and str(make_header(decode_header(hdr))).strip()
+PREVIEW_LENGTH = 256
 
-def headers(eml):
-    return [{'name': k, 'value': v} for k, v in eml.items()]
 
 def preview(bodyValues):
     for part in bodyValues.values():
         if part['type'] == 'text/plain':
-            return part['value'][256:]
+            return make_preview(part['value'], part['type'])
     for part in bodyValues.values():
         if part['type'] == 'text/html':
-            return htmltotext(part['value'])[256:]
+            return make_preview(part['value'], part['type'])
     return None
-    
-
-def htmltotext(html):
-    # TODO: remove html tags ...
-    return html
 
 
-def _mkone(a):
-    if a['name']:
-        return f"\"{a['name']}\" <{a['email']}>"
+def make_preview(value, typ='text/plain'):
+    "Return first PREVIEW_LENGTH characters of text, whitespace normalized."
+    if typ == 'text/html':
+        value = htmltotext(value, PREVIEW_LENGTH)
     else:
-        return f"{a['email']}"
-
-def _mkemail(aa):
-    return ', '.join(_mkone(a) for a in aa)
-
-def _detect_encoding(content, typ):
-    if typ.startswith('message'):
-        match = re.match(r'[^\x20-\x7f]')
-        if match:
-            return '8bit'
-        return '7bit'
-    elif type.startswith('text'):
-        #XXX - also line lengths?
-        match = re.match(r'[^\x20-\x7f]')
-        if match:
-            return 'quoted-printable'
-        return '7bit'
-    return 'base64'
-
-def _makeatt(att, blobs):
-    msg = EmailMessage()
-    msg.add_header('Content-Type', att['type'], name=att['name'])
-    msg.add_header('Content-Disposition',
-        'inline' if att['isInline'] else 'attachment',
-        filename=att['name'],
-        )
-
-    if att['cid']:
-        msg.add_header('Content-ID', "<" + att['cid'] + ">")
-    typ, content = blobs[att['blobId']]
-    msg.add_header('Content-Transfer-Encoding', _detect_encoding(content, att['type']))
-    msg.set_payload(content)
-    return msg
-
-def make(args, blobs):
-    msg = EmailMessage()
-    msg['From'] = _mkemail(args['from'])
-    msg['To'] = _mkemail(args['to'])
-    msg['Cc'] = _mkemail(args['cc'])
-    msg['Bcc'] = _mkemail(args['bcc'])
-    msg['Subject'] = args['subject']
-    msg['Date'] = format_datetime(args['msgdate'])
-    for header, val in args['headers'].items():
-        msg[header] = val
-    if 'replyTo' in args:
-        msg['replyTo'] = args['replyTo']
-
-    if 'textBody' in args:
-        text = args['textBody']
-    else:
-        text = htmltotext(args['htmlBody'])
-    msg.add_header('Content-Type', 'text/plain')
-    msg.set_content(text)
-
-    if 'htmlBody' in args:
-        htmlpart = EmailMessage()
-        htmlpart.add_header('Content-Type', 'text/html')
-        htmlpart.set_content(args['htmlBody'])
-        msg.make_alternative()
-        msg.add_alternative(htmlpart)
-
-    for att in args.get('attachments', ()):
-        msg.add_attachment(_makeatt(att, blobs))
-    
-    return msg.as_string()
+        # enough input for the preview, even if it's mostly whitespace
+        value = value[:PREVIEW_LENGTH * 4]
+    return WHITESPACE_RE.sub(' ', value).strip()[:PREVIEW_LENGTH]
+
+
+HTML_TAG_RE = re.compile(r'<(?:!--.*?(?:-->|\Z)|(/?)([a-zA-Z][a-zA-Z0-9:-]*)[^>]*>?|[!?][^>]*>?)', re.S)
+HTML_SKIP_TAGS = {
+    'script': re.compile(r'</script\s*>', re.I),
+    'style': re.compile(r'</style\s*>', re.I),
+    'head': re.compile(r'</head\s*>', re.I),
+    'title': re.compile(r'</title\s*>', re.I),
+}
+HTML_BLOCK_TAGS = {
+    'address', 'article', 'aside', 'blockquote', 'br', 'dd', 'div', 'dl', 'dt',
+    'footer', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'li', 'ol',
+    'p', 'pre', 'section', 'table', 'td', 'th', 'tr', 'ul',
+}
+HTML_PARAGRAPH_TAGS = {'blockquote', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'p', 'table'}
+WHITESPACE_RE = re.compile(r'\s+')
+
+
+def htmltotext(html, limit=None):
+    """
+    Convert HTML into plain text in a single linear pass.
+    Script and style content is skipped, entities are decoded and
+    conversion stops once limit characters of text were produced.
+    """
+    out = []
+    length = 0
+    newlines = 0  # pending line breaks before next text
+    space = False  # pending space before next text
+    pos = start = 0
+    end = len(html)
+    while True:
+        lt = html.find('<', pos)
+        if lt < 0:
+            lt = end
+        match = HTML_TAG_RE.match(html, lt) if lt < end else None
+        if lt < end and not match:
+            # stray '<' is part of the text
+            pos = lt + 1
+            continue
+
+        if lt > start:
+            text = html[start:lt]
+            if '&' in text:
+                text = unescape(text)
+            words = WHITESPACE_RE.sub(' ', text)
+            if words.strip():
+                if words[0] == ' ':
+                    space = True
+                    words = words[1:]
+                trailing = words[-1] == ' '
+                if trailing:
+                    words = words[:-1]
+                if length:
+                    sep = '\n' * newlines if newlines else (' ' if space else '')
+                    out.append(sep)
+                    length += len(sep)
+                out.append(words)
+                length += len(words)
+                newlines = 0
+                space = trailing
+                if limit is not None and length >= limit:
+                    break
+            elif words:
+                space = True
+        if not match:
+            break
+
+        pos = start = match.end()
+        name = match.group(2)
+        if not name:
+            continue  # comment, doctype, processing instruction
+        name = name.lower()
+        if name in HTML_SKIP_TAGS and not match.group(1):
+            close = HTML_SKIP_TAGS[name].search(html, pos)
+            pos = start = close.end() if close else end
+        elif name in HTML_BLOCK_TAGS:
+            newlines = max(newlines, 2 if name in HTML_PARAGRAPH_TAGS else 1)
+
+    text = ''.join(out)
+    return text if limit is None else text[:limit]
@@ -0,0 +1,81 @@
+"""
+Opt-in request profiling.
+
+A request is profiled when it carries the X-JMAP-Profile header with the
+PROFILE_TOKEN secret, or when it's picked by the sample rate of its
+account: PROFILE_SAMPLE_RATES="alice=0.1,bob=1", PROFILE_SAMPLE_RATE for
+everybody else. Each profiled request writes a pstats file to PROFILE_DIR,
+named by time, request id and the methods called:
+
+    python -m pstats profiles/20240101T120000-4f2a...-Email_query+Email_get.pstats
+"""
+import cProfile
+import hmac
+import logging as log
+import os
+from random import random
+import re
+import time
+
+
+PROFILE_TOKEN = os.getenv('PROFILE_TOKEN', '')
+PROFILE_DIR = os.getenv('PROFILE_DIR', './profiles/')
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+PROFILE_SAMPLE_RATES = {
+    account: float(rate)
+    for account, _, rate in (
+        item.strip().partition('=')
+        for item in os.getenv('PROFILE_SAMPLE_RATES', '').split(',') if item.strip()
+    )
+}
+PROFILE_HEADER = 'x-jmap-profile'
+
+
+class Profile:
+    "cProfile of one request, enabled only while its code runs."
+    def __init__(self, requestId):
+        # ids come from clients, keep them safe for file names
+        self.requestId = re.sub(r'[^\w.-]', '_', requestId)[:64]
+        self.profiler = cProfile.Profile()
+
+    def __enter__(self):
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.disable()
+
+    def save(self, methods) -> str:
+        "Write pstats file, return its path."
+        names = '+'.join(dict.fromkeys(methods)) or 'none'
+        names = re.sub(r'[^\w+.-]', '_', names)[:120]
+        stamp = time.strftime('%Y%m%dT%H%M%S')
+        path = os.path.join(PROFILE_DIR, f'{stamp}-{self.requestId}-{names}.pstats')
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        self.profiler.dump_stats(path)
+        log.info('Profile of request %s written to %s', self.requestId, path)
+        return path
+
+
+def method_names(data):
+    "Method names of a Request object, whatever shape it has."
+    try:
+        return [call[0] for call in data['methodCalls']]
+    except (KeyError, IndexError, TypeError):
+        return []
+
+
+def wanted(user, headers) -> bool:
+    "Should request of user with these headers be profiled?"
+    token = headers.get(PROFILE_HEADER, None)
+    if token and PROFILE_TOKEN and hmac.compare_digest(token, PROFILE_TOKEN):
+        return True
+    rate = PROFILE_SAMPLE_RATES.get(user.username, PROFILE_SAMPLE_RATE)
+    return rate > 0 and random() < rate
+
+
+def for_request(user, headers, requestId):
+    "Return Profile if the request should be profiled, else None."
+    if wanted(user, headers):
+        return Profile(requestId)
+    return None
@@ -0,0 +1,171 @@
+"""
+Push hub.
+
+One watcher per account polls its state and fans changes out to every
+subscriber, EventSource and WebSocket alike. Subscribers are grouped by
+their type filter, so the filtered change is computed once per group.
+Changes arriving within a short window are coalesced into one StateChange,
+and a subscriber that can't keep up gets its queued changes merged
+instead of growing without bound.
+"""
+import asyncio
+from collections import deque
+import contextlib
+from hashlib import sha256
+import json
+import os
+
+from jmap import metrics
+
+
+PUSH_INTERVAL = float(os.getenv('PUSH_INTERVAL', 5))
+PUSH_COALESCE = float(os.getenv('PUSH_COALESCE', 0.2))
+PUSH_QUEUE_SIZE = int(os.getenv('PUSH_QUEUE_SIZE', 16))
+
+
+def push_state(states) -> str:
+    "Opaque pushState of {accountId: {type: state}}."
+    content = json.dumps(states, sort_keys=True, separators=(',', ':'), default=str)
+    return sha256(content.encode()).hexdigest()[:16]
+
+
+def filter_states(states, types):
+    if types is None:
+        return dict(states)
+    return {typ: state for typ, state in states.items() if typ in types}
+
+
+def merge_changes(into, changed):
+    for accountId, states in changed.items():
+        into.setdefault(accountId, {}).update(states)
+
+
+class Subscription:
+    "Bounded queue of StateChange for one client."
+    def __init__(self, types, maxsize):
+        self.types = types
+        self.maxsize = maxsize
+        self.states = {}
+        self.pending = deque()
+        self.ready = asyncio.Event()
+
+    @property
+    def pushState(self):
+        return push_state(self.states)
+
+    def put(self, changed):
+        merge_changes(self.states, changed)
+        if len(self.pending) >= self.maxsize:
+            # slow consumer, states are latest-wins so merging loses nothing
+            merge_changes(self.pending[-1][0], changed)
+            self.pending[-1] = (self.pending[-1][0], self.pushState)
+            metrics.inc('push_merged_total')
+        else:
+            self.pending.append((changed, self.pushState))
+        self.ready.set()
+
+    async def get(self):
+        "Wait for next change, return (changed, pushState)."
+        while not self.pending:
+            self.ready.clear()
+            await self.ready.wait()
+        return self.pending.popleft()
+
+
+class AccountWatcher:
+    def __init__(self, hub, account):
+        self.hub = hub
+        self.account = account
+        self.states = account.db.get_states()
+        # type filter -> set of Subscription
+        self.subscribers = {}
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    def add(self, sub):
+        self.subscribers.setdefault(sub.types, set()).add(sub)
+
+    def remove(self, sub):
+        subs = self.subscribers.get(sub.types, set())
+        subs.discard(sub)
+        if not subs:
+            self.subscribers.pop(sub.types, None)
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.hub.interval)
+            except asyncio.TimeoutError:
+                pass
+            current = self.account.db.get_states()
+            if current == self.states and not self.wakeup.is_set():
+                continue
+            # let the burst settle, then send one StateChange for all of it
+            await asyncio.sleep(self.hub.coalesce)
+            self.wakeup.clear()
+            current = self.account.db.get_states()
+            changed = {typ: state for typ, state in current.items()
+                       if self.states.get(typ) != state}
+            self.states = current
+            if changed:
+                self.publish(changed)
+
+    def publish(self, changed):
+        metrics.inc('push_state_changes')
+        for types, subs in self.subscribers.items():
+            filtered = filter_states(changed, types)
+            if not filtered:
+                continue
+            for sub in subs:
+                # own copy, put() merges into it when the queue is full
+                sub.put({self.account.id: dict(filtered)})
+
+
+class PushHub:
+    def __init__(self, interval=PUSH_INTERVAL, coalesce=PUSH_COALESCE, queue_size=PUSH_QUEUE_SIZE):
+        self.interval = interval
+        self.coalesce = coalesce
+        self.queue_size = queue_size
+        # account -> AccountWatcher
+        self.watchers = {}
+
+    @contextlib.asynccontextmanager
+    async def subscribe(self, user, types=None, pushState=None):
+        """
+        Subscribe to changes of user's accounts, types None or containing
+        '*' means all types. When pushState is given and differs from
+        the current one, all current states are queued first.
+        """
+        if types is not None and '*' not in types:
+            types = frozenset(types)
+        else:
+            types = None
+        sub = Subscription(types, self.queue_size)
+        watchers = []
+        for account in user.accounts.values():
+            watcher = self.watchers.get(account, None)
+            if watcher is None:
+                watcher = self.watchers[account] = AccountWatcher(self, account)
+            watcher.add(sub)
+            watchers.append(watcher)
+            sub.states[account.id] = filter_states(watcher.states, types)
+        if pushState is not None and pushState != sub.pushState:
+            sub.put({id: dict(states) for id, states in sub.states.items()})
+        try:
+            yield sub
+        finally:
+            for watcher in watchers:
+                watcher.remove(sub)
+                if not watcher.subscribers:
+                    watcher.task.cancel()
+                    self.watchers.pop(watcher.account, None)
+
+    def notify(self, user):
+        "Wake watchers of user's accounts, e.g. after a request changed data."
+        for account in user.accounts.values():
+            watcher = self.watchers.get(account, None)
+            if watcher is not None:
+                watcher.wakeup.set()
+
+
+hub = PushHub()
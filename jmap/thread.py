@@ -1,4 +1,3 @@
-from jmap import errors
 from collections import defaultdict
 
 
@@ -32,33 +31,7 @@ def api_Thread_get(request, accountId, ids: list=None):
 
 def api_Thread_changes(request, accountId, sinceState, maxChanges=None, properties=()):
     account = request.get_account(accountId)
-    newState = account.db.highModSeqThread
-    if sinceState <= str(account.db.lowModSeq):
-        raise errors.cannotCalculateChanges({'new_state': newState})
-    
-    rows = account.db.dget('jthreads', {'jmodseq': ('>', sinceState)},
-                        'thrid,deleted,jcreated')
-    if maxChanges and len(rows) > maxChanges:
-        raise errors.cannotCalculateChanges({'new_state': newState})
-    
-    created = []
-    updated = []
-    removed = []
-    for thrid, deleted, jcreated in rows:
-        if not deleted:
-            if jcreated <= sinceState:
-                updated.append(thrid)
-            else:
-                created.append(thrid)
-        elif jcreated <= sinceState:
-            removed.append(thrid)
-        # else never seen
-    
     return {
         'accountId': accountId,
-        'oldState': sinceState,
-        'newState': newState,
-        'created': created,
-        'updated': updated,
-        'removed': removed,
+        **account.db.get_changes('Thread', sinceState, maxChanges),
     }
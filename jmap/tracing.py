@@ -0,0 +1,206 @@
+"""
+Lightweight tracing.
+
+Spans nest through a context variable and are handed to an exporter
+when they end. Set TRACE_EXPORTER to enable:
+
+    jsonl  one JSON object per span appended to TRACE_FILE
+    otlp   spans batched and POSTed as OTLP/JSON to TRACE_ENDPOINT
+
+When disabled, span() returns a shared no-op span, so instrumented code
+pays one function call and one global lookup.
+"""
+import atexit
+from contextvars import ContextVar
+import json
+import logging as log
+import os
+import queue
+import threading
+import time
+import urllib.request
+
+
+TRACE_EXPORTER = os.getenv('TRACE_EXPORTER', '')
+TRACE_FILE = os.getenv('TRACE_FILE', './traces.jsonl')
+TRACE_ENDPOINT = os.getenv('TRACE_ENDPOINT', 'http://127.0.0.1:4318/v1/traces')
+TRACE_SERVICE = os.getenv('TRACE_SERVICE', 'jmap-proxy')
+
+current_span = ContextVar('current_span', default=None)
+exporter = None
+
+
+class Span:
+    __slots__ = ('name', 'traceId', 'spanId', 'parentSpanId', 'start', 'end',
+                 'attributes', 'error', '_token')
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        if parent is None:
+            parent = current_span.get()
+        if parent is None:
+            self.traceId = os.urandom(16).hex()
+            self.parentSpanId = None
+        else:
+            self.traceId = parent.traceId
+            self.parentSpanId = parent.spanId
+        self.spanId = os.urandom(8).hex()
+        self.attributes = attributes or {}
+        self.error = None
+        self.start = time.time_ns()
+        self.end = None
+        self._token = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def finish(self):
+        "End span started without with statement."
+        self.end = time.time_ns()
+        exporter.export(self)
+
+    def __enter__(self):
+        self._token = current_span.set(self)
+        return self
+
+    def __exit__(self, typ, value, tb):
+        current_span.reset(self._token)
+        if value is not None:
+            self.error = f'{typ.__name__}: {value}'
+        self.finish()
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'traceId': self.traceId,
+            'spanId': self.spanId,
+            'parentSpanId': self.parentSpanId,
+            'start': self.start,
+            'end': self.end,
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+class NoopSpan:
+    __slots__ = ()
+
+    def set_attribute(self, key, value):
+        pass
+
+    def finish(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+NOOP_SPAN = NoopSpan()
+
+
+def span(name, parent=None, **attributes):
+    "Return span to be used in with statement, no-op when tracing is off."
+    if exporter is None:
+        return NOOP_SPAN
+    return Span(name, parent, attributes)
+
+
+def enabled() -> bool:
+    return exporter is not None
+
+
+class JsonLinesExporter:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.file = open(path, 'a', buffering=1)
+
+    def export(self, span):
+        line = json.dumps(span.as_dict(), default=str)
+        with self.lock:
+            self.file.write(line + '\n')
+
+
+class OtlpExporter:
+    "Batches spans in a background thread, POSTs them as OTLP/JSON."
+    def __init__(self, endpoint, batch_size=512, interval=1.0):
+        self.endpoint = endpoint
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = queue.Queue(maxsize=batch_size * 16)
+        self.thread = threading.Thread(target=self.run, name='trace-export', daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def export(self, span):
+        try:
+            self.queue.put_nowait(span)
+        except queue.Full:
+            pass  # never block the request for tracing
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if not batch:
+            return
+        body = json.dumps(otlp_payload(batch), default=str).encode()
+        request = urllib.request.Request(self.endpoint, body, {'Content-Type': 'application/json'})
+        try:
+            urllib.request.urlopen(request, timeout=5).close()
+        except OSError as e:
+            log.warning('Trace export to %s failed: %s', self.endpoint, e)
+
+
+def otlp_payload(spans):
+    return {'resourceSpans': [{
+        'resource': {'attributes': [_otlp_attribute('service.name', TRACE_SERVICE)]},
+        'scopeSpans': [{
+            'scope': {'name': 'jmap.tracing'},
+            'spans': [{
+                'traceId': span.traceId,
+                'spanId': span.spanId,
+                'parentSpanId': span.parentSpanId or '',
+                'name': span.name,
+                'kind': 1,
+                'startTimeUnixNano': str(span.start),
+                'endTimeUnixNano': str(span.end),
+                'attributes': [_otlp_attribute(k, v) for k, v in span.attributes.items()],
+                'status': {'code': 2, 'message': span.error} if span.error else {},
+            } for span in spans],
+        }],
+    }]}
+
+
+def _otlp_attribute(key, value):
+    if isinstance(value, bool):
+        return {'key': key, 'value': {'boolValue': value}}
+    if isinstance(value, int):
+        return {'key': key, 'value': {'intValue': str(value)}}
+    if isinstance(value, float):
+        return {'key': key, 'value': {'doubleValue': value}}
+    return {'key': key, 'value': {'stringValue': str(value)}}
+
+
+def configure(name=TRACE_EXPORTER):
+    "Set exporter by name, '' disables tracing."
+    global exporter
+    if name == 'jsonl':
+        exporter = JsonLinesExporter(TRACE_FILE)
+    elif name == 'otlp':
+        exporter = OtlpExporter(TRACE_ENDPOINT)
+    elif not name:
+        exporter = None
+    else:
+        raise ValueError(f'unknown TRACE_EXPORTER {name!r}')
+
+configure()
@@ -0,0 +1,20 @@
+"""
+JMAP over WebSocket (RFC 8887).
+
+The transport lives in server.py, this module only advertises it.
+"""
+import os
+import re
+
+
+BASEURL = os.getenv('BASEURL', 'http://127.0.0.1:8888')
+
+capabilityValue = {
+    "url": re.sub(r'^http', 'ws', BASEURL) + "/ws/",
+    "supportsPush": True,
+}
+
+
+def register_methods(api):
+    # no methods, requests only name it in "using"
+    pass
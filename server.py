@@ -1,30 +1,97 @@
 import asyncio
+from contextlib import asynccontextmanager, nullcontext
+import hmac
+import logging as log
 import os
+import uuid
+import weakref
 
+# bearer token of /metrics scrapes, without it only local clients get metrics
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+# indented JSON is handy for debugging, but costs CPU and bandwidth
+PRETTY_JSON = os.getenv('PRETTY_JSON', '') not in ('', '0')
 try:
     import orjson as json
-    dumps_kw = {'option': json.OPT_INDENT_2}
+    dumps_kw = {'option': json.OPT_INDENT_2} if PRETTY_JSON else {}
 except ImportError:
     import json
-    dumps_kw = {}
+    dumps_kw = {'indent': 2} if PRETTY_JSON else {'separators': (',', ':')}
 
 from starlette.applications import Starlette
 from starlette.middleware import Middleware
 from starlette.middleware.authentication import AuthenticationMiddleware
 from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
 from starlette.responses import Response, StreamingResponse
-from starlette.routing import Route, Mount
+from starlette.routing import Route, Mount, WebSocketRoute
 from starlette.staticfiles import StaticFiles
 
-from jmap.api import handle_request, CAPABILITIES
+from compression import CompressionMiddleware
+from jmap import errors, maintenance, metrics, profiling, push
+from jmap.api import handle_request, is_request, iter_responses, methods_for
+from jmap.db.imap import shutdown_parse_pool
 from user import BasicAuthBackend
 
 
+def dumps(content) -> bytes:
+    res = json.dumps(content, **dumps_kw)
+    return res.encode() if isinstance(res, str) else res
+
+
 class JSONResponse(Response):
     media_type = "application/json"
 
     def render(self, content) -> bytes:
-        return json.dumps(content, **dumps_kw)
+        return dumps(content)
+
+
+_user_locks = weakref.WeakKeyDictionary()
+
+async def run_methods(user, func, *args):
+    """
+    Run blocking method code in a worker thread, so the event loop keeps
+    serving other requests. Code of one user runs one call at a time,
+    their IMAP connection and caches are not thread-safe.
+    """
+    lock = _user_locks.setdefault(user, asyncio.Lock())
+    async with lock:
+        return await asyncio.to_thread(func, *args)
+
+
+async def render_response(user, data, methods, profile=None):
+    """
+    Render JMAP Response object piece by piece, each method response
+    is serialized as soon as it's done, so only one is in memory.
+    When profiled, the profiler runs only while this request's code does.
+    """
+    running = profile or nullcontext()
+    yield b'{"methodResponses":['
+    responses = iter_responses(user, data, methods)
+
+    def step():
+        # profiler and method code both run in the worker thread
+        with running:
+            response = next(responses, None)
+            return None if response is None else dumps(response)
+
+    n = 0
+    while True:
+        chunk = await run_methods(user, step)
+        if chunk is None:
+            break
+        yield (b',' if n else b'') + chunk
+        n += 1
+    tail = {'sessionState': user.sessionState}
+    if 'createdIds' in data:
+        tail['createdIds'] = data['createdIds']
+    yield b'],' + dumps(tail)[1:]
+    push.hub.notify(user)
+    if profile:
+        profile.save(profiling.method_names(data))
+
+
+def request_id(headers) -> str:
+    return headers.get('x-request-id', None) or uuid.uuid4().hex[:16]
 
 
 async def api(request):
@@ -36,17 +103,46 @@ async def api(request):
             "status": 400,
             "detail": "The content of the request did not parse as JSON."
         }, 400)
-    res = handle_request(request.user, data)
-    return JSONResponse(res)
+    # checked before streaming, once it starts the status is 200
+    if not is_request(data):
+        return JSONResponse({
+            "type": "urn:ietf:params:jmap:error:notRequest",
+            "status": 400,
+            "detail": "The request parsed as JSON but did not match the type signature of the Request object."
+        }, 400)
+    try:
+        methods = methods_for(data['using'])
+    except errors.unknownCapability as e:
+        return JSONResponse({
+            "type": "urn:ietf:params:jmap:error:unknownCapability",
+            "status": 400,
+            "detail": f"Unsupported capability: {e}",
+        }, 400)
+    requestId = request_id(request.headers)
+    profile = profiling.for_request(request.user, request.headers, requestId)
+    return StreamingResponse(
+        render_response(request.user, data, methods, profile),
+        media_type='application/json',
+        headers={'X-Request-Id': requestId},
+    )
 
 
 async def event_stream(request, types, closeafter, ping):
-    while True:
-        if await request.is_disconnected():
-            break
-        if ping:
-            yield 'event: ping\ndata: {"interval":%d}\n\n' % ping
-        await asyncio.sleep(ping or 10)
+    async with push.hub.subscribe(request.user, types) as sub:
+        while True:
+            if await request.is_disconnected():
+                break
+            try:
+                # time out even without pings to notice disconnected clients
+                changed, _ = await asyncio.wait_for(sub.get(), ping if ping > 0 else 10)
+            except asyncio.TimeoutError:
+                if ping > 0:
+                    yield 'event: ping\ndata: {"interval":%d}\n\n' % ping
+                continue
+            data = dumps({'@type': 'StateChange', 'changed': changed}).decode()
+            yield f'event: state\ndata: {data}\n\n'
+            if closeafter == 'state':
+                break
 
 async def event(request):
     try:
@@ -73,48 +169,178 @@ async def event(request):
 
 
 
-BASEURL = os.getenv('BASEURL', 'http://127.0.0.1:8888')
-async def well_known_jmap(request):
+async def push_changes(send, user, types, pushState):
+    "Send StateChange whenever a state changes, until cancelled."
+    async with push.hub.subscribe(user, types, pushState) as sub:
+        while True:
+            changed, pushState = await sub.get()
+            await send({
+                '@type': 'StateChange',
+                'changed': changed,
+                'pushState': pushState,
+            })
+
+
+def websocket_response(user, data):
+    "Process one RFC 8887 Request object, return Response or RequestError."
+    requestId = data.get('id', None) if isinstance(data, dict) else None
+    if not is_request(data) or data.get('@type', None) != 'Request':
+        return request_error(requestId, 'notRequest',
+            'The request parsed as JSON but did not match the type signature of the Request object.')
+    try:
+        res = handle_request(user, data)
+    except errors.unknownCapability as e:
+        return request_error(requestId, 'unknownCapability', f'Unsupported capability: {e}')
+    except Exception as e:
+        log.exception('WebSocket request failed')
+        return request_error(requestId, 'serverFail', str(e), 500)
+    res['@type'] = 'Response'
+    if requestId is not None:
+        res['requestId'] = requestId
+    return res
+
+
+def request_error(requestId, type, detail, status=400):
     res = {
-        "capabilities": {u: c.capabilityValue for u, c in CAPABILITIES.items()},
-        "username": request.user.username,
-        "accounts": {
-            account.id: {
-                "name": account.name,
-                "isPersonal": account.is_personal,
-                "isArchiveUser": False,
-                "accountCapabilities": account.capabilities,
-                "isReadOnly": False
-            } for account in request.user.accounts.values()
-        },
-        "primaryAccounts": {
-            "urn:ietf:params:jmap:submission": request.user.username,
-            "urn:ietf:params:jmap:vacationresponse": request.user.username,
-            "urn:ietf:params:jmap:mail": request.user.username
-        },
-        "state": "0",
-        "apiUrl": BASEURL + "/api/",
-        "downloadUrl": BASEURL + "/download/{accountId}/{blobId}/{name}?type={type}",
-        "uploadUrl": BASEURL + "/upload/{accountId}/",
-        "eventSourceUrl": BASEURL + "/event/"#?types={types}&closeafter={closeafter}&ping={ping}",
+        '@type': 'RequestError',
+        'type': 'urn:ietf:params:jmap:error:' + type,
+        'status': status,
+        'detail': detail,
     }
-    return JSONResponse(res)
+    if requestId is not None:
+        res['requestId'] = requestId
+    return res
+
+
+async def websocket_jmap(websocket):
+    user = websocket.user
+    if not user.is_authenticated:
+        await websocket.close(code=1008)
+        return
+    if 'jmap' not in websocket.scope.get('subprotocols', ()):
+        await websocket.close(code=1002)
+        return
+    await websocket.accept(subprotocol='jmap')
+
+    lock = asyncio.Lock()
+    async def send(message):
+        # requests and push share one socket
+        async with lock:
+            await websocket.send_text(dumps(message).decode())
+
+    pusher = None
+    try:
+        while True:
+            message = await websocket.receive()
+            if message['type'] == 'websocket.disconnect':
+                break
+            text = message.get('text', None)
+            if text is None:
+                text = message.get('bytes', b'').decode('utf-8', 'replace')
+            try:
+                data = json.loads(text)
+            except Exception:
+                await send(request_error(None, 'notJSON',
+                    'The content of the request did not parse as JSON.'))
+                continue
+
+            typ = data.get('@type', None) if isinstance(data, dict) else None
+            if typ == 'WebSocketPushEnable':
+                if pusher:
+                    pusher.cancel()
+                types = data.get('dataTypes', None)
+                pusher = asyncio.create_task(push_changes(
+                    send, user, types, data.get('pushState', None)))
+            elif typ == 'WebSocketPushDisable':
+                if pusher:
+                    pusher.cancel()
+                    pusher = None
+            else:
+                requestId = data.get('id', None) if isinstance(data, dict) else None
+                requestId = str(requestId or request_id(websocket.headers))
+                profile = profiling.for_request(user, websocket.headers, requestId)
+
+                def respond():
+                    with profile or nullcontext():
+                        return websocket_response(user, data)
+
+                res = await run_methods(user, respond)
+                if res['@type'] == 'Response':
+                    push.hub.notify(user)
+                if profile:
+                    profile.save(profiling.method_names(data))
+                await send(res)
+    finally:
+        if pusher:
+            pusher.cancel()
+
+
+async def well_known_jmap(request):
+    user = request.user
+    etag = f'"{user.sessionState}"'
+    headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+    if if_none_match(request.headers.get('if-none-match', ''), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(user.session_json, media_type='application/json', headers=headers)
+
+
+def if_none_match(header: str, etag: str) -> bool:
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag == '*' or tag.removeprefix('W/') == etag:
+            return True
+    return False
+
+
+async def metrics_endpoint(request):
+    if METRICS_TOKEN:
+        scheme, _, token = request.headers.get('authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or not hmac.compare_digest(token, METRICS_TOKEN):
+            return Response('Unauthorized', 401, {'WWW-Authenticate': 'Bearer'})
+    elif not request.client or request.client.host not in ('127.0.0.1', '::1'):
+        return Response('Forbidden', 403)
+    return Response(metrics.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class MetricsMiddleware:
+    "Serve /metrics ahead of authentication, scrapers have no IMAP credentials."
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] != '/metrics':
+            return await self.app(scope, receive, send)
+        response = await metrics_endpoint(Request(scope, receive))
+        await response(scope, receive, send)
 
 
 routes = [
     Route('/api/', api, methods=["GET", "POST"]),
     Route('/event/', event),
+    WebSocketRoute('/ws/', websocket_jmap),
     Route('/.well-known/jmap', well_known_jmap),
     Mount('/', StaticFiles(directory="web", html=True)),
 ]
 
 middleware = [
+    Middleware(CompressionMiddleware, minimum_size=int(os.getenv('COMPRESS_MIN_SIZE', 1024))),
     Middleware(CORSMiddleware, allow_origins=['*'], allow_headers=['authorization'], allow_methods=['*']),
+    Middleware(MetricsMiddleware),
     Middleware(AuthenticationMiddleware, backend=BasicAuthBackend()),
 ]
 
+@asynccontextmanager
+async def lifespan(app):
+    async with maintenance.lifespan(app):
+        try:
+            yield
+        finally:
+            shutdown_parse_pool()
+
+
 app = Starlette(
     debug=True,
     routes=routes,
     middleware=middleware,
+    lifespan=lifespan,
 )
@@ -1,6 +1,7 @@
 import pytest
-from jmap.api import handle_request
+from jmap.api import _object_count, handle_request, is_request, iter_responses
 from random import random
+from types import SimpleNamespace
 
 import orjson as json
 
@@ -411,3 +412,96 @@ def test_Mailbox_changes(db, user):
         if tag == '0':
             assert len(response['list']) > 0
     assert json.dumps(res)
+
+
+def test_evaluate_path():
+    from jmap import errors
+    from jmap.api import compile_path, evaluate_path
+    result = {
+        'ids': ['a', 'b'],
+        'list': [
+            {'threadId': 't1', 'emailIds': ['e1', 'e2']},
+            {'threadId': 't2', 'emailIds': ['e3']},
+        ],
+        'a/b~c': 1,
+    }
+    assert evaluate_path(compile_path('/ids'), result) == ['a', 'b']
+    assert evaluate_path(compile_path('/list/*/threadId'), result) == ['t1', 't2']
+    assert evaluate_path(compile_path('/list/*/emailIds'), result) == ['e1', 'e2', 'e3']
+    assert evaluate_path(compile_path('/list/1/emailIds/0'), result) == 'e3'
+    assert evaluate_path(compile_path('/a~1b~0c'), result) == 1
+    assert compile_path('/list/*/threadId') is compile_path('/list/*/threadId')
+    for path in ('/ids/²', '/ids/٣', '/ids/2', '/ids/x'):
+        with pytest.raises(errors.invalidResultReference):
+            evaluate_path(compile_path(path), result)
+
+
+def test_invalid_result_reference(user):
+    res = handle_request(user, {
+        "using": ["urn:ietf:params:jmap:core"],
+        "methodCalls": [
+            ["Core/echo", {"list": [{"id": "1"}]}, "0"],
+            ["Core/echo", {"#ids": {"resultOf": "0", "name": "Core/echo", "path": "/list/*/id"}}, "1"],
+            ["Core/echo", {"#ids": {"resultOf": "0", "name": "Core/echo", "path": "/nope"}}, "2"],
+            ["Core/echo", {"#ids": {"resultOf": "9", "name": "Core/echo", "path": "/list"}}, "3"],
+            ["Core/echo", {"#ids": {"resultOf": "0", "name": "Email/get", "path": "/list"}}, "4"],
+        ]
+    })
+    responses = res['methodResponses']
+    assert responses[1] == ("Core/echo", {"ids": ["1"]}, "1")
+    for method, response, tag in responses[2:]:
+        assert method == 'error'
+        assert response['type'] == 'invalidResultReference'
+
+
+def test_failing_method_does_not_stop_request():
+    def boom(api, **kwargs):
+        raise RuntimeError('boom')
+
+    def echo(api, **kwargs):
+        return kwargs
+
+    methods = {'Test/boom': boom, 'Test/echo': echo}
+    user = SimpleNamespace(sessionState='0')
+    responses = list(iter_responses(user, {
+        "using": [],
+        "methodCalls": [
+            ["Test/boom", {}, "0"],
+            ["Test/echo", {"a": 1}, "1"],
+        ]
+    }, methods))
+    assert responses[0] == ('error', {'type': 'serverFail', 'description': 'boom'}, '0')
+    assert responses[1] == ('Test/echo', {'a': 1}, '1')
+
+
+def test_unhashable_result_reference_path():
+    def echo(api, **kwargs):
+        return kwargs
+
+    user = SimpleNamespace(sessionState='0')
+    responses = list(iter_responses(user, {
+        "using": [],
+        "methodCalls": [
+            ["Test/echo", {"ids": ["a"]}, "0"],
+            ["Test/echo", {"#ids": {"resultOf": "0", "path": ["ids"]}}, "1"],
+            ["Test/echo", {"#ids": {"resultOf": "0", "path": {}}}, "2"],
+            ["Test/echo", {"#ids": "0"}, "3"],
+        ]
+    }, {'Test/echo': echo}))
+    for method, response, tag in responses[1:]:
+        assert method == 'error'
+        assert response['type'] == 'invalidResultReference'
+
+
+def test_is_request():
+    assert is_request({"using": [], "methodCalls": [["Core/echo", {}, "0"]]})
+    assert not is_request([])
+    assert not is_request({"using": [], "methodCalls": {}})
+    assert not is_request({"using": [], "methodCalls": [["Core/echo", {}]]})
+    assert not is_request({"using": [], "methodCalls": [["Core/echo", [], "0"]]})
+
+
+def test_object_count():
+    assert _object_count({'list': [1, 2]}) == 2
+    assert _object_count({'created': ['a'], 'updated': ['b'], 'destroyed': ['c', 'd']}) == 4
+    assert _object_count({'accountId': 'u1'}) is None
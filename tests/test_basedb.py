@@ -0,0 +1,217 @@
+import json
+import sqlite3
+import threading
+
+import pytest
+
+from jmap import errors
+from jmap.db import storage
+from jmap.db.base import MAILBOX_COUNTS, BaseDB
+from jmap.db.migrations import migrate
+
+
+def message(i, thrid, isUnread=True, isDraft=False, inReplyTo=None):
+    return {
+        'msgid': f'm{i}',
+        'thrid': thrid,
+        'isDraft': isDraft,
+        'isUnread': isUnread,
+        'keywords': {},
+        'messageId': f'<{i}@example.com>',
+        'inReplyTo': inReplyTo,
+    }
+
+
+def test_bulk_add_message(tmp_path):
+    db = BaseDB('bulk', path=str(tmp_path))
+    db.dmake('jmailboxes', {'jmailboxid': 'inbox', 'name': 'Inbox'})
+    with db.bulk(chunk_size=2):
+        db.add_message(message(1, 't1', isUnread=False), ['inbox'])
+        db.add_message(message(2, 't1', isDraft=True, inReplyTo='<1@example.com>'), ['inbox'])
+        db.add_message(message(3, 't2', isUnread=False), ['inbox'])
+        db.add_message(message(4, 't1', isUnread=False), ['inbox'])
+    assert not db.backfilling
+
+    threads = {row['thrid']: json.loads(row['data']) for row in db.dget('jthreads')}
+    assert threads == {'t1': ['m1', 'm2', 'm4'], 't2': ['m3']}
+    mailbox = db.dgetone('jmailboxes', {'jmailboxid': 'inbox'})
+    assert mailbox['totalEmails'] == 4
+    assert mailbox['unreadEmails'] == 1
+    assert mailbox['totalThreads'] == 2
+    assert mailbox['unreadThreads'] == 1
+
+
+def test_storage_profile(tmp_path):
+    db = BaseDB('profile', path=str(tmp_path), profile='fast')
+    assert db.dbh.execute('PRAGMA synchronous').fetchone()[0] == 1  # NORMAL
+    assert db.dbh.execute('PRAGMA cache_size').fetchone()[0] == -65536
+
+    assert storage.pragmas('safe', {'cache_size': -4096})['cache_size'] == -4096
+    with pytest.raises(ValueError):
+        storage.pragmas('safe', {'cache_size': '1; DROP TABLE jmessages'})
+    with pytest.raises(ValueError):
+        storage.pragmas('reckless')
+
+
+def test_reads_do_not_wait_for_writer(tmp_path):
+    db = BaseDB('concurrent', path=str(tmp_path))
+    db.dmake('jmailboxes', {'jmailboxid': 'inbox', 'name': 'Inbox'})
+    started, release = threading.Event(), threading.Event()
+
+    def slow_sync():
+        db.dupdate('jmailboxes', {'name': 'Renamed'}, {'jmailboxid': 'inbox'})
+        started.set()
+        release.wait(5)
+
+    future = db.writer.submit(slow_sync)
+    assert started.wait(5)
+    # last committed state, while the sync transaction is open
+    assert db.dgetone('jmailboxes', {'jmailboxid': 'inbox'}, 'name')['name'] == 'Inbox'
+    release.set()
+    future.result(5)
+    assert db.dgetone('jmailboxes', {'jmailboxid': 'inbox'}, 'name')['name'] == 'Renamed'
+
+
+def test_group_commit_isolates_failing_job(tmp_path):
+    db = BaseDB('group', path=str(tmp_path))
+    release = threading.Event()
+    blocker = db.writer.submit(release.wait, 5)
+
+    def fail():
+        db.dmake('jmailboxes', {'jmailboxid': 'bad', 'name': 'Bad'})
+        raise ValueError('failed job')
+
+    futures = [
+        db.writer.submit(db.dmake, 'jmailboxes', {'jmailboxid': 'a', 'name': 'A'}),
+        db.writer.submit(fail),
+        db.writer.submit(db.dmake, 'jmailboxes', {'jmailboxid': 'b', 'name': 'B'}),
+    ]
+    release.set()
+    blocker.result(5)
+    futures[0].result(5)
+    futures[2].result(5)
+    with pytest.raises(ValueError):
+        futures[1].result(5)
+    assert sorted(db.dgetcol('jmailboxes', {}, 'jmailboxid')) == ['a', 'b']
+
+
+def test_migrations(tmp_path):
+    db = BaseDB('migrations', path=str(tmp_path))
+    applied = [(row['component'], row['version']) for row in db.dget('jmigrations')]
+    assert applied == [('base', 1), ('base', 2), ('base', 3), ('base', 4)]
+    with db.reading() as cursor:
+        plan = cursor.execute('EXPLAIN QUERY PLAN SELECT msgid FROM jmessages WHERE jmodseq > ?', [1]).fetchall()
+    assert 'jmessages_jmodseq' in plan[0][3]
+    db.close()
+
+    # applied ones are skipped, new ones run once
+    steps = ['CREATE TABLE extra (id INTEGER)']
+    components = {'base': BaseDB.MIGRATIONS['base'], 'extra': [(1, 'extra table', steps)]}
+    with sqlite3.connect(str(tmp_path / 'migrations.db'), isolation_level=None) as dbh:
+        assert migrate(dbh.cursor(), components) == ['extra 1: extra table']
+        assert migrate(dbh.cursor(), components) == []
+
+
+def test_changes_pages(tmp_path):
+    db = BaseDB('changes', path=str(tmp_path))
+    db.dmake('jmailboxes', {'jmailboxid': 'inbox', 'name': 'Inbox'})
+    state = db.get_states()['Email']
+    with db.bulk(chunk_size=3):
+        for i in range(7):
+            db.add_message(message(i, f't{i // 2}'), ['inbox'])
+
+    pages = []
+    since = state
+    while True:
+        res = db.get_changes('Email', since, maxChanges=3)
+        pages.append(res['created'])
+        since = res['newState']
+        if not res['hasMoreChanges']:
+            break
+    assert pages == [['m0', 'm1', 'm2'], ['m3', 'm4', 'm5'], ['m6']]
+    assert since == db.get_states()['Email']
+
+    db.change_message('m1', {'keywords': {'seen': True}}, ['inbox'])
+    db.delete_message('m2')
+    db.dmake('jmessages', {**message(9, 't9'), 'keywords': '{}'})
+    db.dnuke('jmessages', {'msgid': 'm9'})
+    res = db.get_changes('Email', since)
+    assert (res['created'], res['updated'], res['destroyed']) == ([], ['m1'], ['m2'])
+    res = db.get_changes('Mailbox', since)
+    assert res['updated'] == ['inbox']
+    assert res['updatedProperties'] == ['totalEmails', 'unreadEmails', 'totalThreads', 'unreadThreads']
+
+    with pytest.raises(errors.cannotCalculateChanges):
+        db.get_changes('Email', 'bogus')
+
+
+def test_compact(tmp_path):
+    db = BaseDB('compact', path=str(tmp_path))
+    db.dmake('jmailboxes', {'jmailboxid': 'inbox', 'name': 'Inbox'})
+    old = db.get_states()['Email']
+    with db.bulk():
+        for i in range(20):
+            db.add_message({**message(i, f't{i // 2}'), 'subject': 'x' * 2000}, ['inbox'])
+    db.write(lambda: [db.delete_message(f'm{i}') for i in range(15)])
+    since = db.get_states()['Email']
+
+    res = db.compact(retention_days=1)
+    assert res['lowModSeq'] is None
+    assert db.dgetcol('jmessages', {}, 'COUNT(*)') == [20]
+
+    res = db.compact(retention_days=0, batch=4)
+    assert res['lowModSeq'] == int(since)
+    assert res['purged']['jmessages'] == 15
+    assert res['purged']['jmessagemap'] == 15
+    assert db.dgetcol('jmessages', {}, 'msgid') == ['m15', 'm16', 'm17', 'm18', 'm19']
+    assert res['vacuumed'] > 0
+    assert db.dbh.execute('PRAGMA freelist_count').fetchone()[0] == 0
+    with pytest.raises(errors.cannotCalculateChanges):
+        db.get_changes('Email', old)
+    assert db.get_changes('Email', since)['created'] == []
+
+
+def test_mailbox_counts(tmp_path):
+    db = BaseDB('counts', path=str(tmp_path))
+    for jmailboxid in ('inbox', 'archive'):
+        db.dmake('jmailboxes', {'jmailboxid': jmailboxid, 'name': jmailboxid})
+    db.add_message(message(1, 't1'), ['inbox'])
+    db.add_message(message(2, 't1', isUnread=False), ['inbox', 'archive'])
+    db.add_message(message(3, 't2', isUnread=False), ['inbox'])
+
+    def counts():
+        "Stored counts, checked against counting all messages."
+        stored = {row['jmailboxid']: [row[name] for name in MAILBOX_COUNTS]
+                  for row in db.dget('jmailboxes')}
+        counted = db.mailbox_counts(stored)
+        assert stored == {id: [c[name] for name in MAILBOX_COUNTS] for id, c in counted.items()}
+        return stored
+
+    assert counts() == {'inbox': [3, 1, 2, 1], 'archive': [1, 0, 1, 1]}
+    db.change_message('m1', {'keywords': {'seen': True}}, ['inbox'])
+    assert counts() == {'inbox': [3, 0, 2, 0], 'archive': [1, 0, 1, 0]}
+    db.change_message('m3', {'keywords': {}}, ['archive'])
+    assert counts() == {'inbox': [2, 0, 1, 0], 'archive': [2, 1, 2, 1]}
+    db.delete_message('m3')
+    assert counts() == {'inbox': [2, 0, 1, 0], 'archive': [1, 0, 1, 0]}
+
+    db.write(db.cursor.execute, "UPDATE jmailboxes SET totalEmails = 7 WHERE jmailboxid = 'inbox'")
+    db.write(db.cursor.execute, "DELETE FROM jmailboxthreads WHERE jmailboxid = 'archive'")
+    repaired = db.verify_mailbox_counts()
+    assert list(repaired) == ['inbox']
+    assert repaired['inbox'][0]['totalEmails'] == 7
+    assert db.verify_mailbox_counts() == {}
+    db.change_message('m2', {'keywords': {}}, ['inbox', 'archive'])
+    assert counts() == {'inbox': [2, 1, 1, 1], 'archive': [1, 1, 1, 1]}
+
+
+def test_open_blob_returns_reader(tmp_path):
+    db = BaseDB('blobs', path=str(tmp_path))
+    blobId = db.put_file('blobs', 'text/plain', b'hello world', None)['blobId']
+    connect, opened = db.readers.connect, []
+    db.readers.connect = lambda: opened.append(1) or connect()
+    for _ in range(10):
+        typ, size, open = db.open_blob(blobId)
+        with open() as blob:
+            assert (typ, size, blob.read()) == ('text/plain', 11, b'hello world')
+    assert len(opened) <= 1
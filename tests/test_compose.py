@@ -0,0 +1,38 @@
+from datetime import datetime, timezone
+import io
+
+from jmap import compose, mime
+
+
+def test_make():
+    content = bytes(range(256)) * 1000 + b'tail'
+    blobs = {'f-1': ('application/pdf', len(content), lambda: io.BytesIO(content))}
+    message = compose.make({
+        'from': [{'name': 'Jos\xe9', 'email': 'jose@example.com'}],
+        'to': [{'name': None, 'email': 'jane@example.com'}],
+        'subject': 'Caf\xe9',
+        'msgdate': datetime(2020, 1, 2, 3, 4, 5, tzinfo=timezone.utc),
+        'headers': {'Message-ID': '<1@example.com>'},
+        'textBody': 'Hello\nworld',
+        'htmlBody': '<p>Hello</p>',
+        'attachments': [{'blobId': 'f-1', 'type': None, 'name': 'na\xefve.pdf', 'cid': None}],
+    }, blobs.get)
+    raw = bytes(message)
+    assert len(raw) == len(message)
+    assert message.has_attachment
+
+    root = mime.parse(raw)
+    assert root.type == 'multipart/mixed'
+    alternative, attachment = root.subParts
+    assert alternative.subParts[0].text()[0] == 'Hello\r\nworld\r\n'
+    assert alternative.subParts[1].type == 'text/html'
+    assert attachment.type == 'application/pdf'
+    assert attachment.name == 'na\xefve.pdf'
+    assert attachment.size == len(content)
+    assert attachment.content() == content
+
+
+def test_base64_length():
+    for size in (0, 1, 56, 57, 58, 57 * 1024, 57 * 1024 + 1):
+        blob = compose.Base64Blob(lambda: io.BytesIO(b'x' * size), size)
+        assert len(b''.join(blob)) == len(blob)
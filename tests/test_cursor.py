@@ -0,0 +1,35 @@
+import logging
+import sqlite3
+
+from jmap import metrics
+from jmap.db import cursor
+from jmap.db.cursor import InstrumentedCursor, classify, log_level
+
+
+def test_log_level():
+    assert log_level('info') == logging.INFO
+    assert log_level('5') == 5
+    assert log_level('bogus') == logging.DEBUG
+
+
+def test_classify():
+    assert classify('SELECT a FROM `jmessages` WHERE x=?') == \
+        ('select', 'jmessages', 'SELECT a FROM `jmessages` WHERE x=?')
+    assert classify('UPDATE OR IGNORE jthreads\n  SET a=1')[:2] == ('update', 'jthreads')
+    assert classify('PRAGMA optimize')[:2] == ('pragma', '')
+
+
+def test_instrumented_cursor(monkeypatch, caplog):
+    dbh = sqlite3.connect(':memory:')
+    cur = dbh.cursor(InstrumentedCursor)
+    cur.execute('CREATE TABLE t (a INTEGER)')
+    before = metrics.COUNTERS['sql_statements_total', (('op', 'insert'), ('table', 't'))]
+    cur.executemany('INSERT INTO t VALUES (?)', [(1,), (2,)])
+    assert metrics.COUNTERS['sql_statements_total', (('op', 'insert'), ('table', 't'))] == before + 1
+
+    monkeypatch.setattr(cursor, 'SQL_SLOW_MS', 0)
+    with caplog.at_level(logging.WARNING, logger='jmap.sql'):
+        assert cur.execute('SELECT a FROM t WHERE a > ?', [1]).fetchall() == [(2,)]
+    slow = [r for r in caplog.records if r.levelno == logging.WARNING]
+    assert 'Slow statement' in slow[0].getMessage()
+    assert 'SCAN t' in slow[0].getMessage()
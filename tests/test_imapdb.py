@@ -1,7 +1,87 @@
-from jmap.db import ImapDB
+from base64 import b64encode
+
+from imapclient.response_types import BodyData
+
+from jmap.db import BaseDB, ImapDB
+from jmap.db.imap import first_text_section
 
 
 def test_init():
     username = 'u1'
     db = ImapDB(username)
     assert db.accountid == username
+
+
+def text_part(subtype, params=(b'charset', b'utf-8'), encoding=b'7bit'):
+    return (b'text', subtype, params, None, None, encoding, 100, 3, None, None, None, None)
+
+
+IMAGE = (b'image', b'png', (b'name', b'a.png'), None, None, b'base64', 500, None, None, None, None)
+NESTED = BodyData.create((
+    (text_part(b'plain', encoding=b'quoted-printable'), text_part(b'html'), b'alternative'),
+    IMAGE,
+    b'mixed',
+))
+HTML_ONLY = BodyData.create((
+    IMAGE,
+    text_part(b'html', (b'charset', b'iso-8859-1'), b'base64'),
+    b'mixed',
+))
+NO_TEXT = BodyData.create((
+    IMAGE,
+    text_part(b'plain', (b'name', b'notes.txt')),
+    b'mixed',
+))
+
+
+def test_first_text_section():
+    assert first_text_section(NESTED) == ('1.1', 'plain', 'utf-8', 'quoted-printable')
+    assert first_text_section(HTML_ONLY) == ('2', 'html', 'iso-8859-1', 'base64')
+    assert first_text_section(NO_TEXT) is None
+    assert first_text_section(BodyData.create(IMAGE)) is None
+    assert first_text_section(BodyData.create(text_part(b'plain'))) == ('1', 'plain', 'utf-8', '7bit')
+
+
+class FakeImap:
+    def __init__(self, structures, bodies):
+        self.structures = structures
+        self.bodies = bodies
+        self.fetches = []
+
+    def fetch(self, uids, items):
+        self.fetches.append((sorted(uids), items))
+        if items == ['BODYSTRUCTURE']:
+            return {uid: {b'BODYSTRUCTURE': self.structures[uid]} for uid in uids}
+        section = items[0][len('BODY.PEEK'):].split('<')[0]
+        return {uid: {b'BODY' + section.encode() + b'<0>': self.bodies[uid]} for uid in uids}
+
+
+def test_fill_previews(tmp_path):
+    db = ImapDB.__new__(ImapDB)
+    BaseDB.__init__(db, 'previews', path=str(tmp_path))
+    db.put_previews({'stored': 'from the mirror'})
+    db.imap = FakeImap(
+        {1: NESTED, 2: NO_TEXT, 3: HTML_ONLY},
+        {1: b'Caf=C3=A9 au\r\n  lait', 3: b64encode('<p>Caf\xe9</p>'.encode('iso-8859-1'))},
+    )
+    messages = [
+        {'UID': 0, 'blobId': 'server', 'PREVIEW': b'from the server'},
+        {'UID': 4, 'blobId': 'stored'},
+        {'UID': 1, 'blobId': 'nested'},
+        {'UID': 2, 'blobId': 'notext'},
+        {'UID': 3, 'blobId': 'html'},
+    ]
+    db.fill_previews(messages)
+    assert [msg['preview'] for msg in messages] == \
+        ['from the server', 'from the mirror', 'Caf\xe9 au lait', '', 'Caf\xe9']
+    assert db.imap.fetches == [
+        ([1, 2, 3], ['BODYSTRUCTURE']),
+        ([1], ['BODY.PEEK[1.1]<0.1024>']),
+        ([3], ['BODY.PEEK[2]<0.16384>']),
+    ]
+
+    # made previews are stored, next time no FETCH is needed
+    again = [{'UID': uid, 'blobId': blobId} for uid, blobId in ((0, 'server'), (1, 'nested'), (3, 'html'))]
+    db.fill_previews(again)
+    assert [msg['preview'] for msg in again] == ['from the server', 'Caf\xe9 au lait', 'Caf\xe9']
+    assert len(db.imap.fetches) == 3
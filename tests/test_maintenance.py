@@ -0,0 +1,44 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+from jmap import maintenance, metrics
+
+
+def counter(name, **labels):
+    return metrics.COUNTERS[name, tuple(sorted(labels.items()))]
+
+
+def test_run_job():
+    db = SimpleNamespace(accountid='u1')
+    runs = counter('maintenance_runs_total', job='test_ok')
+    errors = counter('maintenance_errors_total', job='test_fail')
+
+    def fail(db):
+        raise RuntimeError('disk full')
+
+    asyncio.run(maintenance.run_job('test_ok', lambda db: {'done': db.accountid}, db))
+    asyncio.run(maintenance.run_job('test_fail', fail, db))
+    assert counter('maintenance_runs_total', job='test_ok') == runs + 1
+    assert counter('maintenance_errors_total', job='test_fail') == errors + 1
+    assert counter('maintenance_runs_total', job='test_fail') == 0
+    key = ('maintenance_duration_seconds', (('job', 'test_ok'),))
+    assert metrics.HISTOGRAMS[key].count >= 1
+
+
+def test_run_all_concurrently():
+    fast_done = threading.Event()
+    done = []
+
+    def job(db):
+        if db.accountid == 'slow':
+            # only finishes when the other database isn't queued behind it
+            assert fast_done.wait(5)
+        else:
+            fast_done.set()
+        done.append(db.accountid)
+
+    databases = [SimpleNamespace(accountid='slow'), SimpleNamespace(accountid='fast')]
+    asyncio.run(maintenance.run_all('test_concurrent', job, databases, concurrency=2))
+    assert done == ['fast', 'slow']
+    assert counter('maintenance_errors_total', job='test_concurrent') == 0
@@ -0,0 +1,39 @@
+import threading
+
+from jmap import metrics
+
+
+def test_histogram_buckets():
+    histogram = metrics.Histogram((1, 5))
+    for value in (0.5, 1, 3, 10):
+        histogram.observe(value)
+    assert histogram.counts == [2, 1, 1]
+    assert histogram.count == 4
+    assert histogram.sum == 14.5
+
+
+def test_render():
+    metrics.inc('test_total', 2, command='FETCH')
+    metrics.observe('test_seconds', 0.003, (0.001, 0.01), method='Email/get')
+    text = metrics.render()
+    assert '# TYPE test_total counter' in text
+    assert 'test_total{command="FETCH"} 2' in text
+    assert 'test_seconds_bucket{method="Email/get",le="0.001"} 0' in text
+    assert 'test_seconds_bucket{method="Email/get",le="0.01"} 1' in text
+    assert 'test_seconds_bucket{method="Email/get",le="+Inf"} 1' in text
+    assert 'test_seconds_count{method="Email/get"} 1' in text
+
+
+def test_concurrent_updates():
+    def work():
+        for _ in range(2000):
+            metrics.inc('test_threads_total')
+            metrics.observe('test_threads_seconds', 0.002)
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert metrics.snapshot()['test_threads_total'] == 16000
+    assert 'test_threads_seconds_count 16000' in metrics.render()
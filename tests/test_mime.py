@@ -0,0 +1,100 @@
+from base64 import b64encode
+
+from jmap import mime, parse
+
+
+ATTACHMENT = bytes(range(256)) * 40
+
+MESSAGE = b'\r\n'.join([
+    b'From: "Joe" <joe@example.com>',
+    b'To: jane@example.com',
+    b'Subject: =?utf-8?q?Caf=C3=A9?=',
+    b'MIME-Version: 1.0',
+    b'Content-Type: multipart/mixed; boundary="outer"',
+    b'',
+    b'preamble',
+    b'--outer',
+    b'Content-Type: multipart/alternative; boundary=inner',
+    b'',
+    b'--inner',
+    b'Content-Type: text/plain; charset=utf-8',
+    b'Content-Transfer-Encoding: quoted-printable',
+    b'',
+    b'Caf=C3=A9 au lait, long line =',
+    b'continues here',
+    b'--inner',
+    b'Content-Type: text/html; charset="iso-8859-1"',
+    b'',
+    b'<p>Caf\xe9</p>',
+    b'--inner--',
+    b'--outer',
+    b'Content-Type: application/octet-stream',
+    b"Content-Disposition: attachment; filename*=utf-8''na%C3%AFve.bin",
+    b'Content-Transfer-Encoding: base64',
+    b'',
+    b64encode(ATTACHMENT),
+    b'--outer--',
+    b'epilogue',
+])
+
+
+def test_part_tree():
+    root = mime.parse(MESSAGE)
+    assert root.type == 'multipart/mixed'
+    alternative, attachment = root.subParts
+    assert alternative.type == 'multipart/alternative'
+    assert [p.partId for p in alternative.subParts] == ['1.1', '1.2']
+    assert alternative.subParts[1].charset == 'iso-8859-1'
+    assert attachment.partId == '2'
+    assert attachment.disposition == 'attachment'
+    assert attachment.name == 'na\xefve.bin'
+
+
+def test_sizes_without_decoding():
+    root = mime.parse(MESSAGE)
+    text = root.subParts[0].subParts[0]
+    assert text.size == len(text.content())
+    assert root.subParts[1].size == len(ATTACHMENT)
+    assert root.subParts[1].content() == ATTACHMENT
+
+
+def test_lazy_text():
+    text = mime.parse(MESSAGE).subParts[0].subParts[0]
+    assert text.text() == ('Caf\xe9 au lait, long line continues here', False, False)
+    assert text.text(4) == ('Caf', False, True)
+    html = mime.parse(MESSAGE).subParts[0].subParts[1]
+    assert html.text()[0] == '<p>Caf\xe9</p>'
+
+
+def test_partial_base64():
+    attachment = mime.parse(MESSAGE).subParts[1]
+    assert attachment.content(100) == ATTACHMENT[:100]
+
+
+def test_single_part():
+    root = mime.parse(b'Subject: hi\r\n\r\nhello\r\n')
+    assert root.partId == '1'
+    assert root.type == 'text/plain'
+    assert root.charset == 'us-ascii'
+    assert root.text()[0] == 'hello\r\n'
+
+
+def test_parse():
+    res = parse.parse(MESSAGE, 'm1')
+    assert res['subject'] == 'Caf\xe9'
+    assert res['from'] == [{'name': 'Joe', 'email': 'joe@example.com'}]
+    assert [p['partId'] for p in res['textBody']] == ['1.1']
+    assert [p['partId'] for p in res['htmlBody']] == ['1.2']
+    assert [p['blobId'] for p in res['attachments']] == ['m1-2']
+    assert res['bodyValues']['1.2']['value'] == '<p>Caf\xe9</p>'
+
+
+def test_html_only_text_body_values():
+    root = mime.parse(b'Content-Type: text/html; charset=utf-8\r\n\r\n<p>Caf\xc3\xa9 cr\xc3\xa8me</p>')
+    values = parse.select_bodyvalues(root, fetchText=True)
+    assert values['1']['value'] == '<p>Caf\xe9 cr\xe8me</p>'
+    assert values['1']['type'] == 'text/html'
+    # limit is in UTF-8 octets, a value of exactly limit octets is whole
+    assert not parse.select_bodyvalues(root, fetchText=True, limit=19)['1']['isTruncated']
+    res = parse.select_bodyvalues(root, fetchText=True, limit=7)['1']
+    assert (res['value'], res['isTruncated']) == ('<p>Caf', True)
@@ -0,0 +1,75 @@
+import threading
+
+from jmap.parse import PREVIEW_LENGTH, HeaderCache, asAddresses, asText, decode_headers, htmltotext, preview
+
+
+def test_htmltotext():
+    html = '''<html><head><title>T</title><style>p {color: red}</style></head>
+    <body><p>Hello&nbsp;<b>world</b> &amp; you</p>
+    <script>document.write("<p>hidden</p>")</script>
+    <div>Line 1<br>Line 2</div> a < b <!-- comment --> c</body></html>'''
+    assert htmltotext(html) == 'Hello world & you\n\nLine 1\nLine 2\na < b c'
+
+
+def test_htmltotext_limit():
+    html = '<p>' + 'word ' * 10000 + '</p>'
+    assert htmltotext(html, 9) == 'word word'
+
+
+def test_htmltotext_unclosed():
+    assert htmltotext('text <script>never closed') == 'text'
+    assert htmltotext('<p>text <a href="x"') == 'text'
+
+
+def test_preview():
+    bodyValues = {
+        '1': {'type': 'text/html', 'value': '<p>html</p>'},
+        '2': {'type': 'text/plain', 'value': 'plain\r\n\r\n  text ' + 'x' * 1000},
+    }
+    res = preview(bodyValues)
+    assert res.startswith('plain text xxx')
+    assert len(res) == PREVIEW_LENGTH
+    assert preview({'1': bodyValues['1']}) == 'html'
+    assert preview({}) is None
+
+
+def test_header_cache():
+    cache = HeaderCache(2)
+    raw = '"Joe" <joe@example.com>'
+    assert cache.decode(asAddresses, raw) == [{'name': 'Joe', 'email': 'joe@example.com'}]
+    value = cache.decode(asAddresses, raw)
+    value[0]['name'] = 'changed'
+    assert cache.decode(asAddresses, raw) == [{'name': 'Joe', 'email': 'joe@example.com'}]
+    assert (cache.hits, cache.misses) == (2, 1)
+    cache.decode(asText, raw)
+    cache.decode(asText, 'other')
+    assert len(cache.data) == 2
+    assert (asAddresses, raw) not in cache.data
+
+
+def test_decode_headers():
+    values = decode_headers(asText, ['=?utf-8?q?Caf=C3=A9?=', None, '=?utf-8?q?Caf=C3=A9?='])
+    assert values == ['Caf\xe9', None, 'Caf\xe9']
+
+
+def test_header_cache_threads():
+    cache = HeaderCache(50)
+    raws = [f'"User {i}" <u{i}@example.com>' for i in range(200)]
+    failed = []
+
+    def decode():
+        try:
+            for _ in range(20):
+                for raw in raws:
+                    assert cache.decode(asAddresses, raw)[0]['email'] in raw
+        except Exception as e:
+            failed.append(e)
+
+    threads = [threading.Thread(target=decode) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not failed
+    assert len(cache.data) == 50
+    assert cache.hits + cache.misses == 8 * 20 * 200
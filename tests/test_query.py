@@ -0,0 +1,25 @@
+from jmap.db import query
+
+
+def test_split_filter():
+    columns, operators, values = query.split_filter({'thrid': 't1', 'jmodseq': ('>', 5)})
+    assert columns == ('thrid', 'jmodseq')
+    assert operators == ('=', '>')
+    assert values == ['t1', 5]
+
+
+def test_statements():
+    assert query.select('jmessages', 'msgid', ('thrid', 'jmodseq'), ('=', '>')) \
+        == 'SELECT msgid FROM jmessages WHERE thrid=? AND jmodseq > ?'
+    assert query.select('jmessages', '*', limit=1) == 'SELECT * FROM jmessages LIMIT 1'
+    assert query.insert('jthreads', ('thrid', 'data')) \
+        == 'INSERT OR REPLACE INTO jthreads (`thrid`,`data`) VALUES (?,?)'
+    assert query.update('jthreads', ('data',), ('thrid',), ('=',)) \
+        == 'UPDATE jthreads SET data=? WHERE thrid=?'
+    assert query.nuke('jthreads', ('thrid',), ('=',)) \
+        == 'UPDATE jthreads SET deleted=1, jmodseq=? WHERE deleted=0 AND thrid=?'
+
+
+def test_cached():
+    a = query.select('jmessages', 'msgid', ('thrid',), ('=',))
+    assert query.select('jmessages', 'msgid', ('thrid',), ('=',)) is a
@@ -0,0 +1,52 @@
+import json
+
+from jmap import tracing
+
+
+def test_disabled():
+    tracing.configure('')
+    assert tracing.span('noop', a=1) is tracing.NOOP_SPAN
+
+
+def test_jsonl(tmp_path, monkeypatch):
+    monkeypatch.setattr(tracing, 'TRACE_FILE', str(tmp_path / 'traces.jsonl'))
+    tracing.configure('jsonl')
+    try:
+        with tracing.span('outer', folder='INBOX') as outer:
+            with tracing.span('inner') as inner:
+                inner.set_attribute('uids', 3)
+    finally:
+        tracing.configure('')
+    spans = [json.loads(line) for line in (tmp_path / 'traces.jsonl').open()]
+    assert [s['name'] for s in spans] == ['inner', 'outer']
+    assert spans[0]['parentSpanId'] == outer.spanId
+    assert spans[0]['traceId'] == spans[1]['traceId']
+    assert spans[0]['attributes'] == {'uids': 3}
+    assert spans[1]['attributes'] == {'folder': 'INBOX'}
+    assert spans[1]['end'] >= spans[1]['start']
+
+
+def test_writer_job_span(tmp_path, monkeypatch):
+    import sqlite3
+    from jmap.db.writer import Writer
+
+    monkeypatch.setattr(tracing, 'TRACE_FILE', str(tmp_path / 'traces.jsonl'))
+    tracing.configure('jsonl')
+    writer = Writer(sqlite3.connect(':memory:', check_same_thread=False,
+                                    isolation_level=None).cursor())
+
+    def job():
+        with tracing.span('inside'):
+            return 1
+
+    try:
+        with tracing.span('request') as request:
+            assert writer.run(job) == 1
+    finally:
+        writer.close()
+        tracing.configure('')
+    spans = {s['name']: s for s in map(json.loads, (tmp_path / 'traces.jsonl').open())}
+    assert spans['sqlite write']['parentSpanId'] == request.spanId
+    assert spans['sqlite write']['traceId'] == request.traceId
+    assert spans['sqlite write']['attributes'] == {'job': 'job', 'batch': 1}
+    assert spans['inside']['parentSpanId'] == spans['sqlite write']['spanId']
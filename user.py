@@ -1,4 +1,14 @@
 import binascii
+from hashlib import sha256
+import os
+try:
+    import orjson as json
+    def dumps(obj, sort_keys=False) -> bytes:
+        return json.dumps(obj, option=json.OPT_SORT_KEYS if sort_keys else 0)
+except ImportError:
+    import json
+    def dumps(obj, sort_keys=False) -> bytes:
+        return json.dumps(obj, sort_keys=sort_keys, separators=(',', ':')).encode()
 
 from starlette.authentication import (
     AuthenticationBackend, AuthenticationError, BaseUser,
@@ -6,6 +16,10 @@ from starlette.authentication import (
 )
 
 from jmap.account import ImapAccount
+from jmap.api import CAPABILITIES
+
+
+BASEURL = os.getenv('BASEURL', 'http://127.0.0.1:8888')
 
 
 class User(BaseUser):
@@ -19,7 +33,52 @@ class User(BaseUser):
         self.accounts = {
             username: ImapAccount(username, password),
         }
-        self.sessionState = '0'
+        self._session = None
+
+    @property
+    def session(self) -> dict:
+        "JMAP Session resource, built once, accounts and capabilities don't change."
+        if self._session is None:
+            self._session = self._build_session()
+        return self._session[0]
+
+    @property
+    def session_json(self) -> bytes:
+        "Serialized Session resource, ready to be sent as is."
+        if self._session is None:
+            self._session = self._build_session()
+        return self._session[1]
+
+    @property
+    def sessionState(self) -> str:
+        return self.session['state']
+
+    def _build_session(self):
+        res = {
+            "capabilities": {u: c.capabilityValue for u, c in CAPABILITIES.items()},
+            "username": self.username,
+            "accounts": {
+                account.id: {
+                    "name": account.name,
+                    "isPersonal": account.is_personal,
+                    "isArchiveUser": False,
+                    "accountCapabilities": account.capabilities,
+                    "isReadOnly": False
+                } for account in self.accounts.values()
+            },
+            "primaryAccounts": {
+                "urn:ietf:params:jmap:submission": self.username,
+                "urn:ietf:params:jmap:vacationresponse": self.username,
+                "urn:ietf:params:jmap:mail": self.username
+            },
+            "apiUrl": BASEURL + "/api/",
+            "downloadUrl": BASEURL + "/download/{accountId}/{blobId}/{name}?type={type}",
+            "uploadUrl": BASEURL + "/upload/{accountId}/",
+            "eventSourceUrl": BASEURL + "/event/"#?types={types}&closeafter={closeafter}&ping={ping}",
+        }
+        # state changes only when the content does
+        res['state'] = sha256(dumps(res, sort_keys=True)).hexdigest()[:16]
+        return res, dumps(res)
 
     @property
     def is_authenticated(self) -> bool: